@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the latency of cache lookups by exact key and by prefix.
+
+Fills a builtin cache collection of Zato with a number of bookings, keyed as
+they are by ``genesisng.util.keys``, and looks them up by id with a get by
+key and with ``get_by_prefix``, as ``booking.get`` used to, printing the
+median and 99th percentile of each. It must be run with the interpreter of
+the Zato installation, e.g.::
+
+    /opt/zato/current/bin/py benchmarks/cache_keys.py --entries 100000
+"""
+import argparse
+from random import Random
+from time import perf_counter
+from zato.cache import Cache
+from genesisng.util import keys
+
+
+def percentile(values, pct):
+    """Returns the given percentile of a sorted list of values."""
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def run(fn, ids, requests):
+    """Runs a lookup as many times as requested, cycling over the ids, and
+    returns the sorted timings."""
+    timings = []
+    for n in range(requests):
+        id_ = ids[n % len(ids)]
+        start = perf_counter()
+        fn(id_)
+        timings.append(perf_counter() - start)
+    return sorted(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--entries', type=int, default=100000)
+    parser.add_argument('--requests', type=int, default=1000)
+    args = parser.parse_args()
+
+    cache = Cache(max_size=args.entries, max_item_size=10000)
+    for id_ in range(1, args.entries + 1):
+        cache.set(keys.record(id_), {'id': id_, 'locator': '%06x' % id_})
+
+    random = Random(0)
+    ids = [random.randint(1, args.entries) for _ in range(args.requests)]
+    cases = (
+        ('get', lambda id_: cache.get(keys.record(id_), details=True)),
+        ('get_by_prefix', lambda id_: cache.get_by_prefix(
+            keys.record(id_), details=True, limit=1)),
+    )
+    for label, fn in cases:
+        timings = run(fn, ids, args.requests)
+        print('%s, %d entries: p50: %.3f ms, p99: %.3f ms' % (
+            label, args.entries, percentile(timings, 50) * 1000,
+            percentile(timings, 99) * 1000))
+
+
+if __name__ == '__main__':
+    main()
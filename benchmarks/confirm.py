@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Measures the latency of the ``/genesisng/availability/confirm`` channel.
+
+Makes a number of reservations, each one for a different stay so that they do
+not conflict with each other, and prints the median and 99th percentile of the
+response times. Run it against a freshly loaded database before and after a
+change to compare them, e.g.::
+
+    python3 benchmarks/confirm.py --requests 500 --start 2030-01-01
+"""
+import argparse
+import json
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+from datetime import datetime, timedelta
+from time import perf_counter
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+from uuid import uuid4
+
+
+def percentile(values, pct):
+    """Returns the given percentile of a sorted list of values."""
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def confirm(url, check_in, nights, id_room, guests, n):
+    """Makes a reservation and returns its status code and response time."""
+    data = {
+        'guests': guests,
+        'check_in': check_in.strftime('%Y-%m-%d'),
+        'check_out': (check_in + timedelta(days=nights)).strftime('%Y-%m-%d'),
+        'id_room': id_room,
+        'uuid': str(uuid4()),
+        'name': 'Benchmark',
+        'surname': 'Guest %d' % n,
+        'email': 'benchmark%d@example.com' % n
+    }
+    request = Request(url, data=json.dumps(data).encode('utf-8'),
+                      headers={'Content-Type': 'application/json'})
+    start = perf_counter()
+    try:
+        with urlopen(request) as response:
+            response.read()
+            status = response.status
+    except HTTPError as e:
+        status = e.code
+    return status, perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--url', default='http://127.0.0.1:11223'
+                        '/genesisng/availability/confirm')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--start', default='2030-01-01',
+                        help='Check-in date of the first reservation.')
+    parser.add_argument('--nights', type=int, default=1)
+    parser.add_argument('--room', type=int, default=1)
+    parser.add_argument('--guests', type=int, default=1)
+    args = parser.parse_args()
+
+    start = datetime.strptime(args.start, '%Y-%m-%d').date()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = [
+            executor.submit(confirm, args.url,
+                            start + timedelta(days=n * args.nights),
+                            args.nights, args.room, args.guests, n)
+            for n in range(args.requests)]
+        results = [f.result() for f in futures]
+
+    timings = sorted(t for _, t in results)
+    statuses = Counter(s for s, _ in results)
+    print('requests: %d, statuses: %s' % (
+        len(results), dict(sorted(statuses.items()))))
+    print('p50: %.2f ms, p99: %.2f ms, max: %.2f ms' % (
+        percentile(timings, 50) * 1000, percentile(timings, 99) * 1000,
+        timings[-1] * 1000))
+
+
+if __name__ == '__main__':
+    main()
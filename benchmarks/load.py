@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Measures the throughput of the availability and booking lookup channels.
+
+Keeps a number of concurrent clients calling ``availability.search``,
+``booking.locate`` and ``booking.validate`` for a given time, and prints the
+requests per second, per worker and in total, along with the median and 99th
+percentile of the response times of each channel. Run it against a server
+with ``cooperative`` enabled and disabled in the configuration, and the same
+number of workers, to compare them, e.g.::
+
+    python3 benchmarks/load.py --clients 50 --duration 30 --workers 2 \\
+        --locator abc123 --pin 1234
+"""
+import argparse
+import json
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from random import Random
+from time import perf_counter
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+
+def percentile(values, pct):
+    """Returns the given percentile of a sorted list of values."""
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def call(url, data=None):
+    """Calls a channel and returns its status code and response time."""
+    if data is not None:
+        request = Request(url, data=json.dumps(data).encode('utf-8'),
+                          headers={'Content-Type': 'application/json'})
+    else:
+        request = Request(url)
+    start = perf_counter()
+    try:
+        with urlopen(request) as response:
+            response.read()
+            status = response.status
+    except HTTPError as e:
+        status = e.code
+    return status, perf_counter() - start
+
+
+def client(args, n, deadline):
+    """Calls the channels in turns until the deadline and returns the status
+    code and response time of every call, by channel."""
+    random = Random(n)
+    start = datetime.strptime(args.start, '%Y-%m-%d').date()
+    results = defaultdict(list)
+    calls = 0
+    while perf_counter() < deadline:
+        channel = ('search', 'locate', 'validate')[calls % 3]
+        if channel == 'search':
+            check_in = start + timedelta(days=random.randrange(args.days))
+            check_out = check_in + timedelta(days=random.randint(1, 7))
+            url = '%s/genesisng/availability/search?check_in=%s' \
+                '&check_out=%s&guests=%d' % (
+                    args.url, check_in, check_out, random.randint(1, 4))
+            results[channel].append(call(url))
+        elif channel == 'locate':
+            url = '%s/genesisng/bookings/%s/locate' % (
+                args.url, args.locator)
+            results[channel].append(call(url))
+        else:
+            url = '%s/genesisng/bookings/%s/validate' % (
+                args.url, args.locator)
+            results[channel].append(call(url, {'pin': args.pin}))
+        calls += 1
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--url', default='http://127.0.0.1:11223')
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=30,
+                        help='Seconds to keep calling the channels.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of workers of the server.')
+    parser.add_argument('--start', default='2030-01-01',
+                        help='First check-in date of the searches.')
+    parser.add_argument('--days', type=int, default=365,
+                        help='Number of days to spread the searches over.')
+    parser.add_argument('--locator', required=True)
+    parser.add_argument('--pin', required=True)
+    args = parser.parse_args()
+
+    deadline = perf_counter() + args.duration
+    with ThreadPoolExecutor(max_workers=args.clients) as executor:
+        futures = [executor.submit(client, args, n, deadline)
+                   for n in range(args.clients)]
+        results = defaultdict(list)
+        for f in futures:
+            for channel, calls in f.result().items():
+                results[channel].extend(calls)
+
+    total = sum(len(calls) for calls in results.values())
+    print('requests: %d, %.1f req/s, %.1f req/s per worker' % (
+        total, total / args.duration, total / args.duration / args.workers))
+    for channel, calls in sorted(results.items()):
+        timings = sorted(t for _, t in calls)
+        statuses = Counter(s for s, _ in calls)
+        print('%s: %d requests, statuses: %s, p50: %.2f ms, p99: %.2f ms' % (
+            channel, len(calls), dict(sorted(statuses.items())),
+            percentile(timings, 50) * 1000, percentile(timings, 99) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the latency of lookups by key with and without prepared statements.
+
+Runs every lookup of ``genesisng.util.prepared`` a number of times through
+``session.query(...).one_or_none()`` and through the prepared statement, over
+the same pooled connection, and prints the median and 99th percentile of
+each, e.g.::
+
+    python3 benchmarks/lookup.py --uri postgresql://genesisng@localhost/genesisng
+"""
+import argparse
+from time import perf_counter
+from sqlalchemy import create_engine, and_
+from sqlalchemy.orm import sessionmaker, undefer
+from genesisng.schema.booking import Booking
+from genesisng.schema.guest import Guest
+from genesisng.schema.login import Login
+from genesisng.schema.room import Room
+from genesisng.util.prepared import lookup
+
+
+def percentile(values, pct):
+    """Returns the given percentile of a sorted list of values."""
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def lookups(session):
+    """Returns the lookups to compare, each with a function running the
+    query and a function running the prepared statement, for a key."""
+    return {
+        'booking.get': (
+            [r.id for r in session.query(Booking.id)],
+            lambda s, k: s.query(Booking).filter(
+                and_(Booking.id == k, Booking.deleted.is_(None))).
+            one_or_none(),
+            lambda s, k: lookup(s, Booking, 'get_booking', k)),
+        'booking.locate': (
+            [r.locator for r in session.query(Booking.locator)],
+            lambda s, k: s.query(Booking).filter(
+                and_(Booking.locator == k, Booking.deleted.is_(None))).
+            one_or_none(),
+            lambda s, k: lookup(s, Booking, 'locate_booking', k)),
+        'guest.get': (
+            [r.id for r in session.query(Guest.id)],
+            lambda s, k: s.query(Guest).filter(
+                and_(Guest.id == k, Guest.deleted.is_(None))).one_or_none(),
+            lambda s, k: lookup(s, Guest, 'get_guest', k)),
+        'room.get': (
+            [r.id for r in session.query(Room.id)],
+            lambda s, k: s.query(Room).filter(
+                and_(Room.id == k, Room.deleted.is_(None))).one_or_none(),
+            lambda s, k: lookup(s, Room, 'get_room', k)),
+        'login.validate': (
+            [r.username for r in session.query(Login.username)],
+            lambda s, k: s.query(Login).options(undefer('_password')).
+            filter(Login.username == k).one_or_none(),
+            lambda s, k: lookup(s, Login, 'get_login', k,
+                                options=[undefer('_password')])),
+    }
+
+
+def run(Session, fn, keys, requests):
+    """Runs a lookup as many times as requested, cycling over the keys, each
+    in a new session, and returns the sorted timings."""
+    timings = []
+    for n in range(requests):
+        session = Session()
+        start = perf_counter()
+        fn(session, keys[n % len(keys)])
+        timings.append(perf_counter() - start)
+        session.close()
+    return sorted(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--uri',
+                        default='postgresql://genesisng@localhost/genesisng')
+    parser.add_argument('--requests', type=int, default=5000)
+    args = parser.parse_args()
+
+    # A single pooled connection, so that statements are prepared only once
+    engine = create_engine(args.uri, pool_size=1, max_overflow=0)
+    Session = sessionmaker(bind=engine)
+
+    session = Session()
+    cases = lookups(session)
+    session.close()
+
+    for name, (keys, query, prepared) in sorted(cases.items()):
+        if not keys:
+            continue
+        for label, fn in (('query', query), ('prepared', prepared)):
+            timings = run(Session, fn, keys, args.requests)
+            print('%s, %s: p50: %.3f ms, p99: %.3f ms' % (
+                name, label, percentile(timings, 50) * 1000,
+                percentile(timings, 99) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the round trips and latency of the guest upsert step.
+
+Runs the former SELECT-then-flush upsert through the ORM and the current
+single-statement ``INSERT .. ON CONFLICT`` one against the database, for new
+and existing guests, counting the statements sent to the server and printing
+the median and 99th percentile of each. Every run is rolled back, e.g.::
+
+    python3 benchmarks/upsert.py --uri postgresql://genesisng@localhost/genesisng
+"""
+import argparse
+from time import perf_counter
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from genesisng.schema.guest import Guest
+from genesisng.pipeline.booking import upsert_guest
+
+
+def orm_upsert(session, params):
+    """The upsert as it was before, loading the guest in the session."""
+    result = session.query(Guest).\
+        filter(Guest.email == params['email']).one_or_none()
+    if result:
+        result.fromdict(params)
+    else:
+        result = Guest().fromdict(params)
+        session.add(result)
+    session.flush()
+    return result.asdict()
+
+
+def percentile(values, pct):
+    """Returns the given percentile of a sorted list of values."""
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def run(Session, upsert, emails, statements):
+    """Upserts a guest per email address and returns the timings and the
+    number of statements executed."""
+    timings = []
+    before = statements[0]
+    session = Session()
+    try:
+        for n, email in enumerate(emails):
+            params = {'name': 'Benchmark', 'surname': 'Guest %d' % n,
+                      'email': email, 'deleted': None}
+            start = perf_counter()
+            upsert(session, params)
+            timings.append(perf_counter() - start)
+    finally:
+        session.rollback()
+        session.close()
+    return sorted(timings), statements[0] - before
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--uri',
+                        default='postgresql://genesisng@localhost/genesisng')
+    parser.add_argument('--requests', type=int, default=1000)
+    args = parser.parse_args()
+
+    engine = create_engine(args.uri)
+    Session = sessionmaker(bind=engine)
+
+    # Count every statement sent to the server
+    statements = [0]
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements[0] += 1
+
+    session = Session()
+    existing = [r.email for r in session.query(Guest.email).
+                order_by(Guest.id).limit(args.requests)]
+    session.close()
+    new = ['benchmark%d@example.com' % n for n in range(args.requests)]
+
+    for label, emails in (('new', new), ('existing', existing)):
+        if not emails:
+            continue
+        for name, upsert in (('orm', orm_upsert),
+                             ('on conflict', upsert_guest)):
+            timings, executed = run(Session, upsert, emails, statements)
+            print('%s guests, %s: %d upserts, %.2f statements each, '
+                  'p50: %.2f ms, p99: %.2f ms' % (
+                      label, name, len(timings),
+                      executed / max(len(timings), 1),
+                      percentile(timings, 50) * 1000,
+                      percentile(timings, 99) * 1000))
+
+
+if __name__ == '__main__':
+    main()
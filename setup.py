@@ -56,6 +56,9 @@ setup(name='genesisng',
           'sphinx_rtd_theme',
           'sqlalchemy'
       ],
+      extras_require={
+          'green': ['psycogreen']
+      },
       python_requires='>=3.6',
       include_package_data=True,
       zip_safe=False)
@@ -0,0 +1,4 @@
+# coding: utf8
+from . import booking
+
+__all__ = ['booking']
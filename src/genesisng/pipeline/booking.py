@@ -0,0 +1,530 @@
+# -*- coding: utf-8 -*-
+"""
+Steps of the booking pipeline as plain functions.
+
+Every function receives the session to work with and, optionally, the cache
+collection to read from or write to, so that a whole reservation can be made
+in a single transaction without invoking other services. Functions flush
+their changes but never commit: it is up to the caller to commit or roll back
+the transaction.
+"""
+from sqlalchemy import and_, func, tuple_, case, cast, any_, all_, bindparam
+from sqlalchemy import select, exists, column, text, true
+from sqlalchemy import Integer as sqlInteger
+from sqlalchemy import Float as sqlFloat
+from sqlalchemy import Date as sqlDate
+from sqlalchemy.dialects.postgresql import ARRAY, insert
+from sqlalchemy.ext import baked
+from sqlalchemy.exc import SQLAlchemyError
+from genesisng.schema.booking import Booking
+from genesisng.schema.extra import Extra
+from genesisng.schema.guest import Guest
+from genesisng.schema.rate import Rate
+from genesisng.schema.room import Room
+from genesisng.util import occupancy, pricing, keys
+from genesisng.util.availability import rank, describe
+from genesisng.util.config import as_bool
+from genesisng.util.prepared import lookup
+
+# Baked queries of the pipeline, shared by all services running in this
+# process and keyed by the shape of the query
+bakery = baked.bakery()
+
+
+def list_extras(session, cache=None):
+    """
+    Returns all extras that have not been deleted.
+
+    :param session: A live session (transaction).
+    :type session: :class:`~sqlalchemy.orm.session.Session`
+    :param cache: The ``extras`` cache collection. Optional.
+    :type cache: :class:`~zato.server.cache.Cache`
+
+    :returns: A list of dicts with all attributes of a
+        :class:`~genesisng.schema.extra.Extra` model class.
+    :rtype: list
+    """
+
+    if cache is not None:
+        payload = cache.get(keys.ALL)
+        if payload:
+            return payload
+
+    result = session.query(Extra).\
+        filter(Extra.deleted.is_(None)).\
+        order_by(Extra.id.asc()).\
+        all()
+    payload = [r.asdict() for r in result]
+
+    if cache is not None and payload:
+        cache.set(keys.ALL, payload)
+    return payload
+
+
+def _booked(session):
+    """Returns a sub-select of the ids of the rooms booked on any night of
+    a stay."""
+
+    return session.query(Booking.id_room.label('id')).\
+        filter(
+            tuple_(Booking.check_in, Booking.check_out).
+            op('OVERLAPS')
+            (tuple_(cast(bindparam('check_in'), sqlDate),
+                    cast(bindparam('check_out'), sqlDate)))
+        ).\
+        filter(Booking.cancelled.is_(None)).\
+        subquery('subq')
+
+
+def _rooms(session):
+    """Returns a query with the rooms that have not been deleted and can
+    accommodate the guests."""
+
+    return session.query(Room.id, Room.floor_no, Room.room_no, Room.name,
+                         Room.sgl_beds, Room.dbl_beds, Room.supplement,
+                         Room.code, Room.number, Room.accommodates).\
+        filter(Room.deleted.is_(None)).\
+        filter(Room.accommodates >= bindparam('guests'))
+
+
+def _rates(session):
+    """Returns a query with the sum of nights and prices per season (0..N)
+    of a stay."""
+
+    check_in = cast(bindparam('check_in'), sqlDate)
+    check_out = cast(bindparam('check_out'), sqlDate)
+    guests = bindparam('guests', type_=sqlInteger)
+
+    return session.query(
+        func.SUM(
+            case(
+                [(check_out > Rate.date_to, Rate.date_to)],
+                else_=check_out
+            ) -
+            case(
+                [(check_in > Rate.date_from, check_in)],
+                else_=Rate.date_from
+            )
+            ).label('nights'),
+        (func.SUM((
+            case(
+                [(check_out > Rate.date_to, Rate.date_to)],
+                else_=check_out
+            ) -
+            case(
+                [(check_in > Rate.date_from, check_in)],
+                else_=Rate.date_from
+            )) * (Rate.base_price + Rate.bed_price * guests)
+            ).label('price'))
+        ).\
+        filter(
+            tuple_(Rate.date_from, Rate.date_to).
+            op('OVERLAPS')
+            (tuple_(check_in, check_out))
+        ).\
+        filter(Rate.published.is_(True))
+
+
+def _priced(query):
+    """Turns a query of available rooms into a query of priced rooms, sorted
+    the same way :func:`~genesisng.util.availability.rank` does."""
+
+    session = query.session
+    a = query.cte(name='a')
+
+    # Sum of nights and prices per season (0..N)
+    p = _rates(session).cte(name='p')
+
+    total_price = a.c.supplement * p.c.nights + p.c.price
+    return session.query(
+        a.c.id, a.c.floor_no, a.c.room_no, a.c.name, a.c.sgl_beds,
+        a.c.dbl_beds, a.c.code, a.c.number, a.c.accommodates,
+        cast(p.c.nights, sqlInteger).label('nights'),
+        cast(p.c.price, sqlFloat).label('price')).\
+        order_by(total_price.asc()).\
+        order_by(a.c.accommodates.asc()).\
+        order_by(a.c.sgl_beds.asc()).\
+        order_by(a.c.dbl_beds.asc()).\
+        order_by(a.c.floor_no.asc()).\
+        order_by(a.c.room_no.asc())
+
+
+def _calendar(session, config, check_in, check_out, guests, logger=None,
+              generations=None):
+    """Returns the nights and the price of a stay from the price calendar, or
+    None if it is not enabled or could not be loaded."""
+
+    if not as_bool(config.price_calendar):
+        return None
+    try:
+        pricing.calendar.ensure(session, int(config.price_calendar_ttl),
+                                generations)
+        return pricing.calendar.quote(check_in, check_out, guests)
+    except SQLAlchemyError:
+        if logger:
+            logger.exception('Could not load the price calendar.')
+        return None
+
+
+def _busy(session, config, check_in, check_out, logger=None,
+          generations=None):
+    """Returns the ids of the rooms booked on any night of a stay from the
+    occupancy index, or None if it is not enabled, could not be loaded or,
+    when checked, does not match the database."""
+
+    if not as_bool(config.occupancy_index):
+        return None
+    try:
+        occupancy.index.ensure(session, int(config.occupancy_ttl),
+                               generations)
+        busy = occupancy.index.busy_rooms(check_in, check_out)
+    except SQLAlchemyError:
+        if logger:
+            logger.exception('Could not load the occupancy index.')
+        return None
+
+    # Compare the index against the database and fall back to the
+    # sub-select if they do not match
+    if as_bool(config.occupancy_check):
+        expected = {r.id for r in bakery(
+            lambda s: s.query(_booked(s).c.id))(session).params(
+                check_in=check_in, check_out=check_out)}
+        if busy != expected:
+            if logger:
+                logger.warning(
+                    'Occupancy index mismatch for %s-%s: %s != %s' % (
+                        check_in, check_out, sorted(busy), sorted(expected)))
+            occupancy.index.invalidate()
+            return None
+    return busy
+
+
+def search(session, config, check_in, check_out, guests, rooms=None,
+           logger=None, generations=None):
+    """
+    Searches for the rooms available for a stay and prices them.
+
+    Booked rooms are taken from the in-process
+    :class:`~genesisng.util.occupancy.OccupancyIndex` and prices from the
+    in-process :class:`~genesisng.util.pricing.PriceCalendar` when enabled in
+    the configuration, falling back to the database otherwise. Queries are
+    baked, so that they are compiled only once per shape and the stay is
+    passed as bound parameters.
+
+    :param session: A live session (transaction).
+    :type session: :class:`~sqlalchemy.orm.session.Session`
+    :param config: The ``availability`` section of the configuration.
+    :type config: :class:`~bunch.Bunch`
+    :param check_in: The date the guests want to arrive.
+    :type check_in: date
+    :param check_out: The date the guests want to leave.
+    :type check_out: date
+    :param guests: The number of guests.
+    :type guests: int
+    :param rooms: A list of room ids to filter the results. Optional.
+    :type rooms: list
+    :param logger: The logger of the calling service. Optional.
+    :type logger: :class:`~logging.Logger`
+    :param generations: The cache collection holding the generations of the
+        occupancy index and the price calendar. Optional.
+    :type generations: :class:`~zato.server.cache.Cache`
+
+    :returns: A sub-set of :class:`~genesisng.schema.room.Room` properties,
+        the number of nights and the pricing details of the stay, cheapest
+        first.
+    :rtype: list of dict
+    """
+
+    params = {'check_in': check_in, 'check_out': check_out, 'guests': guests}
+
+    # Booked rooms from the occupancy index, if enabled, loaded and matching
+    # the database
+    busy = _busy(session, config, check_in, check_out, logger, generations)
+
+    # Room availability using a sub-select or the booked rooms
+    a = bakery(_rooms)
+    if busy is None:
+        a += lambda q: q.filter(Room.id.notin_(_booked(q.session)))
+    elif busy:
+        a += lambda q: q.filter(
+            Room.id != all_(bindparam('busy', type_=ARRAY(sqlInteger))))
+        params['busy'] = sorted(busy)
+    if rooms:
+        a += lambda q: q.filter(
+            Room.id == any_(bindparam('rooms', type_=ARRAY(sqlInteger))))
+        params['rooms'] = list(rooms)
+
+    # Nights and price of the stay from the price calendar, if enabled
+    quote = _calendar(session, config, check_in, check_out, guests, logger,
+                      generations)
+
+    if quote is not None:
+        # Price every available room in memory and sort them the same way
+        # the query does
+        nights, price = quote
+        result = rank(a(session).params(params).all(), set(), guests,
+                      nights, price)
+    else:
+        result = a.with_criteria(_priced)(session).params(params).all()
+
+    return [describe(r, config.taxes_percentage) for r in result]
+
+
+# Stays searched for by :func:`search_many`, as a relation numbered in order
+_STAYS = text(
+    'SELECT * FROM UNNEST(CAST(:check_in AS DATE[]), '
+    'CAST(:check_out AS DATE[]), CAST(:guests AS INTEGER[])) '
+    'WITH ORDINALITY AS s(check_in, check_out, guests, n)').\
+    columns(column('check_in', sqlDate), column('check_out', sqlDate),
+            column('guests', sqlInteger), column('n', sqlInteger)).\
+    alias('s')
+
+
+def _search_all(session, stays):
+    """Returns the available rooms of many stays, each one with the same
+    properties as the rows of :func:`_priced` plus the supplement, in a single
+    statement that joins every stay laterally with the rates, rooms and
+    bookings."""
+
+    result = [[] for _ in stays]
+    if not stays:
+        return result
+
+    stay = _STAYS.c
+
+    # Sum of nights and prices per season (0..N) of every stay
+    nights = func.least(stay.check_out, Rate.date_to) - \
+        func.greatest(stay.check_in, Rate.date_from)
+    p = select([
+        func.sum(nights).label('nights'),
+        func.sum(nights * (Rate.base_price + Rate.bed_price * stay.guests)).
+        label('price')]).\
+        where(tuple_(Rate.date_from, Rate.date_to).
+              op('OVERLAPS')(tuple_(stay.check_in, stay.check_out))).\
+        where(Rate.published.is_(True)).\
+        lateral('p')
+
+    booked = exists().\
+        where(Booking.id_room == Room.id).\
+        where(tuple_(Booking.check_in, Booking.check_out).
+              op('OVERLAPS')(tuple_(stay.check_in, stay.check_out))).\
+        where(Booking.cancelled.is_(None))
+
+    total_price = Room.supplement * p.c.nights + p.c.price
+    statement = select([
+        stay.n, Room.id, Room.floor_no, Room.room_no, Room.name,
+        Room.sgl_beds, Room.dbl_beds, Room.supplement, Room.code,
+        Room.number.label('number'),
+        Room.accommodates.label('accommodates'),
+        cast(p.c.nights, sqlInteger).label('nights'),
+        cast(p.c.price, sqlFloat).label('price')]).\
+        select_from(
+            _STAYS.join(p, true()).join(Room, and_(
+                Room.deleted.is_(None),
+                Room.accommodates >= stay.guests,
+                ~booked))).\
+        where(p.c.nights > 0).\
+        order_by(stay.n, total_price, Room.accommodates, Room.sgl_beds,
+                 Room.dbl_beds, Room.floor_no, Room.room_no)
+
+    rows = session.execute(statement, {
+        'check_in': [stay[0] for stay in stays],
+        'check_out': [stay[1] for stay in stays],
+        'guests': [stay[2] for stay in stays]})
+    for r in rows:
+        result[r.n - 1].append(r)
+    return result
+
+
+def search_many(session, config, stays, logger=None, generations=None):
+    """
+    Searches for the rooms available for many stays and prices them.
+
+    Stays are answered in memory from the occupancy index and the price
+    calendar when both are enabled, the same way :func:`search` does,
+    including the comparison against the database when ``occupancy_check``
+    is enabled. The rest are searched for in a single SQL statement.
+
+    :param session: A live session (transaction).
+    :type session: :class:`~sqlalchemy.orm.session.Session`
+    :param config: The ``availability`` section of the configuration.
+    :type config: :class:`~bunch.Bunch`
+    :param stays: A list of tuples of check-in date, check-out date and
+        number of guests.
+    :type stays: list
+    :param logger: The logger of the calling service. Optional.
+    :type logger: :class:`~logging.Logger`
+    :param generations: The cache collection holding the generations of the
+        occupancy index and the price calendar. Optional.
+    :type generations: :class:`~zato.server.cache.Cache`
+
+    :returns: The available rooms of every stay, in the same order as the
+        stays, with the same properties as the rows of the availability
+        search plus the supplement, to be passed on to
+        :func:`~genesisng.util.availability.describe`.
+    :rtype: list of list
+    """
+
+    result = [None] * len(stays)
+    if as_bool(config.occupancy_index) and as_bool(config.price_calendar) \
+            and stays:
+        # Every room, as they are filtered by guests when ranked
+        all_rooms = bakery(_rooms)(session).params(
+            guests=min(g for _, _, g in stays)).all()
+        for i, (check_in, check_out, guests) in enumerate(stays):
+            busy = _busy(session, config, check_in, check_out, logger,
+                         generations)
+            if busy is None:
+                continue
+            quote = _calendar(session, config, check_in, check_out, guests,
+                              logger, generations)
+            if quote is not None:
+                result[i] = rank(all_rooms, busy, guests, *quote)
+
+    # The rest, in a single statement
+    pending = [i for i, r in enumerate(result) if r is None]
+    for i, r in zip(pending, _search_all(session,
+                                         [stays[i] for i in pending])):
+        result[i] = r
+    return result
+
+
+def quote(session, config, check_in, check_out, guests, id_room,
+          logger=None, generations=None):
+    """
+    Prices a stay in a room without checking whether the room is booked,
+    which is left to the exclusion constraint on bookings.
+
+    :param session: A live session (transaction).
+    :type session: :class:`~sqlalchemy.orm.session.Session`
+    :param config: The ``availability`` section of the configuration.
+    :type config: :class:`~bunch.Bunch`
+    :param check_in: The date the guests want to arrive.
+    :type check_in: date
+    :param check_out: The date the guests want to leave.
+    :type check_out: date
+    :param guests: The number of guests.
+    :type guests: int
+    :param id_room: The id of the room.
+    :type id_room: int
+    :param logger: The logger of the calling service. Optional.
+    :type logger: :class:`~logging.Logger`
+    :param generations: The cache collection holding the generation of the
+        price calendar. Optional.
+    :type generations: :class:`~zato.server.cache.Cache`
+
+    :returns: The same sub-set of :class:`~genesisng.schema.room.Room`
+        properties and pricing details returned by :func:`search`, or None if
+        the room does not exist, cannot accommodate the guests or no
+        published rate covers the stay.
+    :rtype: dict
+    """
+
+    params = {'check_in': check_in, 'check_out': check_out, 'guests': guests,
+              'id_room': id_room}
+
+    room = bakery(_rooms)
+    room += lambda q: q.filter(Room.id == bindparam('id_room'))
+    room = room(session).params(params).one_or_none()
+    if room is None:
+        return None
+
+    quote = _calendar(session, config, check_in, check_out, guests, logger,
+                      generations)
+    if quote is None:
+        r = bakery(_rates)(session).params(params).one()
+        quote = int(r.nights or 0), float(r.price or 0)
+
+    result = rank([room], set(), guests, *quote)
+    return describe(result[0], config.taxes_percentage) if result else None
+
+
+def upsert_guest(session, params):
+    """
+    Creates a guest or updates the one with the same email address in a
+    single ``INSERT .. ON CONFLICT (email) DO UPDATE`` statement, updating
+    only the attributes given.
+
+    :param session: A live session (transaction).
+    :type session: :class:`~sqlalchemy.orm.session.Session`
+    :param params: The attributes of the guest, including the email.
+    :type params: dict
+
+    :returns: All attributes of a :class:`~genesisng.schema.guest.Guest`
+        model class, as stored in the database.
+    :rtype: dict
+
+    :raises: :class:`~sqlalchemy.exc.IntegrityError` if a constraint has been
+        violated.
+    """
+
+    # Rows are neither loaded nor tracked by the session
+    table = Guest.__table__
+    stmt = insert(table).values(**params)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.email],
+        set_={k: stmt.excluded[k] for k in params if k != 'email'} or
+        {'email': stmt.excluded.email}
+    ).returning(*table.columns)
+    return dict(session.execute(stmt).fetchone())
+
+
+def create_booking(session, params):
+    """
+    Creates a booking.
+
+    :param session: A live session (transaction).
+    :type session: :class:`~sqlalchemy.orm.session.Session`
+    :param params: The attributes of the booking.
+    :type params: dict
+
+    :returns: The booking, already flushed.
+    :rtype: :class:`~genesisng.schema.booking.Booking`
+
+    :raises: :class:`~sqlalchemy.exc.IntegrityError` if a constraint has been
+        violated.
+    """
+
+    result = Booking().fromdict(params)
+    session.add(result)
+    session.flush()
+    return result
+
+
+def get_room(session, id_, cache=None, prepared=False):
+    """
+    Returns a room that has not been deleted.
+
+    :param session: A live session (transaction).
+    :type session: :class:`~sqlalchemy.orm.session.Session`
+    :param id_: The id of the room.
+    :type id_: int
+    :param cache: The ``rooms`` cache collection. Optional.
+    :type cache: :class:`~zato.server.cache.Cache`
+    :param prepared: Whether to use a prepared statement. Optional.
+    :type prepared: bool
+
+    :returns: All attributes of a :class:`~genesisng.schema.room.Room` model
+        class, or None if not found.
+    :rtype: dict
+    """
+
+    cache_key = keys.record(id_)
+    if cache is not None:
+        payload = cache.get(cache_key)
+        if payload:
+            return payload
+
+    if prepared:
+        result = lookup(session, Room, 'get_room', id_)
+    else:
+        result = session.query(Room).\
+            filter(and_(Room.id == id_, Room.deleted.is_(None))).\
+            one_or_none()
+    if result is None:
+        return None
+    payload = result.asdict()
+
+    if cache is not None:
+        cache.set(cache_key, payload)
+    return payload
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from datetime import date, timedelta
+from zato.server.service import Service
+from genesisng.util.availability import most_searched
+from genesisng.util.config import as_bool
+
+
+class Warmup(Service):
+    """
+    Service class to warm up the ``availability`` cache.
+
+    Scheduled job ``genesisng.availability.warmup``.
+
+    Searches for availability, without filtering by rooms, for the most
+    frequent combinations of check-in date, check-out date and number of
+    guests counted by :class:`~genesisng.services.availability.Search` in the
+    ``searches`` cache collection, shared by all server processes, so that it
+    does not matter which one runs the job. Up to ``warmup.searches`` of them
+    with a check-in date within the next ``warmup.horizon`` days are searched
+    for, so that the next searches for them are answered from the cache.
+
+    Searches are made through :class:`~genesisng.services.availability.Batch`,
+    which skips those already in the cache. As the job runs every minute,
+    entries evicted by bookings or rate changes are searched for again
+    shortly after.
+    """
+
+    def handle(self):
+        """
+        Service handler.
+        """
+
+        config = self.user_config.genesisng.warmup
+        if not as_bool(config.enabled):
+            return
+        max_stays = int(
+            self.user_config.genesisng.availability.batch_max_stays)
+
+        today = date.today()
+        end = today + timedelta(days=int(config.horizon))
+        stays = [{
+            'check_in': check_in.strftime('%Y-%m-%d'),
+            'check_out': check_out.strftime('%Y-%m-%d'),
+            'guests': guests
+        } for check_in, check_out, guests in most_searched(
+            self.cache.get_cache('builtin', 'searches'),
+            int(config.searches), today, end)]
+
+        for i in range(0, len(stays), max_stays):
+            self.invoke('availability.batch',
+                        {'stays': stays[i:i + max_stays]})
+
+        self.logger.info('Warmed up the availability cache for %s searches.' %
+                         len(stays))
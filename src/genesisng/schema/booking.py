@@ -2,11 +2,12 @@
 import enum
 from .base import Base
 from sqlalchemy import Column, Integer, Float, String, Date, DateTime
-from sqlalchemy import func
+from sqlalchemy import func, text, event, DDL
 from sqlalchemy import UniqueConstraint, CheckConstraint, ForeignKey, Enum
-from sqlalchemy.dialects.postgresql import UUID, JSONB
+from sqlalchemy.dialects.postgresql import UUID, JSONB, ExcludeConstraint
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import relationship
+from sqlalchemy.sql.elements import quoted_name
 from nanoid import generate
 from random import randint
 from datetime import datetime
@@ -77,10 +78,10 @@ class Booking(Base):
     Uses a unique constraint on the combination of the check-in date, the guest
     id and the room id to prevent duplicated reservations. It also uses a check
     constraint to ensure the check-in date is always before in time than the
-    check-out date.
-
-    TODO: Add an exclude constraint on the check-in and check-out dates to
-    prevent dates from overlapping.
+    check-out date. Finally, it uses an exclude constraint on the room id, the
+    check-in date and the check-out date to prevent bookings of the same room
+    that have not been cancelled from overlapping. The exclude constraint
+    requires the ``btree_gist`` extension.
 
     Includes b-tree indexes to compare, sort and reduce memory consumption
     on fields `check_in`, `check_out`, `locator`, `status`, `meal_plan` and
@@ -104,11 +105,19 @@ class Booking(Base):
     __tablename__ = 'booking'
     __rels__ = []
     __table_args__ = (
-        # TODO: Prevent overlappings using dates as well
         UniqueConstraint('id_guest', 'id_room', 'check_in',
                          name='booking_id_guest_id_room_check_in'),
         # Never check out before checking in
         CheckConstraint('check_in < check_out'),
+        # Prevent bookings of the same room from overlapping by using an
+        # exclusion constraint, the equality operator (=) for the room id and
+        # the overlap operator (&&) for the daterange type. Cancelled bookings
+        # do not occupy the room.
+        ExcludeConstraint(('id_room', '='), (Column(
+            quoted_name('daterange(check_in, check_out)', quote=False)), '&&'),
+                          using='gist',
+                          where=text('cancelled IS NULL'),
+                          name='booking_id_room_date_range'),
     )
 
     id = Column(Integer, primary_key=True)
@@ -185,3 +194,12 @@ class Booking(Base):
         """String representation of the object."""
         return "<Booking(id='%s', guests='%s', check_in='%s', check_out='%s')>" % (
             self.id, self.guests, self.check_in, self.check_out)
+
+
+# Covering index to resolve locators into the id and PIN of bookings with an
+# index-only scan. Created through DDL, as SQLAlchemy 1.3 does not support the
+# INCLUDE clause in indexes.
+event.listen(Booking.__table__, 'after_create', DDL(
+    'CREATE UNIQUE INDEX ix_booking_locator_covering ON booking (locator) '
+    'INCLUDE (id, pin) WHERE deleted IS NULL').execute_if(
+        dialect='postgresql'))
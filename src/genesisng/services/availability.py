@@ -1,20 +1,20 @@
 # -*- coding: utf-8 -*-
 from contextlib import closing
 from http.client import OK, NO_CONTENT, BAD_REQUEST, CREATED, CONFLICT
-from http.client import CONTINUE
 from zato.server.service import Service
-from zato.server.service import Integer, Date, List, Dict
-from genesisng.schema.room import Room
-from genesisng.schema.rate import Rate
-from genesisng.schema.booking import Booking
-from sqlalchemy import func, tuple_, case, cast, any_
-from sqlalchemy import Integer as sqlInteger
-from sqlalchemy import Float as sqlFloat
-from sqlalchemy import Date as sqlDate
+from zato.server.service import Integer, Date, List, Dict, ListOfDicts
+from sqlalchemy.exc import IntegrityError
 from uuid import UUID
-from datetime import datetime
-from math import ceil
-from bunch import Bunch
+from datetime import datetime, timedelta
+from time import time
+from heapq import nsmallest
+from genesisng.pipeline import booking as pipeline
+from genesisng.util import occupancy, green, keys, singleflight
+from genesisng.util.availability import cache_key, compatible_keys
+from genesisng.util.availability import remember, evict, stale_grace
+from genesisng.util.availability import count_search, describe
+from genesisng.util.cache import forget_bookings, remember_booking
+from genesisng.util.config import as_bool
 
 
 class Search(Service):
@@ -27,7 +27,9 @@ class Search(Service):
 
     Stores the search results in the ``availability`` cache. Returns
     ``Cache-Control``, ``Last-Modified`` and ``ETag`` headers. Returns a
-    ``Content-Language`` header.
+    ``Content-Language`` header. Searches filtered by rooms are also answered
+    from a cached search for the same dates and guests that was not filtered,
+    or was filtered by more rooms.
 
     Returns ``OK`` if results have been found, ``NO_CONTENT`` if there is no
     availability or ``BAD_REQUEST`` if the check-in date is not before the
@@ -36,6 +38,30 @@ class Search(Service):
     May receive a live session through the ``self.environ`` parameter, which is
     to be reused in order to encapsulate the SQL sentences inside an active
     transaction.
+
+    Booked rooms are taken from the in-process
+    :class:`~genesisng.util.occupancy.OccupancyIndex` when enabled in the
+    configuration, falling back to a sub-select on bookings when the index
+    cannot be loaded or disagrees with the database. Likewise, nights and
+    prices are taken from the in-process
+    :class:`~genesisng.util.pricing.PriceCalendar` when enabled, falling back
+    to adding up the overlapping rates in the database.
+
+    Identical searches missing the cache at the same time are run only once
+    per server, if ``coalesce`` is enabled, and optionally once across
+    servers through a lock entry in the ``default`` cache, if
+    ``coalesce_across_servers`` is enabled. The rest wait for up to
+    ``coalesce_timeout`` seconds and share the results.
+
+    If ``stale_while_revalidate`` is enabled, entries older than
+    ``stale_after`` seconds, and copies of the entries evicted in the last
+    ``stale_grace`` seconds, are still served, with a
+    ``stale-while-revalidate`` ``Cache-Control`` header, while the search is
+    run again in the background.
+
+    Searches are counted by check-in date, number of nights and number of
+    guests, so that :class:`~genesisng.scheduler.warmup.Warmup` searches for
+    the most frequent ones in advance.
     """
 
     class SimpleIO(object):
@@ -68,7 +94,7 @@ class Search(Service):
 
         conn = self.user_config.genesisng.database.connection
         cache_control = self.user_config.genesisng.cache.default_cache_control
-        taxes_percentage = self.user_config.genesisng.availability.taxes_percentage
+        config = self.user_config.genesisng.availability
         check_in = self.request.input.check_in
         check_out = self.request.input.check_out
         guests = self.request.input.guests
@@ -85,133 +111,127 @@ class Search(Service):
             self.response.payload = {'error': {'message': msg}}
             return
 
-        # Process optional list of room ids
+        # Process optional list of room ids, sorted and without duplicates
         try:
-            rooms = list(map(
+            rooms = sorted(set(map(
                 int,
-                self.request.input.rooms)) if self.request.input.rooms else []
+                self.request.input.rooms))) if self.request.input.rooms else []
         except ValueError:
             rooms = []
 
-        # Check whether a copy exists in the cache
-        # TODO: Use regexp to filter multiple entries by room number so that
-        # a greater number of cache entries can be of use.
-        cache_key = 'check_in:%s|check_out:%s|guests:%s|rooms:%s' % (
-            check_in.strftime('%Y-%m-%d'), check_out.strftime('%Y-%m-%d'),
-            guests, str(rooms))
+        # Count the search, to warm up the cache for the most frequent ones
+        if as_bool(self.user_config.genesisng.warmup.enabled):
+            count_search(self.cache.get_cache('builtin', 'searches'),
+                         check_in, check_out, guests)
+
         cache = self.cache.get_cache('builtin', 'availability')
-        cache_data = cache.get(cache_key, details=True)
-        if cache_data:
-            self.response.status_code = OK
-            self.environ.status_code = OK
-            self.response.headers['Cache-Control'] = cache_control
+        candidates = compatible_keys(check_in, check_out, guests, rooms)
+        key = candidates[0]
+        grace = stale_grace(self.user_config)
+        timeout = int(config.coalesce_timeout)
+
+        def search(session):
+            # Run the search and store the results in the cache, indexed by
+            # their dates. Drop the stale copy, if any, once refreshed or if
+            # the refresh failed, so that it is not served any longer.
+            try:
+                lod = pipeline.search(
+                    session, config, check_in, check_out, guests, rooms,
+                    self.logger, self.cache.get_cache('builtin', 'default'))
+                cache_data = None
+                if lod:
+                    cache_data = cache.set(key, lod, details=True)
+                    remember(key, check_in, check_out, rooms, lod)
+            finally:
+                if grace:
+                    try:
+                        cache.delete(keys.stale(key))
+                    except KeyError:
+                        pass
+            return lod, cache_data
+
+        def run():
+            # Wait for a server already running the same search, if enabled
+            token = None
+            if as_bool(config.coalesce_across_servers):
+                locks = self.cache.get_cache('builtin', 'default')
+                token = singleflight.acquire(locks, keys.lock(key), timeout)
+                if token is None:
+                    cache_data = singleflight.wait(
+                        cache, key, locks, keys.lock(key), timeout)
+                    if cache_data:
+                        return cache_data.value, cache_data
+            try:
+                with closing(self.outgoing.sql.get(conn).session()) as s:
+                    return search(s)
+            finally:
+                if token is not None:
+                    singleflight.release(locks, keys.lock(key), token)
+
+        # Check whether a copy exists in the cache, either of this very search
+        # or of one whose result includes all the requested rooms, or else a
+        # stale copy of this very search, if stale entries may be served.
+        if grace:
+            candidates.append(keys.stale(key))
+        for k in candidates:
+            cache_data = cache.get(k, details=True)
+            if not cache_data:
+                continue
+
+            # Stale copies are served for no longer than the grace period
+            # since their eviction, however often they are read
+            value = cache_data.value
+            if k == keys.stale(key):
+                if time() - value['evicted'] > grace:
+                    continue
+                value = value['value']
+
+            # Entries evicted or older than allowed are served while they
+            # are refreshed in the background
+            age = time() - cache_data.last_write
+            stale = grace and (k == keys.stale(key) or
+                               age > int(config.stale_after))
+            if stale:
+                self.response.headers['Cache-Control'] = \
+                    'max-age=0, stale-while-revalidate=%s' % grace
+                if not singleflight.group.running(key):
+                    green.spawn(singleflight.group.do, key, run, timeout,
+                                logger=self.logger)
+            else:
+                self.response.headers['Cache-Control'] = cache_control
             self.response.headers['Last-Modified'] = cache_data.last_write_http
-            self.response.headers['ETag'] = cache_data.hash
             self.response.headers['Content-Language'] = 'en'
-            self.response.payload[:] = cache_data.value
+            if k in (key, keys.stale(key)):
+                payload = value
+                self.response.headers['ETag'] = cache_data.hash
+            else:
+                payload = [r for r in value if r['id'] in rooms]
+
+            if payload:
+                self.response.status_code = OK
+                self.environ.status_code = OK
+                self.response.payload[:] = payload
+            else:
+                self.response.status_code = NO_CONTENT
+                self.environ.status_code = NO_CONTENT
             self.logger.info('Returning availability from cache.')
             return
 
-        # Reuse the session if any has been provided
+        # Reuse the session if any has been provided. Otherwise, identical
+        # concurrent searches are run only once, if enabled, and the rest
+        # wait for and share its results.
         if self.environ.session:
-            session = self.environ.session
+            lod, cache_data = search(self.environ.session)
+        elif as_bool(config.coalesce):
+            (lod, cache_data), shared = singleflight.group.do(
+                key, run, timeout)
+            if shared:
+                self.logger.info('Returning availability of a concurrent '
+                                 'search.')
         else:
-            session = self.outgoing.sql.get(conn).session()
-
-        # Sum of nights and prices per season (0..N)
-        p = session.query(
-            func.SUM(
-                case(
-                    [(check_out > Rate.date_to, Rate.date_to)],
-                    else_=check_out
-                ) -
-                case(
-                    [(check_in > Rate.date_from, check_in)],
-                    else_=Rate.date_from
-                )
-                ).label('nights'),
-            (func.SUM((
-                case(
-                    [(check_out > Rate.date_to, Rate.date_to)],
-                    else_=check_out
-                ) -
-                case(
-                    [(check_in > Rate.date_from, check_in)],
-                    else_=Rate.date_from
-                )) * (Rate.base_price + Rate.bed_price * guests)
-                ).label('price'))
-            ).\
-            filter(
-                tuple_(Rate.date_from, Rate.date_to).
-                op('OVERLAPS')
-                (tuple_(cast(check_in, sqlDate), cast(check_out, sqlDate)))
-            ).\
-            filter(Rate.published.is_(True)).\
-            cte(name='p')
-
-        # Room availability using a sub-select
-        subq = session.query(Booking.id_room.label('id')).\
-            filter(
-                tuple_(Booking.check_in, Booking.check_out).
-                op('OVERLAPS')
-                (tuple_(cast(check_in, sqlDate), cast(check_out, sqlDate)))
-            ).\
-            filter(Booking.cancelled.is_(None)).\
-            subquery('subq')
-
-        a = session.query(Room.id, Room.floor_no, Room.room_no, Room.name,
-                          Room.sgl_beds, Room.dbl_beds,  Room.supplement,
-                          Room.code, Room.number, Room.accommodates).\
-            filter(Room.deleted.is_(None)).\
-            filter(Room.id.notin_(subq)).\
-            filter(Room.accommodates >= guests)
-        if rooms:
-            a = a.filter(Room.id == any_(rooms))
-        a = a.cte(name='a')
-
-        # Execute query
-        total_price = a.c.supplement * p.c.nights + p.c.price
-        result = session.query(
-            a.c.id, a.c.floor_no, a.c.room_no, a.c.name, a.c.sgl_beds,
-            a.c.dbl_beds, a.c.code, a.c.number, a.c.accommodates,
-            cast(p.c.nights, sqlInteger).label('nights'),
-            cast(p.c.price, sqlFloat).label('price')).\
-            order_by(total_price.asc()).\
-            order_by(a.c.accommodates.asc()).\
-            order_by(a.c.sgl_beds.asc()).\
-            order_by(a.c.dbl_beds.asc()).\
-            order_by(a.c.floor_no.asc()).\
-            order_by(a.c.room_no.asc()).\
-            all()
-
-        if result:
-            # A complex result set cannot be stored in the cache as list of
-            # WritableKeyedTuple, so we transform it into a list of
-            # dictionaries.
-            lod = []
-            for r in result:
-                # To prevent missing decimals, taxes amount is rounded
-                # down/up using math.ceil()
-                taxes_value = ceil(r.price * taxes_percentage / 100)
-                d = {
-                    'id': r.id,
-                    'number': r.number,
-                    'name': r.name,
-                    'sgl_beds': r.sgl_beds,
-                    'dbl_beds': r.dbl_beds,
-                    'accommodates': r.accommodates,
-                    'code': r.code,
-                    'nights': r.nights,
-                    'price': r.price,
-                    'taxes_percentage': taxes_percentage,
-                    'taxes_value': taxes_value,
-                    'total_price': r.price + taxes_value
-                }
-                lod.append(d)
-
-            # Store results in the cache
-            cache_data = cache.set(cache_key, lod, details=True)
+            lod, cache_data = run()
 
+        if lod:
             if cache_data:
                 self.response.headers['Cache-Control'] = cache_control
                 self.response.headers['Last-Modified'] = cache_data.\
@@ -229,9 +249,254 @@ class Search(Service):
             self.environ.status_code = NO_CONTENT
             self.response.headers['Cache-Control'] = 'no-cache'
 
-        # Close the session only if we created a new one
-        if not self.environ.session:
-            session.close()
+
+class Batch(Service):
+    """
+    Service class to search for availability for many stays at once.
+
+    Channel ``/genesisng/availability/batch``.
+
+    Uses `SimpleIO`_.
+
+    Receives a list of stays, each one with its check-in date, check-out date
+    and number of guests, and returns the available rooms of every stay
+    keyed by ``check_in|check_out|guests``. Stays with no availability are
+    returned with an empty list.
+
+    Stays are first looked up in the ``availability`` cache, sharing entries
+    with :class:`Search`. The rest are answered by
+    :func:`~genesisng.pipeline.booking.search_many`, from the in-process
+    :class:`~genesisng.util.occupancy.OccupancyIndex` and
+    :class:`~genesisng.util.pricing.PriceCalendar` when both are enabled in
+    the configuration, with the same fallback as :class:`Search`, or else in
+    a single SQL statement that joins every stay laterally with the rates,
+    rooms and bookings. Their results are stored in the cache, even if empty.
+
+    Returns ``OK`` or ``BAD_REQUEST`` if any of the stays is not valid or
+    there are more stays than allowed by the configuration.
+
+    May receive a live session through the ``self.environ`` parameter, which is
+    to be reused in order to encapsulate the SQL sentences inside an active
+    transaction.
+    """
+
+    class SimpleIO(object):
+        input_required = (ListOfDicts('stays'),)
+        output_optional = (Dict('results'), Dict('error'))
+        skip_empty_keys = True
+
+    def handle(self):
+        """
+        Service handler.
+
+        :param stays: A list of dictionaries with the ``check_in`` and
+            ``check_out`` dates and the number of ``guests`` of every stay.
+        :type stays: list of dict
+
+        :returns: The same sub-set of :class:`~genesisng.schema.room.Room`
+            properties and pricing details returned by :class:`Search`, for
+            every stay.
+        :rtype: dict
+        """
+
+        conn = self.user_config.genesisng.database.connection
+        config = self.user_config.genesisng.availability
+        taxes_percentage = config.taxes_percentage
+        max_stays = int(config.batch_max_stays)
+
+        # Check stays, removing duplicates but keeping their order
+        stays = []
+        try:
+            for s in self.request.input.stays:
+                check_in = datetime.strptime(s['check_in'], '%Y-%m-%d').date()
+                check_out = datetime.strptime(s['check_out'],
+                                              '%Y-%m-%d').date()
+                guests = int(s['guests'])
+                if check_in >= check_out or guests < 1:
+                    raise ValueError
+                if (check_in, check_out, guests) not in stays:
+                    stays.append((check_in, check_out, guests))
+        except (KeyError, TypeError, ValueError):
+            msg = 'Every stay requires a check-in date at least 1 day ' \
+                'before its check-out date and at least 1 guest.'
+            stays = None
+        else:
+            msg = 'Between 1 and %d stays are allowed.' % max_stays
+
+        if not stays or len(stays) > max_stays:
+            self.response.status_code = BAD_REQUEST
+            self.environ.status_code = BAD_REQUEST
+            self.environ.error_msg = msg
+            self.response.payload = {'error': {'message': msg}}
+            return
+
+        # Take from the cache the stays already searched for
+        cache = self.cache.get_cache('builtin', 'availability')
+        results = {}
+        pending = []
+        for stay in stays:
+            label = '%s|%s|%s' % stay
+            value = cache.get(cache_key(*stay, rooms=[]))
+            if value is not None:
+                results[label] = value
+            else:
+                pending.append(stay)
+
+        if pending:
+            # Reuse the session if any has been provided
+            if self.environ.session:
+                session = self.environ.session
+            else:
+                session = self.outgoing.sql.get(conn).session()
+
+            # In memory or in a single SQL statement for all the stays
+            computed = pipeline.search_many(
+                session, config, pending, self.logger,
+                self.cache.get_cache('builtin', 'default'))
+
+            for stay, result in zip(pending, computed):
+                # Stays with no availability are cached as well, so that they
+                # are not searched for again until evicted
+                lod = [describe(r, taxes_percentage) for r in result]
+                key = cache_key(*stay, rooms=[])
+                cache.set(key, lod)
+                remember(key, stay[0], stay[1], [], lod)
+                results['%s|%s|%s' % stay] = lod
+
+            # Close the session only if we created a new one
+            if not self.environ.session:
+                session.close()
+
+        self.response.headers['Cache-Control'] = 'no-cache'
+        self.response.headers['Content-Language'] = 'en'
+        self.response.payload = {'results': results}
+        self.response.status_code = OK
+        self.environ.status_code = OK
+
+
+class Flexible(Service):
+    """
+    Service class to search for the cheapest stays of a number of nights
+    anywhere between two dates.
+
+    Channel ``/genesisng/availability/flexible``.
+
+    Uses `SimpleIO`_.
+
+    Every stay of the requested number of nights that starts on or after the
+    first date and ends on or before the last date is priced the same way as
+    in :class:`Search`, including the supplement of the room, and the
+    cheapest combinations of stay and room are returned first. Only stays
+    whose nights are all covered by a published rate are considered.
+
+    The window is slid over the in-process
+    :class:`~genesisng.util.occupancy.OccupancyIndex` and the prefix sums of
+    the :class:`~genesisng.util.pricing.PriceCalendar` when both are enabled
+    in the configuration, so that every start date costs a couple of lookups.
+    Otherwise, all start dates are searched for in a single SQL statement.
+
+    Returns ``OK`` if results have been found, ``NO_CONTENT`` if there is no
+    availability or ``BAD_REQUEST`` if the stay does not fit between the
+    dates or they are too far apart.
+    """
+
+    class SimpleIO(object):
+        input_required = (Date('date_from'), Date('date_to'),
+                          Integer('nights'), Integer('guests'))
+        output_optional = ('check_in', 'check_out', 'id', 'number', 'name',
+                           'sgl_beds', 'dbl_beds', 'accommodates', 'code',
+                           'nights', 'price', 'taxes_percentage',
+                           'taxes_value', 'total_price')
+        skip_empty_keys = True
+        output_repeated = True
+
+    def handle(self):
+        """
+        Service handler.
+
+        :param date_from: The first date the guests could arrive.
+        :type date_from: date
+        :param date_to: The last date the guests could leave.
+        :type date_to: date
+        :param nights: The number of nights of the stay.
+        :type nights: int
+        :param guests: The number of guests.
+        :type guests: int
+
+        :returns: The check-in and check-out dates of the stay, along with
+            the same sub-set of :class:`~genesisng.schema.room.Room`
+            properties and pricing details returned by :class:`Search`,
+            cheapest first.
+        :rtype: list of dict
+        """
+
+        conn = self.user_config.genesisng.database.connection
+        config = self.user_config.genesisng.availability
+        taxes_percentage = config.taxes_percentage
+        max_days = int(config.flexible_max_days)
+        max_results = int(config.flexible_max_results)
+        nights = self.request.input.nights
+        guests = self.request.input.guests
+
+        date_from = datetime.strptime(self.request.input.date_from,
+                                      '%Y-%m-%d').date()
+        date_to = datetime.strptime(self.request.input.date_to,
+                                    '%Y-%m-%d').date()
+
+        # Check dates
+        span = (date_to - date_from).days
+        if nights < 1 or nights > span or span > max_days:
+            self.response.status_code = BAD_REQUEST
+            self.environ.status_code = BAD_REQUEST
+            msg = 'The stay must fit between the dates, which cannot be ' \
+                'more than %d days apart.' % max_days
+            self.environ.error_msg = msg
+            self.response.payload = {'error': {'message': msg}}
+            return
+
+        # Every possible stay, by start date
+        stays = []
+        for i in range(span - nights + 1):
+            check_in = date_from + timedelta(days=i)
+            stays.append((check_in, check_in + timedelta(days=nights),
+                          guests))
+
+        session = self.outgoing.sql.get(conn).session()
+
+        # Slide the window over the in-memory index and calendar, if enabled,
+        # or else search for all the start dates in a single SQL statement
+        computed = pipeline.search_many(
+            session, config, stays, self.logger,
+            self.cache.get_cache('builtin', 'default'))
+
+        session.close()
+
+        # Cheapest stays first, then as sorted by the availability search
+        options = []
+        for (check_in, check_out, _), result in zip(stays, computed):
+            for r in result:
+                if r.nights == nights:
+                    options.append((r.supplement * r.nights + r.price,
+                                    len(options), check_in, check_out, r))
+        options = nsmallest(max_results, options)
+
+        if options:
+            lod = []
+            for _, _, check_in, check_out, r in options:
+                d = describe(r, taxes_percentage)
+                d['check_in'] = check_in.strftime('%Y-%m-%d')
+                d['check_out'] = check_out.strftime('%Y-%m-%d')
+                lod.append(d)
+
+            self.response.headers['Cache-Control'] = 'no-cache'
+            self.response.headers['Content-Language'] = 'en'
+            self.response.payload[:] = lod
+            self.response.status_code = OK
+            self.environ.status_code = OK
+        else:
+            self.response.status_code = NO_CONTENT
+            self.environ.status_code = NO_CONTENT
+            self.response.headers['Cache-Control'] = 'no-cache'
 
 
 class Confirm(Service):
@@ -248,18 +513,30 @@ class Confirm(Service):
     Publishes a message to the ``/genesisng/bookings`` topic name.
 
     Invalidates the affected portion of the ``availability`` cache collection,
-    if possible, or the whole collection otherwise.
+    i.e. the entries whose dates overlap those of the booking and had the
+    booked room available.
 
     Returns ``CREATED`` if the new reservation was successfully created and the
     associated client was successfully created or updated, ``BAD_REQUEST`` if
     an issue was found with the input parameters and ``CONFLICT`` if the
     reservation could not be made due to lack of availability.
 
-    Invokes the services :class:`~genesisng.services.guest.Upsert`,
+    The booking is inserted without checking availability beforehand. The
+    exclusion constraint on bookings rejects it if the room is already booked
+    for any of the nights, even by a concurrent request, and the whole
+    transaction is rolled back.
+
+    Runs the steps of the booking pipeline in
+    :mod:`genesisng.pipeline.booking` inside a single transaction, without
+    invoking other services. The read-only steps (extras, quote and room)
+    are run concurrently on separate connections if
+    ``confirm_concurrent_reads`` is enabled and psycopg2 waits for the
+    database cooperatively, and only the writes (guest and booking) in the
+    transaction. The same steps are used by
+    :class:`~genesisng.services.guest.Upsert`,
     :class:`~genesisng.services.booking.Create`,
-    :class:`~genesisng.services.availability.Extras`,
-    :class:`~genesisng.services.availability.Search` and
-    :class:`~genesisng.services.room.Get` to retrieve the required data.
+    :class:`~genesisng.services.extra.List`, :class:`Search` and
+    :class:`~genesisng.services.room.Get`.
     """
 
     class SimpleIO(object):
@@ -401,44 +678,59 @@ class Confirm(Service):
             self.response.payload = {'error': {'message': msg}}
             return
 
+        config = self.user_config.genesisng.availability
+
+        # Read-only steps, which do not depend on each other
+        def read_extras(session):
+            if not loe:
+                return []
+            cache = self.cache.get_cache('builtin', 'extras')
+            return pipeline.list_extras(session, cache)
+
+        def read_quote(session):
+            # Availability is not checked here but enforced by the exclusion
+            # constraint when inserting the booking.
+            return pipeline.quote(
+                session, config, check_in, check_out, p.guests, p.id_room,
+                self.logger, self.cache.get_cache('builtin', 'default'))
+
+        def read_room(session):
+            cache = self.cache.get_cache('builtin', 'rooms')
+            return pipeline.get_room(session, p.id_room, cache)
+
+        def reader(read):
+            def run():
+                with closing(self.outgoing.sql.get(conn).session()) as s:
+                    return read(s)
+            return run
+
+        reads = (read_extras, read_quote, read_room)
+
         with closing(self.outgoing.sql.get(conn).session()) as session:
 
-            # Environment variables to be passed when invoking other services
-            environ = Bunch(status_code=CONTINUE, session=session)
+            # Get the extras, pricing information and room information,
+            # either concurrently, each on a connection of its own, when
+            # psycopg2 waits for the database cooperatively, or else one
+            # after the other in the transaction.
+            if as_bool(config.confirm_concurrent_reads) and green.is_green():
+                all_extras, res, room = green.gather(*map(reader, reads))
+            else:
+                all_extras, res, room = [read(session) for read in reads]
 
             # Prepare extras to be saved by turning a list of integers into a
             # dictionary with code, name, description and price.
             extras = {'list': []}
             if loe:
-                input_data = {}
-                all_extras = self.invoke('extra.list', input_data,
-                                         environ=environ, as_bunch=True)
-                for extra in all_extras['response']:
-                    if extra.id in loe:
+                for extra in all_extras:
+                    if extra['id'] in loe:
                         extras['list'].append({
-                            'code': extra.code,
-                            'name': extra.name,
-                            'description': extra.description,
-                            'price': extra.price
+                            'code': extra['code'],
+                            'name': extra['name'],
+                            'description': extra['description'],
+                            'price': extra['price']
                         })
 
-            # Check for availability and get pricing information
-            environ.status_code = CONTINUE
-            input_data = {
-                'check_in': p.check_in,
-                'check_out': p.check_out,
-                'guests': p.guests,
-                'rooms': [p.id_room]
-            }
-            availability = self.invoke('availability.search', input_data,
-                                       environ=environ, as_bunch=True)
-            if environ.status_code == OK:
-                res = availability['response'][0]
-                price = res.price
-                taxes_percentage = res.taxes_percentage
-                taxes_value = res.taxes_value
-                total_price = res.total_price
-            else:
+            if not res:
                 self.response.status_code = CONFLICT
                 msg = 'There is no availability for the requested dates, number of guests and room.'
                 self.response.payload = {'error': {'message': msg}}
@@ -448,9 +740,9 @@ class Confirm(Service):
             # returned.
             result = {}
 
-            # Save the guest and add it to the result
-            environ.status_code = CONTINUE
-            input_data = {
+            # Save the guest and the booking, removing empty strings from the
+            # input data
+            guest_params = {
                 'name': p.name,
                 'surname': p.surname,
                 'gender': p.gender,
@@ -464,84 +756,85 @@ class Confirm(Service):
                 'province': p.province,
                 'country': p.country,
                 'home_phone': p.home_phone,
-                'mobile_phone': p.mobile_phone
+                'mobile_phone': p.mobile_phone,
+                'deleted': None
             }
-            # Remove empty strings from input data
-            for x in input_data:
-                if input_data[x] == '':
-                    del (input_data[x])
-            guest = self.invoke('guest.upsert', input_data, environ=environ,
-                                as_bunch=True)
-            if environ.status_code == OK:
-                result['guest'] = guest['response']
-            else:
+            guest_params = {k: v for k, v in guest_params.items() if v != ''}
+            try:
+                guest = pipeline.upsert_guest(session, guest_params)
+                booking_params = {
+                    'id_guest': guest['id'],
+                    'id_room': p.id_room,
+                    'guests': p.guests,
+                    'check_in': p.check_in,
+                    'check_out': p.check_out,
+                    'base_price': res['price'],
+                    'taxes_percentage': res['taxes_percentage'],
+                    'taxes_value': res['taxes_value'],
+                    'total_price': res['total_price'],
+                    'status': p.status,
+                    'meal_plan': p.meal_plan,
+                    'extras': extras,
+                    'uuid': uuid
+                }
+                booking_params = {k: v for k, v in booking_params.items()
+                                  if v != ''}
+                booking = pipeline.create_booking(session, booking_params)
+            except IntegrityError as e:
+                # The room has been booked for any of the nights, either
+                # before or concurrently, or the booking is a duplicate.
+                session.rollback()
+                self.response.headers['Cache-Control'] = 'no-cache'
                 self.response.status_code = CONFLICT
-                msg = 'Could not create guest.'
+                diag = getattr(e.orig, 'diag', None)
+                if getattr(diag, 'constraint_name', None) == \
+                        'booking_id_room_date_range':
+                    msg = 'There is no availability for the requested dates, number of guests and room.'
+                else:
+                    msg = 'Could not confirm availability for the given parameters'
                 self.response.payload = {'error': {'message': msg}}
                 return
 
-            # Save the booking and add it to the result
-            environ.status_code = CONTINUE
-            input_data = {
-                'id_guest': guest['response'].id,
-                'id_room': p.id_room,
-                'guests': p.guests,
-                'check_in': p.check_in,
-                'check_out': p.check_out,
-                'base_price': price,
-                'taxes_percentage': taxes_percentage,
-                'taxes_value': taxes_value,
-                'total_price': total_price,
-                'status': p.status,
-                'meal_plan': p.meal_plan,
-                'extras': extras,
-                'uuid': uuid
-            }
-            # Remove empty strings from input data
-            for x in input_data:
-                if input_data[x] == '':
-                    del (input_data[x])
-            booking = self.invoke('booking.create', input_data,
-                                  environ=environ, as_bunch=True)
-            if environ.status_code == CREATED:
-                result['booking'] = booking['response']
-
-            # Get room information and add it to the result
-            environ.status_code = CONTINUE
-            input_data = {'id': p.id_room}
-            room = self.invoke('room.get', input_data, environ=environ,
-                               as_bunch=True)
-            if environ.status_code == OK:
-                result['room'] = room['response']
+            result['guest'] = guest
+            result['booking'] = booking.asdict(exclude=['uuid'])
+
+            # Add room information to the result
+            if room:
+                result['room'] = room
 
             # Commit the transaction
             session.commit()
 
-            if result:
-
-                # Invalidate the availability cache.
-                # TODO: Invalidate the affected portion only (i.e. entries
-                # whose dates overlap for the same room id).
-                cache = self.cache.get_cache('builtin', 'availability')
-                if cache:
-                    self.logger.debug('Clearing availability cache')
-                    cache.clear()
-
-                # Publish a message to ``/genesisng/bookings/new`` topic name.
-                topic_name = '/genesisng/bookings/new'
-                data = 'id:%s' % booking['response'].id
-                priority = self.user_config.genesisng.availability.pubsub_priority
-                msg_id = self.pubsub.publish(topic_name, data=data,
-                                             priority=priority)
-                self.logger.info('Added message with id %s to topic %s for booking with id %s' % (msg_id, topic_name, booking['response'].id))
-
-                # Return the result
-                self.response.headers['Cache-Control'] = 'no-cache'
-                self.response.status_code = CREATED
-                self.response.payload = result
-                self.response.headers['Content-Language'] = 'en'
-            else:
-                self.response.headers['Cache-Control'] = 'no-cache'
-                self.response.status_code = CONFLICT
-                msg = 'Could not confirm availability for the given parameters'
-                self.response.payload = {'error': {'message': msg}}
+            # Save the guest and the booking in the cache
+            cache = self.cache.get_cache('builtin', 'guests')
+            cache.set(keys.record(guest['id']), guest)
+            forget_bookings(cache, guest['id'])
+            remember_booking(self.cache.get_cache('builtin', 'bookings'),
+                             self.cache.get_cache('builtin', 'locators'),
+                             booking.asdict())
+
+            # Update the occupancy index
+            occupancy.index.sync(
+                booking, self.cache.get_cache('builtin', 'default'))
+
+            # Invalidate the affected portion of the availability cache,
+            # i.e. entries whose dates overlap and had the room available.
+            cache = self.cache.get_cache('builtin', 'availability')
+            if cache:
+                evict(cache, check_in, check_out, p.id_room, booked=True,
+                      logger=self.logger,
+                      grace=stale_grace(self.user_config))
+
+            # Publish a message to ``/genesisng/bookings/new`` topic name.
+            topic_name = '/genesisng/bookings/new'
+            data = 'id:%s' % booking.id
+            priority = config.pubsub_priority
+            msg_id = self.pubsub.publish(topic_name, data=data,
+                                         priority=priority)
+            self.logger.info('Added message with id %s to topic %s for booking with id %s' % (msg_id, topic_name, booking.id))
+
+            # Return the result
+            self.response.headers['Cache-Control'] = 'no-cache'
+            self.response.status_code = CREATED
+            self.response.payload = result
+            self.response.headers['Content-Language'] = 'en'
@@ -2,7 +2,7 @@
 from contextlib import closing
 from http.client import OK, NO_CONTENT, BAD_REQUEST, CREATED, NOT_FOUND
 from http.client import CONFLICT, FORBIDDEN
-from sqlalchemy import and_, or_, func
+from sqlalchemy import and_
 from sqlalchemy.exc import IntegrityError
 from uuid import UUID
 from datetime import datetime
@@ -11,8 +11,17 @@ from zato.server.service import Service
 from zato.server.service import Integer, Float, Date, DateTime
 from zato.server.service import Dict, List, AsIs
 from genesisng.schema.booking import Booking, generate_pin
-from genesisng.util.config import parse_args
-from genesisng.util.filters import parse_filters
+from genesisng.pipeline import booking as pipeline
+from genesisng.util.cache import CacheWriter, forget_bookings
+from genesisng.util.cache import remember_booking, forget_booking
+from genesisng.util.cache import locate_booking, pin_digest
+from genesisng.util.config import parse_args, encode_after, as_bool
+from genesisng.util.prepared import lookup
+from genesisng.util.filters import parse_filters, bake_list
+from genesisng.util.count import count_rows
+from genesisng.util.export import export, resume_after, FORMATS
+from genesisng.util import occupancy, keys
+from genesisng.util.availability import evict, stale_grace
 
 
 class Get(Service):
@@ -61,11 +70,12 @@ class Get(Service):
         conn = self.user_config.genesisng.database.connection
         cache_control = self.user_config.genesisng.cache.default_cache_control
         id_ = self.request.input.id
+        prepared = as_bool(
+            self.user_config.genesisng.database.prepared_statements)
 
         # Check whether a copy exists in the cache
-        cache_key = 'id:%s' % id_
         cache = self.cache.get_cache('builtin', 'bookings')
-        cache_data = cache.get_by_prefix(cache_key, details=True, limit=1)
+        cache_data = cache.get(keys.record(id_), details=True)
         if cache_data:
             self.response.status_code = OK
             self.response.headers['Cache-Control'] = cache_control
@@ -77,15 +87,19 @@ class Get(Service):
 
         # Otherwise, retrieve the data
         with closing(self.outgoing.sql.get(conn).session()) as session:
-            result = session.query(Booking).\
-                filter(and_(Booking.id == id_, Booking.deleted.is_(None))).\
-                one_or_none()
+            if prepared:
+                result = lookup(session, Booking, 'get_booking', id_)
+            else:
+                result = session.query(Booking).\
+                    filter(and_(Booking.id == id_,
+                                Booking.deleted.is_(None))).\
+                    one_or_none()
 
             if result:
                 # Save the record in the cache
-                cache_key = 'id:%s|locator:%s' % (result.id, result.locator)
-                cache_data = cache.set(
-                    cache_key, result.asdict(), details=True)
+                cache_data = remember_booking(
+                    cache, self.cache.get_cache('builtin', 'locators'),
+                    result.asdict(), details=True)
 
                 # Set cache headers in response
                 if cache_data:
@@ -114,9 +128,10 @@ class Locate(Service):
 
     Uses `SimpleIO`_.
 
-    Stores the record in the ``bookings`` cache. Returns ``Cache-Control``,
-    ``Last-Modified`` and ``ETag`` headers. Returns a ``Content-Language``
-    header.
+    Stores the record in the ``bookings`` cache and its id by locator in the
+    ``locators`` cache, through which it is looked up. Returns
+    ``Cache-Control``, ``Last-Modified`` and ``ETag`` headers. Returns a
+    ``Content-Language`` header.
 
     Returns ``OK`` upon successful retrieval, or ``NOT_FOUND`` otherwise.
     """
@@ -152,11 +167,13 @@ class Locate(Service):
         conn = self.user_config.genesisng.database.connection
         cache_control = self.user_config.genesisng.cache.default_cache_control
         locator = self.request.input.locator.lower()
+        prepared = as_bool(
+            self.user_config.genesisng.database.prepared_statements)
 
         # Check whether a copy exists in the cache
-        cache_key = 'locator:%s' % locator
         cache = self.cache.get_cache('builtin', 'bookings')
-        cache_data = cache.get_by_suffix(cache_key, details=True, limit=1)
+        locators = self.cache.get_cache('builtin', 'locators')
+        cache_data = locate_booking(cache, locators, locator)
         if cache_data:
             self.response.status_code = OK
             self.response.headers['Cache-Control'] = cache_control
@@ -168,16 +185,18 @@ class Locate(Service):
 
         # Otherwise, retrieve the data
         with closing(self.outgoing.sql.get(conn).session()) as session:
-            result = session.query(Booking).\
-                filter(and_(Booking.locator == locator,
-                            Booking.deleted.is_(None))).\
-                one_or_none()
+            if prepared:
+                result = lookup(session, Booking, 'locate_booking', locator)
+            else:
+                result = session.query(Booking).\
+                    filter(and_(Booking.locator == locator,
+                                Booking.deleted.is_(None))).\
+                    one_or_none()
 
             if result:
                 # Save the record in the cache
-                cache_key = 'id:%s|locator:%s' % (result.id, result.locator)
-                cache_data = cache.set(
-                    cache_key, result.asdict(), details=True)
+                cache_data = remember_booking(
+                    cache, locators, result.asdict(), details=True)
 
                 # Set cache headers in response
                 if cache_data:
@@ -361,8 +380,6 @@ class Create(Service):
             if params[k] == '':
                 del(params[k])
 
-        result = Booking().fromdict(params)
-
         # Reuse the session if any has been provided
         if self.request.input.session:
             session = self.request.input.session
@@ -370,18 +387,32 @@ class Create(Service):
             session = self.outgoing.sql.get(conn).session()
 
         try:
-            session.add(result)
+            result = pipeline.create_booking(session, params)
 
-            # Flush if we are reusing the session, otherwise commit
-            if self.environ.session:
-                session.flush()
-            else:
+            # Commit only if the session was not provided
+            if not self.environ.session:
                 session.commit()
 
+            # Update the occupancy index
+            occupancy.index.sync(
+                result, self.cache.get_cache('builtin', 'default'))
+
+            # Invalidate the affected portion of the availability cache,
+            # unless the invoking service takes care of it.
+            if not self.environ.session:
+                evict(self.cache.get_cache('builtin', 'availability'),
+                      result.check_in, result.check_out, result.id_room,
+                      booked=True, logger=self.logger,
+                      grace=stale_grace(self.user_config))
+
+            # Forget the bookings of the guest
+            forget_bookings(self.cache.get_cache('builtin', 'guests'),
+                            result.id_guest)
+
             # Save the record in the cache
-            cache_key = 'id:%s|locator:%s' % (result.id, result.locator)
-            cache = self.cache.get_cache('builtin', 'bookings')
-            cache.set(cache_key, result.asdict())
+            remember_booking(self.cache.get_cache('builtin', 'bookings'),
+                             self.cache.get_cache('builtin', 'locators'),
+                             result.asdict())
 
             self.response.status_code = CREATED
             self.environ.status_code = CREATED
@@ -462,10 +493,24 @@ class Cancel(Service):
                 result.cancelled = datetime.utcnow()
                 session.commit()
 
+                # Update the occupancy index
+                occupancy.index.sync(
+                    result, self.cache.get_cache('builtin', 'default'))
+
+                # Invalidate the affected portion of the availability cache
+                evict(self.cache.get_cache('builtin', 'availability'),
+                      result.check_in, result.check_out, result.id_room,
+                      logger=self.logger,
+                      grace=stale_grace(self.user_config))
+
+                # Forget the bookings of the guest
+                forget_bookings(self.cache.get_cache('builtin', 'guests'),
+                                result.id_guest)
+
                 # Save the record in the cache
-                cache_key = 'id:%s|locator:%s' % (result.id, result.locator)
-                cache = self.cache.get_cache('builtin', 'bookings')
-                cache.set(cache_key, result.asdict())
+                remember_booking(self.cache.get_cache('builtin', 'bookings'),
+                                 self.cache.get_cache('builtin', 'locators'),
+                                 result.asdict())
 
                 # Return the result
                 self.response.status_code = OK
@@ -518,13 +563,25 @@ class Delete(Service):
                 # Set deleted field
                 result.deleted = datetime.utcnow()
                 session.commit()
+                occupancy.index.sync(
+                    result, self.cache.get_cache('builtin', 'default'))
                 self.response.status_code = NO_CONTENT
                 self.response.headers['Cache-Control'] = 'no-cache'
 
+                # Invalidate the affected portion of the availability cache
+                evict(self.cache.get_cache('builtin', 'availability'),
+                      result.check_in, result.check_out, result.id_room,
+                      logger=self.logger,
+                      grace=stale_grace(self.user_config))
+
+                # Forget the bookings of the guest
+                forget_bookings(self.cache.get_cache('builtin', 'guests'),
+                                result.id_guest)
+
                 # Invalidate the cache
-                cache_key = 'id:%s|locator:%s' % (result.id, result.locator)
-                cache = self.cache.get_cache('builtin', 'bookings')
-                cache.delete(cache_key)
+                forget_booking(self.cache.get_cache('builtin', 'bookings'),
+                               self.cache.get_cache('builtin', 'locators'),
+                               result.id, result.locator)
             else:
                 self.response.status_code = NOT_FOUND
                 self.response.headers['Cache-Control'] = 'no-cache'
@@ -631,6 +688,11 @@ class Update(Service):
                     filter(Booking.id == id_).one_or_none()
 
                 if result:
+                    # Keep the current stay to invalidate the availability
+                    # cache afterwards
+                    before = (result.id_room, result.check_in,
+                              result.check_out, result.id_guest)
+
                     # TODO: Implement a wrapper to remove empty request keys,
                     # or add request params to skip_empty_keys as per
                     # https://forum.zato.io/t/leave-the-simpleio-input-optional-out-of-the-input/593/22
@@ -668,12 +730,30 @@ class Update(Service):
                         result.extras = p.extras
                     session.commit()
 
+                    # Update the occupancy index
+                    occupancy.index.sync(
+                        result, self.cache.get_cache('builtin', 'default'))
+
+                    # Invalidate the affected portion of the availability
+                    # cache, for both the previous and the current stay
+                    cache = self.cache.get_cache('builtin', 'availability')
+                    evict(cache, before[1], before[2], before[0],
+                          logger=self.logger,
+                          grace=stale_grace(self.user_config))
+                    evict(cache, result.check_in, result.check_out,
+                          result.id_room, logger=self.logger,
+                          grace=stale_grace(self.user_config))
+
+                    # Forget the bookings of the previous and the current
+                    # guest
+                    forget_bookings(self.cache.get_cache('builtin', 'guests'),
+                                    *{before[3], result.id_guest})
+
                     # Save the record in the cache
-                    cache_key = 'id:%s|locator:%s' % (result.id,
-                                                      result.locator)
-                    cache = self.cache.get_cache('builtin', 'bookings')
-                    cache_data = cache.set(
-                        cache_key, result.asdict(), details=True)
+                    cache_data = remember_booking(
+                        self.cache.get_cache('builtin', 'bookings'),
+                        self.cache.get_cache('builtin', 'locators'),
+                        result.asdict(), details=True)
 
                     self.response.status_code = OK
                     self.response.payload = cache_data.value
@@ -748,10 +828,14 @@ class ChangePIN(Service):
                 result.pin = generate_pin()
                 session.commit()
 
+                # Forget the bookings of the guest
+                forget_bookings(self.cache.get_cache('builtin', 'guests'),
+                                result.id_guest)
+
                 # Save the record in the cache
-                cache_key = 'id:%s|locator:%s' % (result.id, result.locator)
-                cache = self.cache.get_cache('builtin', 'bookings')
-                cache.set(cache_key, result.asdict())
+                remember_booking(self.cache.get_cache('builtin', 'bookings'),
+                                 self.cache.get_cache('builtin', 'locators'),
+                                 result.asdict())
 
                 # Return the result
                 self.response.status_code = OK
@@ -772,10 +856,14 @@ class Validate(Service):
 
     Uses `SimpleIO`_.
 
-    Stores the record in the ``bookings`` cache, if found. Returns a
+    Stores the record in the ``bookings`` cache, if found, and its id and the
+    hash of its PIN by locator in the ``locators`` cache. Returns a
     ``Cache-Control`` header.  Returns a ``Content-Language`` header.
 
     Returns ``OK`` upon successful modification, or ``FORBIDDEN`` otherwise.
+
+    When the locator is not in the cache, the PIN is checked against the
+    covering index on locators before reading the whole booking.
     """
     class SimpleIO:
         input_required = ('locator')
@@ -809,12 +897,15 @@ class Validate(Service):
         conn = self.user_config.genesisng.database.connection
         locator = self.request.input.locator.lower()
         pin = self.request.input.pin
+        prepared = as_bool(
+            self.user_config.genesisng.database.prepared_statements)
 
         # Check whether a copy exists in the cache
-        cache_key = 'locator:%s' % locator
         cache = self.cache.get_cache('builtin', 'bookings')
-        cache_data = cache.get_by_suffix(cache_key, details=True)
-        if cache_data and cache_data.value.pin == pin:
+        locators = self.cache.get_cache('builtin', 'locators')
+        cache_data = locate_booking(cache, locators, locator, pin)
+        if cache_data and cache_data.value['pin'] == pin and \
+                not cache_data.value['cancelled']:
             self.response.status_code = OK
             self.response.payload = cache_data.value
             self.response.headers['Cache-Control'] = 'no-cache'
@@ -823,18 +914,38 @@ class Validate(Service):
 
         # Otherwise, retrieve the data
         with closing(self.outgoing.sql.get(conn).session()) as session:
-            result = session.query(Booking).\
-                filter(and_(Booking.locator == locator,
-                            Booking.pin == pin,
-                            Booking.deleted.is_(None),
-                            Booking.cancelled.is_(None))).\
-                one_or_none()
+            # Unless the locator is in the cache, check the PIN through the
+            # covering index on locators first, so that wrong PINs are
+            # rejected without reading the booking.
+            if not locators.get(keys.locator(locator)):
+                row = session.query(Booking.id, Booking.pin).\
+                    filter(and_(Booking.locator == locator,
+                                Booking.deleted.is_(None))).\
+                    one_or_none()
+                if row is not None:
+                    locators.set(keys.locator(locator), {
+                        'id': row.id, 'pin': pin_digest(row.pin)})
+                if row is None or row.pin != pin:
+                    self.response.status_code = FORBIDDEN
+                    self.response.headers['Cache-Control'] = 'no-cache'
+                    self.response.headers['Content-Language'] = 'en'
+                    return
+
+            if prepared:
+                result = lookup(session, Booking, 'validate_booking',
+                                locator, pin)
+            else:
+                result = session.query(Booking).\
+                    filter(and_(Booking.locator == locator,
+                                Booking.pin == pin,
+                                Booking.deleted.is_(None),
+                                Booking.cancelled.is_(None))).\
+                    one_or_none()
 
             if result:
                 # Save the record in the cache
-                cache_key = 'id:%s|locator:%s' % (result.id, result.locator)
-                cache_data = cache.set(
-                    cache_key, result.asdict(), details=True)
+                cache_data = remember_booking(
+                    cache, locators, result.asdict(), details=True)
 
                 # Return the result
                 self.response.status_code = OK
@@ -847,6 +958,121 @@ class Validate(Service):
                 self.response.headers['Content-Language'] = 'en'
 
 
+class Export(Service):
+    """
+    Service class to export the bookings in the system.
+
+    Channel ``/genesisng/bookings/export``.
+
+    Uses `SimpleIO`_.
+
+    Rows are fetched through a server-side cursor and converted to
+    newline-delimited JSON or CSV a chunk at a time, so that no more than a
+    chunk of rows is ever held by the driver and the ORM. Each response holds
+    up to ``max_chunks`` chunks. When there may be more rows to export, a
+    token is returned in the ``X-Genesis-After`` header, to be passed back
+    as the ``after`` parameter to export the next rows. The cache is not
+    used.
+
+    Returns ``OK`` and the exported rows, even if there are none.
+
+    Filtering is optional. Multiple filters are allowed but only one operator
+    for all the filters. Fields projection is allowed. Search is not allowed.
+    Rows are sorted by id.
+
+    In case of error, it does not return ``BAD_REQUEST`` but, instead, it
+    assumes the default parameter values and carries on.
+    """
+
+    # Fields allowed in filters or field projection.
+    allowed = Bunch({
+        'criteria': ('id',),
+        'filters': ('id', 'id_guest', 'id_room', 'reserved', 'guests',
+                    'check_in', 'check_out', 'base_price', 'total_price',
+                    'status', 'meal_plan', 'extras'),
+        'fields': ('id', 'id_guest', 'id_room', 'reserved', 'guests',
+                   'check_in', 'check_out', 'checked_in', 'checked_out',
+                   'cancelled', 'base_price', 'taxes_percentage',
+                   'taxes_value', 'total_price', 'locator', 'pin', 'status',
+                   'meal_plan', 'extras', 'uuid', 'deleted'),
+        'search': ()
+    })
+
+    class SimpleIO:
+        input_optional = (List('filters'), List('operator'), List('fields'),
+                          List('format'), List('after'))
+
+    def handle(self):
+        """
+        Service handler.
+
+        Query string parameters:
+
+        :param filters: A filter, as in the ``List`` service. Multiple
+            occurrences of this parameter are allowed.
+        :type filters: str
+        :param operator: The operator to join all filters, either ``and`` or
+            ``or``. The default value is ``and``.
+        :type operator: str
+        :param fields: Fields projection. A field name of the model class.
+            Multiple occurrences of this parameter are allowed.
+        :type fields: str
+        :param format: The output format, either ``ndjson`` or ``csv``. The
+            default value is ``ndjson``.
+        :type format: str
+        :param after: The token returned in the ``X-Genesis-After`` header
+            of the previous response, to export the rows that follow.
+        :type after: str
+
+        :returns: The selected attributes of a
+            :class:`~genesisng.schema.booking.Booking` model class, one row per
+            line.
+        :rtype: str
+        """
+
+        # Shortcut to the entity columns
+        cols = Booking.__table__.columns
+
+        # Database connection
+        conn = self.user_config.genesisng.database.connection
+
+        # Parse received arguments
+        params = parse_args(self.request.input, self.allowed,
+                            self.user_config.genesisng.pagination, self.logger)
+        try:
+            format_ = self.request.input.format[0].lower()
+        except (ValueError, KeyError, IndexError, AttributeError, TypeError):
+            format_ = 'ndjson'
+        if format_ not in FORMATS:
+            self.logger.info("Discarting format: %s" % format_)
+            format_ = 'ndjson'
+        fields = params.columns or list(self.allowed.fields)
+
+        # Compose query
+        with closing(self.outgoing.sql.get(conn).session()) as session:
+            query = session.query(*(cols[f] for f in fields),
+                                  cols['id'].label('after_id'))
+            query = parse_filters(params.filters, params.operator, cols, query)
+            after_id = resume_after(self.request.input)
+            if after_id is not None:
+                query = query.filter(cols['id'] > after_id)
+            query = query.order_by(cols['id'].asc())
+
+            config = self.user_config.genesisng.export
+            payload, last_id = export(query, fields, format_,
+                                      int(config.chunk_size),
+                                      int(config.max_chunks))
+
+        self.response.status_code = OK
+        self.response.payload = payload
+        self.response.content_type = FORMATS[format_]
+        self.response.headers['Cache-Control'] = 'no-cache'
+        self.response.headers['Content-Language'] = 'en'
+        if last_id is not None:
+            self.response.headers['X-Genesis-After'] = encode_after(
+                'id', 'asc', last_id, last_id)
+
+
 class List(Service):
     """
     Service class to get a list of all bookings in the system.
@@ -868,9 +1094,10 @@ class List(Service):
     In case of error, it does not return ``BAD_REQUEST`` but, instead, it
     assumes the default parameter values and carries on.
 
-    The total count of records (``X-Genesis-Count``), the page number
-    (``X-Genesis-Page``) and the page size (``X-Genesis-Size``) are returned as
-    headers. It does not return hybrid properties.
+    The page number (``X-Genesis-Page``) and the page size (``X-Genesis-Size``)
+    are returned as headers, as well as the total count of records
+    (``X-Genesis-Count``) if requested through the ``count`` parameter. It
+    does not return hybrid properties.
     """
 
     # Fields allowed in sorting criteria, filters, field projection or
@@ -890,7 +1117,8 @@ class List(Service):
 
     class SimpleIO:
         input_optional = (List('page'), List('size'), List('sort'),
-                          List('filters'), List('fields'), List('operator'))
+                          List('filters'), List('fields'), List('operator'),
+                          List('after'), List('count'))
         # Fields projection makes all output fields optional
         output_optional = ('id', 'id_guest', 'id_room', DateTime('reserved'),
                            'guests', Date('check_in'), Date('check_out'),
@@ -902,7 +1130,7 @@ class List(Service):
                            # UUID('uuid'),
                            # 'uuid' # JSON serializaction error
                            # https://forum.zato.io/t/returning-uuid-types-from-services-using-json/1735
-                           'nights', 'count')
+                           'nights')
         skip_empty_keys = True
         output_repeated = True
 
@@ -916,6 +1144,14 @@ class List(Service):
         :type page: int
         :param size: The page size. Default is located in the user config.
         :type size: int
+        :param after: The token returned in the ``X-Genesis-After`` header
+            of the previous page. Optional. When given, the page number is
+            ignored and the page starts right after the last row of the
+            previous one, which must have been sorted the same way.
+        :type after: str
+        :param count: Whether to return the total count of records in the
+            ``X-Genesis-Count`` header. Optional. Default is false.
+        :type count: bool
         :param sort: The sort criteria (field name) and direction (ascending
             ``asc`` or descending ``desc``), using the pipe ``|`` as separator
             (i.e. ``<criteria>|<direction>``. The default criteria is ``id``
@@ -958,33 +1194,21 @@ class List(Service):
                             self.user_config.genesisng.pagination, self.logger)
         # Compose query
         with closing(self.outgoing.sql.get(conn).session()) as session:
-            query = session.query(func.count().over().label('count'))
-            # Add columns to get a flat row of columns rather than entities
-            for f in self.allowed.fields:
-                query = query.add_columns(cols[f])
-
-            # Prepare filters
-            query = parse_filters(params.filters, params.operator, cols, query)
-
-            # Search: add ilike clauses if there is a search term.
-            if params.search:
-                clauses = []
-                for s in self.paging.search:
-                    clauses.append(cols[s].ilike(params.search))
-                query = query.filter(or_(*clauses))
-
-            # Order by
-            if params.direction == 'asc':
-                query = query.order_by(cols[params.criteria].asc())
-            else:
-                query = query.order_by(cols[params.criteria].desc())
-
-            # Add limit and offset
-            query = query.offset(params.offset)
-            query = query.limit(params.limit)
+            # Baked queries with the filters and the search term applied,
+            # sorted by the criteria and paginated
+            base, query, binds = bake_list(
+                [cols[f] for f in self.allowed.fields], cols, params,
+                self.allowed.search)
+
+            # Total count of records matching the filters, only if requested
+            if params.count:
+                total = count_rows(session, base(session).params(binds),
+                                   Booking.__table__, params,
+                                   self.user_config.genesisng.pagination,
+                                   self.cache.get_cache('builtin', 'bookings'))
 
             # Execute query
-            result = query.all()
+            result = query(session).params(binds).all()
 
             # Return now if no rows were returned
             if not result:
@@ -1000,26 +1224,34 @@ class List(Service):
                     "Could not get the 'bookings' cache collection.")
 
             # Get a list of the fields to be removed
-            diff = ['count']
+            diff = []
             if params.columns:
                 diff += list(set(result[0].keys()) - set(params.columns))
 
             # Empty list for the processed rows (dicts)
             payload = []
 
+            # Rows are stored in the cache all at once after the loop, along
+            # with their locators
+            writer = CacheWriter(cache, 'bookings', self.logger)
+            index = CacheWriter(self.cache.get_cache('builtin', 'locators'),
+                                'locators', self.logger)
+
             # Loop the result set
             for r in result:
-                # Store each row (a WritableKeyedTuple) in the cache.
-                if cache is not None:
-                    cache.set('id:%s|locator:%s' % (r.id, r.locator), r)
+                # Store each row (a WritableKeyedTuple) in the cache as a
+                # dict, as every other writer of the collection does
+                writer.set(keys.record(r.id), r._asdict())
+                index.set(keys.locator(r.locator),
+                          {'id': r.id, 'pin': pin_digest(r.pin)})
 
                 # Remove unwanted fields from the result
                 d = {key: getattr(r._elem, key)
                      for key in r._elem.keys() if key not in diff}
                 payload.append(d)
 
-            # Get the count from the last row
-            params.count = r.count
+            writer.flush()
+            index.flush()
 
             # Return the result set
             self.response.status_code = OK
@@ -1028,7 +1260,14 @@ class List(Service):
             self.response.headers['Content-Language'] = 'en'
             self.response.headers['X-Genesis-Page'] = str(params.page)
             self.response.headers['X-Genesis-Size'] = str(params.size)
-            self.response.headers['X-Genesis-Count'] = str(params.count)
+            if params.count:
+                self.response.headers['X-Genesis-Count'] = str(total)
+
+            # Token to seek the next page from the last row
+            if len(result) == params.limit:
+                self.response.headers['X-Genesis-After'] = encode_after(
+                    params.criteria, params.direction,
+                    getattr(r, params.criteria), r.id)
 
 
 class Restore(Service):
@@ -1087,10 +1326,24 @@ class Restore(Service):
                 result.deleted = None
                 session.commit()
 
+                # Update the occupancy index
+                occupancy.index.sync(
+                    result, self.cache.get_cache('builtin', 'default'))
+
+                # Invalidate the affected portion of the availability cache
+                evict(self.cache.get_cache('builtin', 'availability'),
+                      result.check_in, result.check_out, result.id_room,
+                      booked=True, logger=self.logger,
+                      grace=stale_grace(self.user_config))
+
+                # Forget the bookings of the guest
+                forget_bookings(self.cache.get_cache('builtin', 'guests'),
+                                result.id_guest)
+
                 # Save the record in the cache
-                cache_key = 'id:%s|locator:%s' % (result.id, result.locator)
-                cache = self.cache.get_cache('builtin', 'bookings')
-                cache.set(cache_key, result.asdict())
+                remember_booking(self.cache.get_cache('builtin', 'bookings'),
+                                 self.cache.get_cache('builtin', 'locators'),
+                                 result.asdict())
 
                 # Return the result
                 self.response.status_code = OK
@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
 from http.client import OK, NO_CONTENT
 from zato.server.service import Service
-from genesisng.schema.extra import Extra
+from genesisng.pipeline import booking as pipeline
+from genesisng.util import keys
 
 
 class List(Service):
@@ -54,7 +55,7 @@ class List(Service):
         cache_control = self.user_config.genesisng.cache.default_cache_control
 
         # Check whether a copy exists in the cache
-        cache_key = 'all'
+        cache_key = keys.ALL
         try:
             cache = self.cache.get_cache('builtin', 'extras')
         except Exception:
@@ -81,22 +82,16 @@ class List(Service):
         else:
             session = self.outgoing.sql.get(conn).session()
 
-        # Compose and execute query
-        query = session.query(Extra)
-        query = query.filter(Extra.deleted.is_(None))
-        query = query.order_by(Extra.id.asc())
-        result = query.all()
+        # Retrieve the extras as a list of dictionaries so that they can be
+        # stored in the cache.
+        payload = pipeline.list_extras(session)
 
-        if not result:
+        if not payload:
             self.response.status_code = NO_CONTENT
             # TODO: Check first whether self.environ exists?
             self.environ.status_code = NO_CONTENT
             self.response.headers['Cache-Control'] = 'no-cache'
-
-            # Transform the result (a list of objects) into a list of
-            # dictionaries so that they can be stored in the cache.
-            payload = [r.asdict() for r in result]
-
+        else:
             # Store the processed result set in the cache
             if cache is not None:
                 cache_data = cache.set(cache_key, payload, details=True)
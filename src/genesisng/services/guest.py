@@ -1,16 +1,26 @@
 # -*- coding: utf-8 -*-
+import csv
 from contextlib import closing
 from http.client import OK, NO_CONTENT, BAD_REQUEST, CREATED, CONFLICT
 from http.client import NOT_FOUND
-from sqlalchemy import or_, and_, func
+from sqlalchemy import or_, and_
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
 from datetime import datetime
 from bunch import Bunch
 from zato.server.service import Service, Dict, List
 from zato.server.service import Integer, Date, DateTime, ListOfDicts
 from genesisng.schema.guest import Guest
-from genesisng.util.config import parse_args
-from genesisng.util.filters import parse_filters
+from genesisng.schema.booking import Booking
+from genesisng.pipeline import booking as pipeline
+from genesisng.util.cache import CacheWriter, forget_bookings
+from genesisng.util.config import parse_args, encode_after, as_bool
+from genesisng.util.filters import parse_filters, bake_list
+from genesisng.util.count import count_rows
+from genesisng.util.export import export, resume_after, FORMATS
+from genesisng.util.bulk import parse_guests, stage_guests, merge_guests
+from genesisng.util.prepared import lookup
+from genesisng.util import keys
 
 
 class Get(Service):
@@ -50,9 +60,11 @@ class Get(Service):
         conn = self.user_config.genesisng.database.connection
         cache_control = self.user_config.genesisng.cache.default_cache_control
         id_ = self.request.input.id
+        prepared = as_bool(
+            self.user_config.genesisng.database.prepared_statements)
 
         # Check whether a copy exists in the cache
-        cache_key = 'id:%s' % id_
+        cache_key = keys.record(id_)
         cache = self.cache.get_cache('builtin', 'guests')
         cache_data = cache.get(cache_key, details=True)
         if cache_data:
@@ -64,9 +76,12 @@ class Get(Service):
             return
 
         with closing(self.outgoing.sql.get(conn).session()) as session:
-            result = session.query(Guest).\
-                filter(and_(Guest.id == id_, Guest.deleted.is_(None))).\
-                one_or_none()
+            if prepared:
+                result = lookup(session, Guest, 'get_guest', id_)
+            else:
+                result = session.query(Guest).\
+                    filter(and_(Guest.id == id_, Guest.deleted.is_(None))).\
+                    one_or_none()
 
             if not result:
                 self.response.status_code = NOT_FOUND
@@ -181,7 +196,7 @@ class Create(Service):
                 session.commit()
 
                 # Save the record in the cache
-                cache_key = 'id:%s' % result.id
+                cache_key = keys.record(result.id)
                 cache = self.cache.get_cache('builtin', 'guests')
                 result = result.asdict()
                 cache.set(cache_key, result)
@@ -248,9 +263,10 @@ class Delete(Service):
             self.response.headers['Cache-Control'] = 'no-cache'
 
             # Invalidate the cache
-            cache_key = 'id:%s' % id_
+            cache_key = keys.record(id_)
             cache = self.cache.get_cache('builtin', 'guests')
             cache.delete(cache_key)
+            forget_bookings(cache, id_)
 
 
 class Update(Service):
@@ -372,9 +388,10 @@ class Update(Service):
                 session.commit()
 
                 # Save the record in the cache
-                cache_key = 'id:%s' % result.id
+                cache_key = keys.record(result.id)
                 cache = self.cache.get_cache('builtin', 'guests')
                 cache.set(cache_key, result.asdict())
+                forget_bookings(cache, result.id)
 
                 self.response.status_code = OK
                 self.response.payload = result
@@ -395,7 +412,9 @@ class Upsert(Service):
 
     Uses `SimpleIO`_.
 
-    If there was an existing user but it was deleted, it is restored.
+    If there was an existing user but it was deleted, it is restored. The
+    guest is inserted or updated in a single ``INSERT .. ON CONFLICT (email)
+    DO UPDATE`` statement.
 
     Stores the record in the ``guests`` cache. Returns a ``Cache-Control``
     header.
@@ -489,9 +508,7 @@ class Upsert(Service):
         }
 
         # Remove empty strings from params
-        for x in params:
-            if params[x] == '':
-                del(params[x])
+        params = {k: v for k, v in params.items() if v != ''}
 
         # Reuse the session if any has been provided
         if self.environ.session:
@@ -499,37 +516,25 @@ class Upsert(Service):
         else:
             session = self.outgoing.sql.get(conn).session()
 
-        # INSERT .. ON CONFLICT DO UPDATE is not well supported by the
-        # current version of SQLAlchemy (1.3), so we do it manually.
-        result = session.query(Guest).\
-            filter(Guest.email == p.email).one_or_none()
-
         try:
-            if result:
-                # Update the record
-                result.fromdict(params)
-            else:
-                # Add a new record
-                result = Guest().fromdict(params)
-                session.add(result)
+            result = pipeline.upsert_guest(session, params)
 
-            # Flush if we are reusing the session, otherwise commit
-            if self.environ.session:
-                session.flush()
-            else:
+            # Commit only if the session was not provided
+            if not self.environ.session:
                 session.commit()
 
             # Save the record in the cache only if the session was new
-            cache_key = 'id:%s' % result.id
+            cache_key = keys.record(result['id'])
             cache = self.cache.get_cache('builtin', 'guests')
-            cache.set(cache_key, result.asdict())
+            cache.set(cache_key, result)
+            forget_bookings(cache, result['id'])
 
             # Return the result
             self.environ.status_code = OK
             self.response.status_code = OK
             self.response.payload = result
             url = self.user_config.genesisng.location.guests
-            self.response.headers['Location'] = url.format(id=result.id)
+            self.response.headers['Location'] = url.format(id=result['id'])
             self.response.headers['Cache-Control'] = 'no-cache'
 
         except IntegrityError:
@@ -546,6 +551,220 @@ class Upsert(Service):
             session.close()
 
 
+class Import(Service):
+    """
+    Service class to import a list of guests into the system.
+
+    Channel ``/genesisng/guests/import``.
+
+    Uses `SimpleIO`_.
+
+    The list is validated and copied into a temporary staging table in a
+    single ``COPY`` statement, then merged into the ``guest`` table in a
+    single ``INSERT .. ON CONFLICT (email) DO UPDATE`` statement. Guests
+    whose email address already exists are updated on the columns present in
+    the list and restored if they had been deleted. All rows are imported in
+    the same transaction.
+
+    Removes the updated guests from the ``guests`` cache collection.
+
+    Returns ``OK`` along with the number of inserted, updated and rejected
+    rows, and the reason of every rejection, or ``BAD_REQUEST`` if the header
+    of the list is not valid.
+    """
+
+    class SimpleIO:
+        input_required = ('data',)
+        output_optional = ('inserted', 'updated', 'rejected',
+                           List('errors'), Dict('error'))
+        skip_empty_keys = True
+
+    def handle(self):
+        """
+        Service handler.
+
+        :param data: The list of guests in CSV format, with a header line
+            naming the columns. Allowed columns are those of the
+            :class:`~genesisng.schema.guest.Guest` model class except
+            ``id`` and ``deleted``. Columns ``name``, ``surname`` and
+            ``email`` are required. Dates use the ``YYYY-MM-DD`` format.
+        :type data: str
+
+        :returns: The number of inserted, updated and rejected rows and a
+            list of errors, each made of the line number and the reason.
+        :rtype: dict
+        """
+
+        conn = self.user_config.genesisng.database.connection
+
+        try:
+            header, valid, rejected = parse_guests(self.request.input.data)
+        except (ValueError, csv.Error) as e:
+            self.response.status_code = BAD_REQUEST
+            self.environ.status_code = BAD_REQUEST
+            msg = str(e)
+            self.environ.error_msg = msg
+            self.response.payload = {'error': {'message': msg}}
+            return
+
+        inserted, updated = [], []
+        if valid:
+            with closing(self.outgoing.sql.get(conn).session()) as session:
+                stage_guests(session, valid.values())
+                inserted, updated = merge_guests(session, header)
+                session.commit()
+
+            # Forget the updated guests
+            try:
+                cache = self.cache.get_cache('builtin', 'guests')
+                for id_ in updated:
+                    try:
+                        cache.delete(keys.record(id_))
+                    except KeyError:
+                        pass
+                forget_bookings(cache, *updated)
+            except Exception:
+                self.logger.error(
+                    "Could not get the 'guests' cache collection.")
+
+        self.logger.info('Imported guests: %s inserted, %s updated, '
+                         '%s rejected' % (len(inserted), len(updated),
+                                          len(rejected)))
+
+        self.response.status_code = OK
+        self.response.payload = {
+            'inserted': len(inserted),
+            'updated': len(updated),
+            'rejected': len(rejected),
+            'errors': ['Line %s: %s' % r for r in rejected]
+        }
+        self.response.headers['Cache-Control'] = 'no-cache'
+
+
+class Export(Service):
+    """
+    Service class to export the guests in the system.
+
+    Channel ``/genesisng/guests/export``.
+
+    Uses `SimpleIO`_.
+
+    Rows are fetched through a server-side cursor and converted to
+    newline-delimited JSON or CSV a chunk at a time, so that no more than a
+    chunk of rows is ever held by the driver and the ORM. Each response holds
+    up to ``max_chunks`` chunks. When there may be more rows to export, a
+    token is returned in the ``X-Genesis-After`` header, to be passed back
+    as the ``after`` parameter to export the next rows. The cache is not
+    used.
+
+    Returns ``OK`` and the exported rows, even if there are none.
+
+    Filtering is optional. Multiple filters are allowed but only one operator
+    for all the filters. Fields projection is allowed. Search is optional and
+    the passed search term is case insensitive. Rows are sorted by id.
+
+    In case of error, it does not return ``BAD_REQUEST`` but, instead, it
+    assumes the default parameter values and carries on.
+    """
+
+    # Fields allowed in filters, field projection or searched in.
+    allowed = Bunch({
+        'criteria': ('id',),
+        'filters': ('id', 'name', 'surname', 'gender', 'email',
+                    'passport', 'birthdate', 'address1', 'address2',
+                    'locality', 'postcode', 'province', 'country',
+                    'home_phone', 'mobile_phone'),
+        'fields': ('id', 'name', 'surname', 'gender', 'email',
+                   'passport', 'birthdate', 'address1', 'address2',
+                   'locality', 'postcode', 'province', 'country',
+                   'home_phone', 'mobile_phone', 'deleted'),
+        'search': ('name', 'surname', 'email', 'passport', 'address1',
+                   'address2', 'locality', 'postcode', 'province',
+                   'country', 'home_phone', 'mobile_phone')
+    })
+
+    class SimpleIO:
+        input_optional = (List('filters'), List('operator'), List('fields'),
+                          List('search'), List('format'),
+                          List('after'))
+
+    def handle(self):
+        """
+        Service handler.
+
+        Query string parameters:
+
+        :param filters: A filter, as in the ``List`` service. Multiple
+            occurrences of this parameter are allowed.
+        :type filters: str
+        :param operator: The operator to join all filters, either ``and`` or
+            ``or``. The default value is ``and``.
+        :type operator: str
+        :param fields: Fields projection. A field name of the model class.
+            Multiple occurrences of this parameter are allowed.
+        :type fields: str
+        :param search: Search term (case insensitive).
+        :type search: str
+        :param format: The output format, either ``ndjson`` or ``csv``. The
+            default value is ``ndjson``.
+        :type format: str
+        :param after: The token returned in the ``X-Genesis-After`` header
+            of the previous response, to export the rows that follow.
+        :type after: str
+
+        :returns: The selected attributes of a
+            :class:`~genesisng.schema.guest.Guest` model class, one row per
+            line.
+        :rtype: str
+        """
+
+        # Shortcut to the entity columns
+        cols = Guest.__table__.columns
+
+        # Database connection
+        conn = self.user_config.genesisng.database.connection
+
+        # Parse received arguments
+        params = parse_args(self.request.input, self.allowed,
+                            self.user_config.genesisng.pagination, self.logger)
+        try:
+            format_ = self.request.input.format[0].lower()
+        except (ValueError, KeyError, IndexError, AttributeError, TypeError):
+            format_ = 'ndjson'
+        if format_ not in FORMATS:
+            self.logger.info("Discarting format: %s" % format_)
+            format_ = 'ndjson'
+        fields = params.columns or list(self.allowed.fields)
+
+        # Compose query
+        with closing(self.outgoing.sql.get(conn).session()) as session:
+            query = session.query(*(cols[f] for f in fields),
+                                  cols['id'].label('after_id'))
+            query = parse_filters(params.filters, params.operator, cols, query)
+            after_id = resume_after(self.request.input)
+            if after_id is not None:
+                query = query.filter(cols['id'] > after_id)
+            if params.search:
+                query = query.filter(or_(
+                    *(cols[s].ilike(params.search)
+                      for s in self.allowed.search)))
+            query = query.order_by(cols['id'].asc())
+
+            config = self.user_config.genesisng.export
+            payload, last_id = export(query, fields, format_,
+                                      int(config.chunk_size),
+                                      int(config.max_chunks))
+
+        self.response.status_code = OK
+        self.response.payload = payload
+        self.response.content_type = FORMATS[format_]
+        self.response.headers['Cache-Control'] = 'no-cache'
+        self.response.headers['Content-Language'] = 'en'
+        if last_id is not None:
+            self.response.headers['X-Genesis-After'] = encode_after(
+                'id', 'asc', last_id, last_id)
+
+
 class List(Service):
     """
     Service class to get a list of guests in the system.
@@ -568,9 +787,11 @@ class List(Service):
     In case of error, it does not return ``BAD_REQUEST`` but, instead, it
     assumes the default parameter values and carries on.
 
-    The total count of records (``X-Genesis-Count``), the page number
-    (``X-Genesis-Page``) and the page size (``X-Genesis-Size``) are returned as
-    headers.
+    The page number (``X-Genesis-Page``) and the page size (``X-Genesis-Size``)
+    are returned as headers, as well as the total count of records
+    (``X-Genesis-Count``) if requested through the ``count`` parameter. When
+    the page is full, an opaque token to get the next one is returned in the
+    ``X-Genesis-After`` header, to be passed back in the ``after`` parameter.
     """
 
     # Fields allowed in sorting criteria, filters, field projection or
@@ -595,7 +816,7 @@ class List(Service):
     class SimpleIO:
         input_optional = (List('page'), List('size'), List('sort'),
                           List('filters'), List('operator'), List('fields'),
-                          List('search'))
+                          List('search'), List('after'), List('count'))
         # Fields projection makes all output fields optional
         output_optional = ('id', 'name', 'surname', 'gender', 'email',
                            'passport', Date('birthdate'), 'address1',
@@ -615,6 +836,14 @@ class List(Service):
         :type page: int
         :param size: The page size. Default is located in the user config.
         :type size: int
+        :param after: The token returned in the ``X-Genesis-After`` header
+            of the previous page. Optional. When given, the page number is
+            ignored and the page starts right after the last row of the
+            previous one, which must have been sorted the same way.
+        :type after: str
+        :param count: Whether to return the total count of records in the
+            ``X-Genesis-Count`` header. Optional. Default is false.
+        :type count: bool
         :param sort: The sort criteria (field name) and direction (ascending
             ``asc`` or descending ``desc``), using the pipe ``|`` as separator
             (i.e. ``<criteria>|<direction>``. The default criteria is ``id``
@@ -660,33 +889,21 @@ class List(Service):
 
         # Compose query
         with closing(self.outgoing.sql.get(conn).session()) as session:
-            query = session.query(func.count().over().label('count'))
-            # Add columns to get a flat row of columns rather than entities
-            for f in self.allowed.fields:
-                query = query.add_columns(cols[f])
-
-            # Prepare filters
-            query = parse_filters(params.filters, params.operator, cols, query)
-
-            # Search: add ilike clauses if there is a search term.
-            if params.search:
-                clauses = []
-                for s in self.paging.search:
-                    clauses.append(cols[s].ilike(params.search))
-                query = query.filter(or_(*clauses))
-
-            # Order by
-            if params.direction == 'asc':
-                query = query.order_by(cols[params.criteria].asc())
-            else:
-                query = query.order_by(cols[params.criteria].desc())
-
-            # Add limit and offset
-            query = query.offset(params.offset)
-            query = query.limit(params.limit)
+            # Baked queries with the filters and the search term applied,
+            # sorted by the criteria and paginated
+            base, query, binds = bake_list(
+                [cols[f] for f in self.allowed.fields], cols, params,
+                self.allowed.search)
+
+            # Total count of records matching the filters, only if requested
+            if params.count:
+                total = count_rows(session, base(session).params(binds),
+                                   Guest.__table__, params,
+                                   self.user_config.genesisng.pagination,
+                                   self.cache.get_cache('builtin', 'guests'))
 
             # Execute query
-            result = query.all()
+            result = query(session).params(binds).all()
 
             # Return now if no rows were returned
             if not result:
@@ -702,26 +919,27 @@ class List(Service):
                     "Could not get the 'guests' cache collection.")
 
             # Get a list of the fields to be removed
-            diff = ['count']
+            diff = []
             if params.columns:
                 diff += list(set(result[0].keys()) - set(params.columns))
 
             # Empty list for the processed rows (dicts)
             payload = []
 
+            # Rows are stored in the cache all at once after the loop
+            writer = CacheWriter(cache, 'guests', self.logger)
+
             # Loop the result set
             for r in result:
                 # Store each row (a WritableKeyedTuple) in the cache.
-                if cache is not None:
-                    cache.set('id:%s' % r.id, r)
+                writer.set(keys.record(r.id), r)
 
                 # Remove unwanted fields from the result
                 d = {key: getattr(r._elem, key)
                      for key in r._elem.keys() if key not in diff}
                 payload.append(d)
 
-            # Get the count from the last row
-            params.count = r.count
+            writer.flush()
 
             self.response.status_code = OK
             self.response.payload[:] = payload
@@ -729,7 +947,14 @@ class List(Service):
             self.response.headers['Content-Language'] = 'en'
             self.response.headers['X-Genesis-Page'] = str(params.page)
             self.response.headers['X-Genesis-Size'] = str(params.size)
-            self.response.headers['X-Genesis-Count'] = str(params.count)
+            if params.count:
+                self.response.headers['X-Genesis-Count'] = str(total)
+
+            # Token to seek the next page from the last row
+            if len(result) == params.limit:
+                self.response.headers['X-Genesis-After'] = encode_after(
+                    params.criteria, params.direction,
+                    getattr(r, params.criteria), r.id)
 
 
 class Bookings(Service):
@@ -740,14 +965,18 @@ class Bookings(Service):
 
     Uses `SimpleIO`_.
 
-    Includes the guest details and the list of bookings and rooms.
+    Includes the guest details and the list of bookings and rooms, all of
+    them retrieved in a single query through the relationships between the
+    :class:`~genesisng.schema.guest.Guest`,
+    :class:`~genesisng.schema.booking.Booking` and
+    :class:`~genesisng.schema.room.Room` model classes.
+
+    If enabled in the configuration, stores the whole result in the
+    ``guests`` cache collection, from where it is removed every time the
+    guest or any of his/her bookings change.
 
     Returns ``OK`` if the guest was found, even if he/she had no bookings, or
     ``NOT_FOUND`` otherwise.
-
-    Invokes the services :class:`~genesisng.services.guest.Get`,
-    :class:`~genesisng.services.bookings.List` and
-    :class:`~genesisng.services.rooms.List` to retrieve the required data.
     """
 
     class SimpleIO:
@@ -767,80 +996,60 @@ class Bookings(Service):
         :type id: int
 
         :returns: All attributes of a :class:`~genesisng.schema.guest.Guest`
-            model class, including the hybrid properties. A list of dicts
-            under the ``booking`` key with all bookings, and a list of dicts
-            under the ``room`` key with all the rooms in such bookings, without
-            duplicates.
+            model class. A list of dicts under the ``bookings`` key with all
+            bookings, and a list of dicts under the ``rooms`` key with all
+            the rooms in such bookings, without duplicates, both sorted by id
+            and including the hybrid properties.
         :rtype: dict
         """
+
+        conn = self.user_config.genesisng.database.connection
+        config = self.user_config.genesisng.cache
         id_ = self.request.input.id
 
-        result = {}
+        # Check whether a copy exists in the cache
+        cache_key = keys.guest_bookings(id_)
+        cache = self.cache.get_cache('builtin', 'guests')
+        use_cache = as_bool(config.guest_bookings)
+        if use_cache:
+            result = cache.get(cache_key)
+            if result:
+                self.response.status_code = OK
+                self.response.payload = result
+                self.response.headers['Cache-Control'] = 'no-cache'
+                return
 
-        # Get guest data
-        input_data = {'id': id_}
-        guest = self.invoke('guest.get', input_data)
+        with closing(self.outgoing.sql.get(conn).session()) as session:
+            guest = session.query(Guest).\
+                options(joinedload(Guest.booking).joinedload(Booking.room)).\
+                filter(and_(Guest.id == id_, Guest.deleted.is_(None))).\
+                one_or_none()
 
-        if guest['response']:
-            # Add the guest to the result
-            result = guest['response']
+            if not guest:
+                self.response.status_code = NOT_FOUND
+                self.response.headers['Cache-Control'] = 'no-cache'
+                return
 
-            # Store the result in the cache
-            # Result is already a dict
-            cache = self.cache.get_cache('builtin', 'guests')
-            cache_key = 'id:%s' % guest['response']['id']
-            cache.set(cache_key, guest['response'])
-
-            # Get the list of bookings from the guest
-            result['bookings'] = []
-            input_data = {'filters': ['id_guest|eq|%s' % id_]}
-            bookings = self.invoke('booking.list', input_data)
-
-            room_ids = []
-            if bookings['response']:
-                cache = self.cache.get_cache('builtin', 'bookings')
-                for b in bookings['response']:
-
-                    # Add the booking to the result
-                    del b['count']
-                    result['bookings'].append(b)
-
-                    # Save the room id in the booking
-                    room_ids.append(b['id_room'])
-
-                    # Store booking in the cache
-                    # Result is already a dict
-                    cache_key = 'id:%s' % b['id']
-                    cache.set(cache_key, b)
-
-            # Get room data from the list of saved rooms
-            result['rooms'] = []
-            if room_ids:
-                input_data = {'operator': 'or', 'filters': []}
-                for i in room_ids:
-                    input_data['filters'].append('id|eq|%d' % i)
-                rooms = self.invoke('room.list', input_data)
-                if rooms['response']:
-                    cache = self.cache.get_cache('builtin', 'rooms')
-                    for r in rooms['response']:
-
-                        # Add the room to the result
-                        del r['count']
-                        result['rooms'].append(r)
-
-                        # Store room in the cache
-                        # Result is already a dict
-                        cache_key = 'id:%s' % r['id']
-                        cache.set(cache_key, r)
-
-        # Return the dictionary with guest, bookings and rooms
-        if result:
-            self.response.status_code = OK
-            self.response.payload = result
-            self.response.headers['Cache-Control'] = 'no-cache'
-        else:
-            self.response.status_code = NOT_FOUND
-            self.response.headers['Cache-Control'] = 'no-cache'
+            # Guest details, bookings and rooms, as dicts
+            result = guest.asdict()
+            bookings = sorted(guest.booking, key=lambda b: b.id)
+            result['bookings'] = [
+                b.asdict(exclude=['uuid'], include=['nights'])
+                for b in bookings]
+            rooms = {b.room.id: b.room for b in bookings if b.room}
+            result['rooms'] = [
+                rooms[r].asdict(include=['number', 'accommodates'])
+                for r in sorted(rooms)]
+
+        # Store the guest and the whole result in the cache
+        cache.set(keys.record(id_), guest.asdict())
+        if use_cache:
+            cache.set(cache_key, result,
+                      expiry=int(config.guest_bookings_expiry))
+
+        self.response.status_code = OK
+        self.response.payload = result
+        self.response.headers['Cache-Control'] = 'no-cache'
 
 
 class Restore(Service):
@@ -894,10 +1103,11 @@ class Restore(Service):
                 session.commit()
 
                 # Save the result in the cache, as dict
-                cache_key = 'id:%s' % id_
+                cache_key = keys.record(id_)
                 cache = self.cache.get_cache('builtin', 'guests')
                 result = result.asdict()
                 cache.set(cache_key, result)
+                forget_bookings(cache, id_)
 
                 self.response.status_code = OK
                 self.response.payload = result
@@ -1,15 +1,20 @@
 # -*- coding: utf-8 -*-
 from contextlib import closing
 from http.client import OK, NO_CONTENT, CREATED, NOT_FOUND, CONFLICT, FORBIDDEN
-from sqlalchemy import or_, and_, func
+from http.client import SERVICE_UNAVAILABLE
+from sqlalchemy import and_
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import undefer
-from passlib.hash import bcrypt
 from bunch import Bunch
 from zato.server.service import Service, Boolean, Integer, AsIs, List
 from genesisng.schema.login import Login
-from genesisng.util.config import parse_args
-from genesisng.util.filters import parse_filters
+from genesisng.util.cache import CacheWriter
+from genesisng.util.config import parse_args, encode_after, as_bool
+from genesisng.util.prepared import lookup
+from genesisng.util.passwords import verifier, verified, Overloaded
+from genesisng.util.filters import bake_list
+from genesisng.util.count import count_rows
+from genesisng.util import keys
 
 
 class Get(Service):
@@ -52,7 +57,7 @@ class Get(Service):
         id_ = self.request.input.id
 
         # Check whether a copy exists in the cache
-        cache_key = 'id:%s' % id_
+        cache_key = keys.record(id_)
         cache = self.cache.get_cache('builtin', 'logins')
         cache_data = cache.get(cache_key, details=True)
         if cache_data:
@@ -112,6 +117,14 @@ class Validate(Service):
     database cryptographic functions to verify the password or it verifies it
     inside the service. The former is faster but the clear-text passwords
     travels to the database.
+
+    When verified inside the service, the password is handed over to a pool
+    of ``security.verify_workers`` processes, unless set to 0. Returns
+    ``SERVICE_UNAVAILABLE``, and a ``Retry-After`` header, if more than
+    ``security.verify_queue`` verifications are already waiting for the pool
+    or this one takes longer than ``security.verify_timeout`` seconds.
+    Successful verifications are remembered in memory for
+    ``security.verified_expiry`` seconds, unless set to 0.
     """
 
     class SimpleIO:
@@ -138,6 +151,8 @@ class Validate(Service):
         vtype = self.user_config.genesisng.security.login_validation_type
         username = self.request.input.username
         password = self.request.input.password
+        prepared = as_bool(
+            self.user_config.genesisng.database.prepared_statements)
 
         with closing(self.outgoing.sql.get(conn).session()) as session:
 
@@ -151,16 +166,41 @@ class Validate(Service):
             else:
                 # Do not send the clear-text password to the database. Instead,
                 # verify it inside the service.
-                result = session.query(Login).options(undefer('_password')).\
-                    filter(Login.username == username).one_or_none()
-                if result:
-                    if not bcrypt.verify(password, result.password):
+                if prepared:
+                    result = lookup(session, Login, 'get_login', username,
+                                    options=[undefer('_password')])
+                else:
+                    result = session.query(Login).\
+                        options(undefer('_password')).\
+                        filter(Login.username == username).one_or_none()
+                security = self.user_config.genesisng.security
+                expiry = int(security.verified_expiry)
+                if result and not (expiry and verified.check(
+                        username, password, result.password)):
+                    try:
+                        valid = verifier.verify(
+                            password, result.password,
+                            workers=int(security.verify_workers),
+                            max_pending=int(security.verify_queue),
+                            timeout=float(security.verify_timeout))
+                    except Overloaded as e:
+                        self.logger.warning(
+                            'Could not validate credentials of %s: %s' %
+                            (username, e))
+                        self.response.status_code = SERVICE_UNAVAILABLE
+                        self.response.headers['Cache-Control'] = 'no-cache'
+                        self.response.headers['Retry-After'] = '1'
+                        return
+                    if not valid:
                         result = None
+                    elif expiry:
+                        verified.add(username, password, result.password,
+                                     expiry)
 
             if result:
 
                 # Save the record in the cache, minus the password
-                cache_key = 'id-%s' % result.id
+                cache_key = keys.record(result.id)
                 cache = self.cache.get_cache('builtin', 'logins')
                 result = result.asdict(exclude=['password'])
                 cache.set(cache_key, result)
@@ -237,7 +277,7 @@ class Create(Service):
                 session.commit()
 
                 # Save the record in the cache, minus the password
-                cache_key = 'id:%s' % result.id
+                cache_key = keys.record(result.id)
                 cache = self.cache.get_cache('builtin', 'logins')
                 cache.set(cache_key, result.asdict(exclude=['password']))
 
@@ -295,7 +335,7 @@ class Delete(Service):
                 self.response.headers['Cache-Control'] = 'no-cache'
 
                 # Invalidate the cache
-                cache_key = 'id:%s' % id_
+                cache_key = keys.record(id_)
                 cache = self.cache.get_cache('builtin', 'logins')
                 cache.delete(cache_key)
 
@@ -385,7 +425,7 @@ class Update(Service):
                     session.commit()
 
                     # Save the record in the cache, minus the password
-                    cache_key = 'id:%s' % result.id
+                    cache_key = keys.record(result.id)
                     cache = self.cache.get_cache('builtin', 'logins')
                     cache.set(cache_key, result.asdict())
 
@@ -429,9 +469,11 @@ class List(Service):
     In case of error, it does not return ``BAD_REQUEST`` but, instead, it
     assumes the default parameter values and carries on.
 
-    The total count of records (``X-Genesis-Count``), the page number
-    (``X-Genesis-Page``) and the page size (``X-Genesis-Size``) are returned as
-    headers.
+    The page number (``X-Genesis-Page``) and the page size (``X-Genesis-Size``)
+    are returned as headers, as well as the total count of records
+    (``X-Genesis-Count``) if requested through the ``count`` parameter. When
+    the page is full, an opaque token to get the next one is returned in the
+    ``X-Genesis-After`` header, to be passed back in the ``after`` parameter.
     """
 
     # Fields allowed in sorting criteria, filters, field projection or
@@ -446,9 +488,9 @@ class List(Service):
     class SimpleIO:
         input_optional = (List('page'), List('size'), List('sort'),
                           List('filters'), List('fields'), List('operator'),
-                          List('search'))
+                          List('search'), List('after'), List('count'))
         output_optional = ('id', 'username', 'name', 'surname', 'email',
-                           'is_admin', 'count')
+                           'is_admin')
         skip_empty_keys = True
         output_repeated = True
 
@@ -462,6 +504,14 @@ class List(Service):
         :type page: int
         :param size: The page size. Default is located in the user config.
         :type size: int
+        :param after: The token returned in the ``X-Genesis-After`` header
+            of the previous page. Optional. When given, the page number is
+            ignored and the page starts right after the last row of the
+            previous one, which must have been sorted the same way.
+        :type after: str
+        :param count: Whether to return the total count of records in the
+            ``X-Genesis-Count`` header. Optional. Default is false.
+        :type count: bool
         :param sort: The sort criteria (field name) and direction (ascending
             ``asc`` or descending ``desc``), using the pipe ``|`` as separator
             (i.e. ``<criteria>|<direction>``. The default criteria is ``id``
@@ -509,14 +559,14 @@ class List(Service):
                             self.user_config.genesisng.pagination, self.logger)
 
         # Check whether a copy exists in the cache
-        cache_key = 'page:%s|size:%s|criteria:%s|direction:%s|filters:%s|operator:%s|search:%s' % (
-            params.page, params.size, params.criteria, params.direction,
-            str(params.filters), params.operator, params.search)
+        cache_key = keys.page(params)
         try:
             cache = self.cache.get_cache('builtin', 'logins')
         except Exception:
             self.logger.error("Could not get the 'logins' cache collection.")
-        if cache is not None:
+        # Pages are not taken from the cache if the count is requested
+        cache_data = None
+        if cache is not None and not params.count:
             cache_data = cache.get(cache_key, details=True)
         if cache_data:
             self.logger.info("Returning list of logins from the cache.")
@@ -540,37 +590,32 @@ class List(Service):
             self.response.headers['Last-Modified'] = str(
                 cache_data.last_write_http)
             self.response.headers['ETag'] = str(cache_data.hash)
+
+            # Token to seek the next page from the last row
+            if len(cache_data.value) == params.limit:
+                last = cache_data.value[-1]
+                self.response.headers['X-Genesis-After'] = encode_after(
+                    params.criteria, params.direction,
+                    last[params.criteria], last['id'])
             return
 
         # Compose query
         with closing(self.outgoing.sql.get(conn).session()) as session:
-            query = session.query(func.count().over().label('count'))
-            # Add columns to get a flat row of columns rather than entities
-            for f in self.allowed.fields:
-                query = query.add_columns(cols[f])
-
-            # Prepare filters
-            query = parse_filters(params.filters, params.operator, cols, query)
-
-            # Search: add ilike clauses if there is a search term.
-            if params.search:
-                clauses = []
-                for s in self.paging.search:
-                    clauses.append(cols[s].ilike(params.search))
-                query = query.filter(or_(*clauses))
-
-            # Order by
-            if params.direction == 'asc':
-                query = query.order_by(cols[params.criteria].asc())
-            else:
-                query = query.order_by(cols[params.criteria].desc())
-
-            # Add limit and offset
-            query = query.offset(params.offset)
-            query = query.limit(params.limit)
+            # Baked queries with the filters and the search term applied,
+            # sorted by the criteria and paginated
+            base, query, binds = bake_list(
+                [cols[f] for f in self.allowed.fields], cols, params,
+                self.allowed.search)
+
+            # Total count of records matching the filters, only if requested
+            if params.count:
+                total = count_rows(session, base(session).params(binds),
+                                   Login.__table__, params,
+                                   self.user_config.genesisng.pagination,
+                                   cache)
 
             # Execute query
-            result = query.all()
+            result = query(session).params(binds).all()
 
             # Return now if no rows were returned
             if not result:
@@ -579,7 +624,7 @@ class List(Service):
                 return
 
             # Get a list of the fields to be removed
-            diff = ['count']
+            diff = []
             if params.columns:
                 diff += list(set(result[0].keys()) - set(params.columns))
 
@@ -589,6 +634,9 @@ class List(Service):
             # Empty list of dicts for the processed rows of the result set
             payload = []
 
+            # Rows are stored in the cache all at once after the loop
+            writer = CacheWriter(cache, 'logins', self.logger)
+
             # Loop the result set
             for r in result:
                 # Remove unwanted fields from the row
@@ -599,28 +647,33 @@ class List(Service):
                 # Convert each WritableKeyedTuple to a dict so that we store
                 # a list of dicts in the cache
                 d = {key: getattr(r._elem, key)
-                     for key in r._elem.keys() if key not in ['count']}
+                     for key in r._elem.keys()}
                 data.append(d)
 
                 # Store each full row (as a dict) in the cache.
                 # Passwords have already been excluded.
-                if cache is not None:
-                    cache.set('id:%s' % r.id, d)
+                writer.set(keys.record(r.id), d)
+
+            writer.flush()
 
             # Store the processed result set in the cache
             if cache is not None:
                 self.logger.info("Storing list of logins in the cache.")
                 cache_data = cache.set(cache_key, data, details=True)
 
-            # Get the count from the last row
-            params.count = r.count
-
             self.response.status_code = OK
             self.response.payload[:] = payload
             self.response.headers['Content-Language'] = 'en'
             self.response.headers['X-Genesis-Page'] = str(params.page)
             self.response.headers['X-Genesis-Size'] = str(params.size)
-            self.response.headers['X-Genesis-Count'] = str(params.count)
+            if params.count:
+                self.response.headers['X-Genesis-Count'] = str(total)
+
+            # Token to seek the next page from the last row
+            if len(result) == params.limit:
+                self.response.headers['X-Genesis-After'] = encode_after(
+                    params.criteria, params.direction,
+                    getattr(r, params.criteria), r.id)
 
             if cache_data:
                 self.response.headers['Cache-Control'] = cache_control
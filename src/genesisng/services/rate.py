@@ -2,12 +2,14 @@
 from contextlib import closing
 from http.client import OK, NO_CONTENT, CREATED, NOT_FOUND, CONFLICT
 from bunch import Bunch
-from sqlalchemy import and_, or_
+from sqlalchemy import and_
 from sqlalchemy.exc import IntegrityError
 from zato.server.service import Service, Integer, Float, Date, Boolean, List
 from genesisng.schema.rate import Rate
-from genesisng.util.config import parse_args
-from genesisng.util.filters import parse_filters
+from genesisng.util.config import parse_args, encode_after
+from genesisng.util.filters import bake_list
+from genesisng.util import pricing, keys
+from genesisng.util.availability import evict, stale_grace
 
 
 class Get(Service):
@@ -48,7 +50,7 @@ class Get(Service):
         id_ = self.request.input.id
 
         # Check whether a copy exists in the cache
-        cache_key = 'id-%s' % id_
+        cache_key = keys.record(id_)
         cache = self.cache.get_cache('builtin', 'rates')
         cache_data = cache.get(cache_key, details=True)
         if cache_data:
@@ -145,8 +147,17 @@ class Create(Service):
                 session.add(result)
                 session.commit()
 
+                # Update the price calendar
+                pricing.calendar.sync(
+                    result, self.cache.get_cache('builtin', 'default'))
+
+                # Invalidate the affected portion of the availability cache
+                evict(self.cache.get_cache('builtin', 'availability'),
+                      result.date_from, result.date_to, logger=self.logger,
+                      grace=stale_grace(self.user_config))
+
                 # Save the record in the cache
-                cache_key = 'id-%s' % result.id
+                cache_key = keys.record(result.id)
                 cache = self.cache.get_cache('builtin', 'rates')
                 result = result.asdict()
                 cache.set(cache_key, result)
@@ -199,15 +210,27 @@ class Delete(Service):
         id_ = self.request.input.id
 
         with closing(self.outgoing.sql.get(conn).session()) as session:
+            # Keep the dates to invalidate the availability cache afterwards
+            dates = session.query(Rate.date_from, Rate.date_to).\
+                filter(Rate.id == id_).one_or_none()
             deleted = session.query(Rate).filter(Rate.id == id_).delete()
             session.commit()
 
             if deleted:
+                # Update the price calendar
+                pricing.calendar.discard(
+                    id_, self.cache.get_cache('builtin', 'default'))
+
+                # Invalidate the affected portion of the availability cache
+                evict(self.cache.get_cache('builtin', 'availability'),
+                      dates.date_from, dates.date_to, logger=self.logger,
+                      grace=stale_grace(self.user_config))
+
                 self.response.status_code = NO_CONTENT
                 self.response.headers['Cache-Control'] = 'no-cache'
 
                 # Invalidate the cache
-                cache_key = 'id-%s' % id_
+                cache_key = keys.record(id_)
                 cache = self.cache.get_cache('builtin', 'rates')
                 cache.delete(cache_key)
 
@@ -276,6 +299,10 @@ class Update(Service):
                          one_or_none()
 
                 if result:
+                    # Keep the current dates to invalidate the availability
+                    # cache afterwards
+                    before = (result.date_from, result.date_to)
+
                     # TODO: Implement a wrapper to remove empty request keys,
                     # or add request params to skip_empty_keys as per
                     # https://forum.zato.io/t/leave-the-simpleio-input-optional-out-of-the-input/593/22
@@ -295,8 +322,21 @@ class Update(Service):
                         result.published = p.published
                     session.commit()
 
+                    # Update the price calendar
+                    pricing.calendar.sync(
+                        result, self.cache.get_cache('builtin', 'default'))
+
+                    # Invalidate the affected portion of the availability
+                    # cache, for both the previous and the current dates
+                    cache = self.cache.get_cache('builtin', 'availability')
+                    evict(cache, before[0], before[1], logger=self.logger,
+                          grace=stale_grace(self.user_config))
+                    evict(cache, result.date_from, result.date_to,
+                          logger=self.logger,
+                          grace=stale_grace(self.user_config))
+
                     # Save the record in the cache
-                    cache_key = 'id-%s' % result.id
+                    cache_key = keys.record(result.id)
                     cache = self.cache.get_cache('builtin', 'rates')
                     cache_data = cache.set(
                         cache_key, result.asdict(), details=True)
@@ -345,7 +385,9 @@ class List(Service):
     (``X-Genesis-Count``), as one is expected to always filter by seasons (i.e.
     years). This context also serves to demonstrate the difference between
     using the entity (i.e. :class:`~genesisng.schema.rate.Rate`) or the entity
-    columns in the query.
+    columns in the query. When the page is full, an opaque token to get the
+    next one is returned in the ``X-Genesis-After`` header, to be passed back
+    in the ``after`` parameter.
     """
 
     # Fields allowed in sorting criteria, filters, field projection or
@@ -359,7 +401,7 @@ class List(Service):
 
     class SimpleIO:
         input_optional = (List('page'), List('size'), List('sort'),
-                          List('filters'), List('operator'))
+                          List('filters'), List('operator'), List('after'))
         output_optional = ('id', Date('date_from'), Date('date_to'),
                            'base_price', 'bed_price', 'published', 'days')
         output_repeated = True
@@ -375,6 +417,11 @@ class List(Service):
         :type page: int
         :param size: The page size. Default is located in the user config.
         :type size: int
+        :param after: The token returned in the ``X-Genesis-After`` header
+            of the previous page. Optional. When given, the page number is
+            ignored and the page starts right after the last row of the
+            previous one, which must have been sorted the same way.
+        :type after: str
         :param sort: The sort criteria (field name) and direction (ascending
             ``asc`` or descending ``desc``), using the pipe ``|`` as separator
             (i.e. ``<criteria>|<direction>``. The default criteria is ``id``
@@ -412,30 +459,13 @@ class List(Service):
 
         # Compose query
         with closing(self.outgoing.sql.get(conn).session()) as session:
-            query = session.query(Rate)
-
-            # Prepare filters
-            query = parse_filters(params.filters, params.operator, cols, query)
-
-            # Search: add ilike clauses if there is a search term.
-            if params.search:
-                clauses = []
-                for s in self.paging.search:
-                    clauses.append(cols[s].ilike(params.search))
-                query = query.filter(or_(*clauses))
-
-            # Order by
-            if params.direction == 'asc':
-                query = query.order_by(cols[params.criteria].asc())
-            else:
-                query = query.order_by(cols[params.criteria].desc())
-
-            # Add limit and offset
-            query = query.offset(params.offset)
-            query = query.limit(params.limit)
+            # Baked queries with the filters and the search term applied,
+            # sorted by the criteria and paginated
+            base, query, binds = bake_list([Rate], cols, params,
+                                           self.allowed.search)
 
             # Execute query
-            result = query.all()
+            result = query(session).params(binds).all()
 
             # Return now if no rows were returned
             if not result:
@@ -454,7 +484,7 @@ class List(Service):
             for r in result:
                 # Store each row (a WritableKeyedTuple) in the cache as a dict
                 if cache is not None:
-                    cache.set('id:%s' % r.id, r._asdict())
+                    cache.set(keys.record(r.id), r._asdict())
 
             # Return the result set
             self.response.payload[:] = result
@@ -463,3 +493,9 @@ class List(Service):
             self.response.headers['Content-Language'] = 'en'
             self.response.headers['X-Genesis-Page'] = str(params.page)
             self.response.headers['X-Genesis-Size'] = str(params.size)
+
+            # Token to seek the next page from the last row
+            if len(result) == params.limit:
+                self.response.headers['X-Genesis-After'] = encode_after(
+                    params.criteria, params.direction,
+                    getattr(r, params.criteria), r.id)
@@ -7,8 +7,11 @@ from sqlalchemy import and_, or_
 from sqlalchemy.exc import IntegrityError
 from zato.server.service import Service, Integer, Float, List
 from genesisng.schema.room import Room
-from genesisng.util.config import parse_args
+from genesisng.pipeline import booking as pipeline
+from genesisng.util.cache import CacheWriter
+from genesisng.util.config import parse_args, as_bool
 from genesisng.util.filters import parse_filters
+from genesisng.util import keys
 
 
 class Get(Service):
@@ -50,9 +53,11 @@ class Get(Service):
         conn = self.user_config.genesisng.database.connection
         cache_control = self.user_config.genesisng.cache.default_cache_control
         id_ = self.request.input.id
+        prepared = as_bool(
+            self.user_config.genesisng.database.prepared_statements)
 
         # Check whether a copy exists in the cache
-        cache_key = 'id:%s' % id_
+        cache_key = keys.record(id_)
         cache = self.cache.get_cache('builtin', 'rooms')
         cache_data = cache.get(cache_key, details=True)
         if cache_data:
@@ -73,15 +78,12 @@ class Get(Service):
             session = self.outgoing.sql.get(conn).session()
 
         # Otherwise, retrieve the data
-        result = session.query(Room).\
-            filter(and_(Room.id == id_, Room.deleted.is_(None))).\
-            one_or_none()
+        result = pipeline.get_room(session, id_, prepared=prepared)
 
         if result:
 
             # Save the record in the cache
-            cache_data = cache.set(
-                cache_key, result.asdict(), details=True)
+            cache_data = cache.set(cache_key, result, details=True)
 
             # Set cache headers in response
             if cache_data:
@@ -174,7 +176,7 @@ class Create(Service):
                 session.commit()
 
                 # Save the record in the cache
-                cache_key = 'id:%s' % result.id
+                cache_key = keys.record(result.id)
                 cache = self.cache.get_cache('builtin', 'rooms')
                 result = result.asdict()
                 cache.set(cache_key, result)
@@ -238,7 +240,7 @@ class Delete(Service):
                 self.response.headers['Cache-Control'] = 'no-cache'
 
                 # Invalidate the cache
-                cache_key = 'id:%s' % id_
+                cache_key = keys.record(id_)
                 cache = self.cache.get_cache('builtin', 'rooms')
                 cache.delete(cache_key)
 
@@ -297,7 +299,7 @@ class Restore(Service):
                 session.commit()
 
                 # Save the result in the cache, as dict
-                cache_key = 'id:%s' % id_
+                cache_key = keys.record(id_)
                 cache = self.cache.get_cache('builtin', 'rooms')
                 result = result.asdict()
                 cache.set(cache_key, result)
@@ -396,7 +398,7 @@ class Update(Service):
                     session.commit()
 
                     # Save the record in the cache
-                    cache_key = 'id:%s' % result.id
+                    cache_key = keys.record(result.id)
                     cache = self.cache.get_cache('builtin', 'rooms')
                     cache_data = cache.set(
                         cache_key, result.asdict(), details=True)
@@ -475,7 +477,7 @@ class List(Service):
         cache_control = self.user_config.genesisng.cache.default_cache_control
 
         # Check whether a copy exists in the cache
-        cache_key = 'all'
+        cache_key = keys.ALL
         try:
             cache = self.cache.get_cache('builtin', 'rooms')
         except Exception:
@@ -509,6 +511,9 @@ class List(Service):
             # Empty list of dicts to be saved in the cache
             payload = []
 
+            # Rows are stored in the cache all at once after the loop
+            writer = CacheWriter(cache, 'rooms', self.logger)
+
             # Loop the result set
             for r in result:
                 # Convert each WritableKeyedTuple to a dict so that we store
@@ -517,8 +522,9 @@ class List(Service):
                 payload.append(d)
 
                 # Store each full row (as a dict) in the cache.
-                if cache is not None:
-                    cache.set('id:%s' % r.id, d)
+                writer.set(keys.record(r.id), d)
+
+            writer.flush()
 
             # Store the processed result set in the cache
             if cache is not None:
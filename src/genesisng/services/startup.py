@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from zato.server.service import Service
+from genesisng.util import green
+from genesisng.util.config import as_bool
+
+
+class Cooperative(Service):
+    """
+    Service class to make psycopg2 wait for the database cooperatively.
+
+    Startup service, run by every server process once it has started, as
+    listed in the ``startup_services_any_worker`` section of ``server.conf``.
+
+    Registers the gevent wait callback of psycopg2, if enabled through the
+    ``database.cooperative`` key of the configuration, once per process
+    rather than on every request.
+    """
+
+    def handle(self):
+        """
+        Service handler.
+        """
+
+        if as_bool(self.user_config.genesisng.database.cooperative):
+            green.patch(self.logger)
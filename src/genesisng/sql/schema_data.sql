@@ -1902,9 +1902,9 @@ INSERT INTO booking (id_guest, id_room, reserved, guests, check_in, check_out, c
             (5, 5, '2016-01-25 14:43:00', 3, '2017-06-08', '2017-06-18', NULL, NULL, NULL, 500, 10, 50, 550, '6E8NM0', generate_pin(), 'Confirmed', 'BedAndBreakfast', '{}'),
             (6, 1, '2016-01-25 14:43:00', 3, '2017-06-11', '2017-06-15', NULL, NULL, NULL, 500, 10, 50, 550, 'MRQNOO', generate_pin(), 'Confirmed', 'BedAndBreakfast', '{}'),
             (7, 2, '2016-01-25 14:43:00', 2, '2017-05-21', '2017-05-26', NULL, NULL, NULL, 500, 10, 50, 550, 'JAYT36', generate_pin(), 'Confirmed', 'BedAndBreakfast', '{}'),
-            (8, 3, '2016-01-25 14:43:00', 3, '2017-06-02', '2017-06-16', NULL, NULL, NULL, 500, 10, 50, 550, '4MWDBV', generate_pin(), 'Confirmed', 'BedAndBreakfast', '{}'),
+            (8, 3, '2016-01-25 14:43:00', 3, '2017-06-02', '2017-06-16', NULL, NULL, '2016-02-01 10:00:00', 500, 10, 50, 550, '4MWDBV', generate_pin(), 'Cancelled', 'BedAndBreakfast', '{}'),
             (9, 4, '2016-01-25 14:43:00', 3, '2017-06-11', '2017-06-21', NULL, NULL, NULL, 500, 10, 50, 550, 'JHLJXO', generate_pin(), 'Confirmed', 'BedAndBreakfast', '{}'),
-            (10, 5, '2016-01-25 14:43:00', 3, '2017-06-12', '2017-06-22', NULL, NULL, NULL, 500, 10, 50, 550, 'E7TVB9', generate_pin(), 'Confirmed', 'BedAndBreakfast', '{}'),
+            (10, 5, '2016-01-25 14:43:00', 3, '2017-06-12', '2017-06-22', NULL, NULL, '2016-02-01 10:00:00', 500, 10, 50, 550, 'E7TVB9', generate_pin(), 'Cancelled', 'BedAndBreakfast', '{}'),
             (11, 1, '2016-01-25 14:43:00', 1, '2017-06-01', '2017-06-07', NULL, NULL, NULL, 500, 10, 50, 550, 'PMLI4K', generate_pin(), 'Confirmed', 'BedAndBreakfast', '{}'),
             (12, 2, '2016-01-25 14:43:00', 3, '2017-06-21', '2017-06-29', NULL, NULL, NULL, 500, 10, 50, 550, '9GP26W', generate_pin(), 'Confirmed', 'BedAndBreakfast', '{}'),
             (13, 3, '2016-01-25 14:43:00', 3, '2017-06-19', '2017-06-29', NULL, NULL, NULL, 500, 10, 50, 550, 'D3M8HJ', generate_pin(), 'Confirmed', 'BedAndBreakfast', '{}'),
@@ -1917,17 +1917,17 @@ INSERT INTO booking (id_guest, id_room, reserved, guests, check_in, check_out, c
             (7, 5, '2016-01-25 14:43:00', 3, '2017-08-21', '2017-08-31', NULL, NULL, NULL, 500, 10, 50, 550, 'NQX04Y', generate_pin(), 'Confirmed', 'BedAndBreakfast', '{}'),
             (8, 1, '2016-01-25 14:43:00', 2, '2017-08-11', '2017-08-21', NULL, NULL, NULL, 500, 10, 50, 550, 'UK3LDY', generate_pin(), 'Confirmed', 'BedAndBreakfast', '{}'),
             (9, 2, '2016-01-25 14:43:00', 2, '2017-06-06', '2017-06-16', NULL, NULL, NULL, 500, 10, 50, 550, 'EYX2Q3', generate_pin(), 'Confirmed', 'BedAndBreakfast', '{}'),
-            (10, 3, '2016-01-25 14:43:00', 3, '2017-06-01', '2017-06-10', NULL, NULL, NULL, 500, 10, 50, 550, 'LHSRFC', generate_pin(), 'Confirmed', 'BedAndBreakfast', '{}'),
-            (11, 4, '2016-01-25 14:43:00', 1, '2017-06-01', '2017-06-03', NULL, NULL, NULL, 500, 10, 50, 550, '23Y6TO', generate_pin(), 'Confirmed', 'BedAndBreakfast', '{}'),
+            (10, 3, '2016-01-25 14:43:00', 3, '2017-06-01', '2017-06-10', NULL, NULL, '2016-02-01 10:00:00', 500, 10, 50, 550, 'LHSRFC', generate_pin(), 'Cancelled', 'BedAndBreakfast', '{}'),
+            (11, 4, '2016-01-25 14:43:00', 1, '2017-06-01', '2017-06-03', NULL, NULL, '2016-02-01 10:00:00', 500, 10, 50, 550, '23Y6TO', generate_pin(), 'Cancelled', 'BedAndBreakfast', '{}'),
             (12, 5, '2016-01-25 14:43:00', 3, '2017-05-05', '2017-05-15', NULL, NULL, NULL, 500, 10, 50, 550, '5J2H6I', generate_pin(), 'Confirmed', 'BedAndBreakfast', '{}'),
-            (13, 1, '2016-01-25 14:43:00', 3, '2017-05-09', '2017-06-19', NULL, NULL, NULL, 500, 10, 50, 550, 'WQAJHP', generate_pin(), 'Confirmed', 'BedAndBreakfast', '{}'),
+            (13, 1, '2016-01-25 14:43:00', 3, '2017-05-09', '2017-06-19', NULL, NULL, '2016-02-01 10:00:00', 500, 10, 50, 550, 'WQAJHP', generate_pin(), 'Cancelled', 'BedAndBreakfast', '{}'),
             (1, 2, '2016-01-25 14:43:00', 2, '2017-05-11', '2017-05-18', NULL, NULL, NULL, 500, 10, 50, 550, '4ZMD85', generate_pin(), 'Confirmed', 'BedAndBreakfast', '{}'),
             (2, 3, '2016-01-25 14:43:00', 2, '2017-05-23', '2017-05-28', NULL, NULL, NULL, 500, 10, 50, 550, 'XU0XPE', generate_pin(), 'Confirmed', 'BedAndBreakfast', '{}'),
             (3, 4, '2016-01-25 14:43:00', 2, '2017-07-14', '2017-07-28', NULL, NULL, NULL, 500, 10, 50, 550, '7B6207', generate_pin(), 'Confirmed', 'BedAndBreakfast', '{}'),
             (4, 5, '2016-01-25 14:43:00', 3, '2017-07-07', '2017-07-14', NULL, NULL, NULL, 500, 10, 50, 550, 'HAUI6Z', generate_pin(), 'Confirmed', 'BedAndBreakfast', '{}'),
             (5, 1, '2016-01-25 14:43:00', 2, '2017-07-01', '2017-07-11', NULL, NULL, NULL, 500, 10, 50, 550, '72Y2DE', generate_pin(), 'Confirmed', 'BedAndBreakfast', '{}'),
             (6, 2, '2016-01-25 14:43:00', 3, '2017-07-15', '2017-07-30', NULL, NULL, NULL, 500, 10, 50, 550, '8A5DFJ', generate_pin(), 'Confirmed', 'BedAndBreakfast', '{}'),
-            (7, 3, '2016-01-25 14:43:00', 2, '2017-06-01', '2017-06-08', NULL, NULL, NULL, 500, 10, 50, 550, '6I71JZ', generate_pin(), 'Confirmed', 'BedAndBreakfast', '{}'),
+            (7, 3, '2016-01-25 14:43:00', 2, '2017-06-01', '2017-06-08', NULL, NULL, '2016-02-01 10:00:00', 500, 10, 50, 550, '6I71JZ', generate_pin(), 'Cancelled', 'BedAndBreakfast', '{}'),
             (8, 4, '2016-01-25 14:43:00', 3, '2017-08-08', '2017-08-16', NULL, NULL, NULL, 500, 10, 50, 550, 'APEFOJ', generate_pin(), 'Confirmed', 'BedAndBreakfast', '{}');
 
 UPDATE booking SET extras = '{"list": [{"code": "Massage30", "name": "30 minutes massage", "description": "To help you relax or recover from physical exercise", "price": 30}]}' WHERE id_guest < 10;
@@ -1,6 +1,13 @@
 # coding: utf8
 from . import config
 from . import payload
+from . import occupancy
+from . import pricing
+from . import availability
+from . import count
+from . import cache
+from . import keys
 
 
-__all__ = ['config', 'payload']
+__all__ = ['config', 'payload', 'occupancy', 'pricing',
+           'availability', 'count', 'cache', 'keys']
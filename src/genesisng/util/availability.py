@@ -0,0 +1,423 @@
+# -*- coding: utf-8 -*-
+import re
+from collections import defaultdict
+from threading import RLock
+from datetime import datetime
+from time import time
+from heapq import nlargest
+from math import ceil
+from bunch import Bunch
+from genesisng.util import keys
+from genesisng.util.config import as_bool
+
+
+def cache_key(check_in, check_out, guests, rooms):
+    """
+    Builds the key of an entry in the ``availability`` cache collection.
+
+    Keys are canonical: the room ids are sorted and deduplicated, so that the
+    same search always maps to the same entry regardless of the order in which
+    rooms were requested.
+
+    :param check_in: The date the guests want to arrive.
+    :type check_in: date
+    :param check_out: The date the guests want to leave.
+    :type check_out: date
+    :param guests: The number of guests.
+    :type guests: int
+    :param rooms: A list of room ids used to filter the results.
+    :type rooms: list
+
+    :returns: The cache key.
+    :rtype: str
+    """
+
+    return 'check_in:%s|check_out:%s|guests:%s|rooms:%s' % (
+        check_in.strftime('%Y-%m-%d'), check_out.strftime('%Y-%m-%d'),
+        guests, ','.join(str(r) for r in sorted(set(rooms))))
+
+
+def parse_key(key):
+    """
+    Parses a key built by :func:`cache_key`.
+
+    :param key: The cache key.
+    :type key: str
+
+    :returns: The check-in date, the check-out date, the number of guests and
+        the list of room ids, or None if the key could not be parsed.
+    :rtype: tuple
+    """
+
+    try:
+        parts = dict(p.split(':', 1) for p in key.split('|'))
+        check_in = datetime.strptime(parts['check_in'], '%Y-%m-%d').date()
+        check_out = datetime.strptime(parts['check_out'], '%Y-%m-%d').date()
+        guests = int(parts['guests'])
+        rooms = [int(r) for r in re.findall(r'\d+', parts['rooms'])]
+    except (ValueError, KeyError):
+        return None
+    return check_in, check_out, guests, rooms
+
+
+class IntervalIndex(object):
+    """
+    Index of the entries of the ``availability`` cache collection by the
+    nights of the stay they were computed for.
+
+    Every entry is added to a bucket per night of its stay, so that finding
+    the entries that overlap a range of dates costs as many lookups as nights
+    in the range, no matter how many entries there are. Along with the dates,
+    the index keeps the rooms used to filter the search and the rooms that
+    were found available, which allows evicting only the entries affected by
+    a change on a given room.
+
+    Entries written by other server processes are not known to the index
+    until they are reconciled from the keys of the cache collection, which
+    encode the dates and the rooms filter but not the result.
+    """
+
+    def __init__(self, max_size=10000):
+        self._lock = RLock()
+        self._entries = {}
+        self._nights = defaultdict(set)
+        self.max_size = max_size
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, key, check_in, check_out, rooms, result=None):
+        """
+        Adds or replaces an entry in the index.
+
+        :param key: The cache key.
+        :type key: str
+        :param check_in: The check-in date of the search.
+        :type check_in: date
+        :param check_out: The check-out date of the search.
+        :type check_out: date
+        :param rooms: The room ids used to filter the search, if any.
+        :type rooms: list
+        :param result: The ids of the rooms found available, or None if
+            unknown.
+        :type result: set
+        """
+        with self._lock:
+            self.remove(key)
+            # Forget the oldest entries, which have most likely been expired
+            # from the cache collection already.
+            while len(self._entries) >= self.max_size:
+                self.remove(next(iter(self._entries)))
+            first = check_in.toordinal()
+            last = check_out.toordinal()
+            self._entries[key] = (first, last, frozenset(rooms),
+                                  frozenset(result) if result is not None
+                                  else None)
+            for night in range(first, last):
+                self._nights[night].add(key)
+
+    def remove(self, key):
+        """Removes an entry from the index, if found."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return
+            for night in range(entry[0], entry[1]):
+                bucket = self._nights.get(night)
+                if bucket is not None:
+                    bucket.discard(key)
+                    if not bucket:
+                        del self._nights[night]
+
+    def overlapping(self, check_in, check_out):
+        """
+        Returns the entries whose stay overlaps the given dates.
+
+        :returns: A dictionary with the cache key as key and a tuple of the
+            rooms filter and the result as value.
+        :rtype: dict
+        """
+        with self._lock:
+            keys = set()
+            for night in range(check_in.toordinal(), check_out.toordinal()):
+                keys.update(self._nights.get(night, ()))
+            return {k: self._entries[k][2:] for k in keys}
+
+    def reconcile(self, keys):
+        """Adds the keys of the cache collection that are not known to the
+        index yet, with an unknown result, and removes those no longer in
+        it."""
+        keys = set(keys)
+        with self._lock:
+            for key in set(self._entries) - keys:
+                self.remove(key)
+        for key in keys:
+            if key not in self:
+                parsed = parse_key(key)
+                if parsed:
+                    self.add(key, parsed[0], parsed[1], parsed[3])
+
+
+# Index shared by all services running in this process
+index = IntervalIndex()
+
+
+def count_search(cache, check_in, check_out, guests):
+    """
+    Counts a search, regardless of its rooms filter, in the ``searches``
+    cache collection, shared by all server processes.
+
+    :param cache: The ``searches`` cache collection.
+    :type cache: :class:`~zato.server.cache.Cache`
+    :param check_in: The date the guests want to arrive.
+    :type check_in: date
+    :param check_out: The date the guests want to leave.
+    :type check_out: date
+    :param guests: The number of guests.
+    :type guests: int
+    """
+
+    cache.incr(cache_key(check_in, check_out, guests, []))
+
+
+def most_searched(cache, n, start, end):
+    """
+    Returns the most frequent searches counted by :func:`count_search` with a
+    check-in date in a range.
+
+    Searches whose check-in date has passed are forgotten. The collection is
+    bounded to a maximum number of entries, so that the searches counted the
+    least recently are forgotten first once it is full.
+
+    :param cache: The ``searches`` cache collection.
+    :type cache: :class:`~zato.server.cache.Cache`
+    :param n: The maximum number of searches to return.
+    :type n: int
+    :param start: The first check-in date of the range.
+    :type start: date
+    :param end: The day after the last check-in date of the range.
+    :type end: date
+
+    :returns: Tuples of check-in date, check-out date and number of guests,
+        most frequent first.
+    :rtype: list
+    """
+
+    counts = []
+    for key in list(cache.keys()):
+        parsed = parse_key(key)
+        if parsed is None:
+            continue
+        if parsed[0] < start:
+            try:
+                cache.delete(key)
+            except KeyError:
+                # Expired in the meantime
+                pass
+            continue
+        value = cache.get(key)
+        if value and parsed[0] < end:
+            counts.append((value, parsed[:3]))
+    return [k for v, k in nlargest(n, counts, key=lambda c: c[0])]
+
+
+def compatible_keys(check_in, check_out, guests, rooms):
+    """
+    Returns the keys of the entries of the ``availability`` cache collection
+    that can answer a search, best match first.
+
+    Besides the exact entry, a search filtered by rooms can be answered by
+    the unfiltered search for the same dates and guests, or by any search
+    filtered by a superset of the requested rooms, by filtering its result.
+
+    :returns: A list of cache keys, starting with the exact one.
+    :rtype: list
+    """
+
+    key = cache_key(check_in, check_out, guests, rooms)
+    keys = [key]
+    if not rooms:
+        return keys
+
+    keys.append(cache_key(check_in, check_out, guests, []))
+    wanted = set(rooms)
+    overlapping = index.overlapping(check_in, check_out)
+    for k, (filter_, _) in overlapping.items():
+        if k not in keys and filter_ > wanted and \
+                parse_key(k)[:3] == (check_in, check_out, guests):
+            keys.append(k)
+    return keys
+
+
+def remember(key, check_in, check_out, rooms, payload):
+    """
+    Adds an entry just stored in the ``availability`` cache collection to the
+    index.
+
+    :param payload: The list of available rooms stored in the cache.
+    :type payload: list of dict
+    """
+
+    index.add(key, check_in, check_out, rooms, {r['id'] for r in payload})
+
+
+def evict(cache, check_in, check_out, id_room=None, booked=False,
+          logger=None, grace=0):
+    """
+    Evicts the entries of the ``availability`` cache collection affected by a
+    change on the given dates.
+
+    When a room has been booked, only the entries where such room was
+    available are evicted. When a room has been released (e.g. a booking has
+    been cancelled), all entries whose rooms filter allows it are evicted, as
+    it may now be available. When no room is given (e.g. a rate has changed),
+    all entries overlapping the dates are evicted.
+
+    Evicted entries may be kept for a while under a stale key, along with the
+    time of their eviction, to be served by
+    :class:`~genesisng.services.availability.Search` while it refreshes them
+    for no longer than the grace period, as reading them extends their expiry
+    in the cache collection.
+
+    :param cache: The ``availability`` cache collection.
+    :type cache: :class:`~zato.server.cache.Cache`
+    :param check_in: The first night affected by the change.
+    :type check_in: date
+    :param check_out: The day after the last night affected by the change.
+    :type check_out: date
+    :param id_room: The id of the affected room, if any.
+    :type id_room: int
+    :param booked: Whether the room has been booked or released.
+    :type booked: bool
+    :param grace: The number of seconds to keep a stale copy of the evicted
+        entries for, or 0 not to keep it.
+    :type grace: int
+
+    :returns: The number of evicted entries.
+    :rtype: int
+    """
+
+    # Learn about the entries written by other server processes. Should the
+    # collection not be iterable, evict at least the entries known to this
+    # process, whatever room they are about.
+    conservative = False
+    try:
+        index.reconcile(list(cache.keys()))
+    except Exception:
+        if logger:
+            logger.exception('Could not reconcile the availability index.')
+        conservative = True
+
+    evicted = 0
+    overlapping = index.overlapping(check_in, check_out)
+    for key, (rooms, _) in overlapping.items():
+        if id_room is not None and not conservative:
+            if rooms and id_room not in rooms:
+                continue
+        value = cache.get(key)
+        if value is None:
+            # Already expired from the cache collection
+            index.remove(key)
+            continue
+        # The result known to the index may be outdated, so tell from the
+        # cached value whether the booked room was available in it
+        if booked and not conservative and \
+                id_room not in {r['id'] for r in value}:
+            continue
+        try:
+            if grace:
+                cache.set(keys.stale(key), {'evicted': time(), 'value': value},
+                          expiry=grace)
+            cache.delete(key)
+            evicted += 1
+        except KeyError:
+            # Expired in the meantime
+            pass
+        index.remove(key)
+
+    if logger:
+        logger.debug('Evicted %s availability entries for %s-%s' % (
+            evicted, check_in, check_out))
+    return evicted
+
+
+def stale_grace(user_config) -> int:
+    """
+    Returns the number of seconds a stale copy of the evicted entries of the
+    ``availability`` cache collection is kept for, or 0 if stale entries are
+    not to be served.
+
+    :param user_config: The user configuration of the calling service.
+    :type user_config: Bunch dict
+
+    :rtype: int
+    """
+
+    config = user_config.genesisng.availability
+    if not as_bool(config.stale_while_revalidate):
+        return 0
+    return int(config.stale_grace)
+
+
+def rank(rooms, busy, guests, nights, price):
+    """
+    Prices the rooms that are available for a stay and sorts them the same
+    way the availability search does.
+
+    :param rooms: The rooms that have not been deleted, with the properties
+        returned by the availability search plus the supplement.
+    :type rooms: list
+    :param busy: The ids of the rooms booked on any night of the stay.
+    :type busy: set
+    :param guests: The number of guests.
+    :type guests: int
+    :param nights: The number of nights covered by a rate.
+    :type nights: int
+    :param price: The price of the stay, not including the supplement.
+    :type price: float
+
+    :returns: The available rooms along with the nights and the price.
+    :rtype: list of :class:`~bunch.Bunch`
+    """
+
+    if not nights:
+        return []
+    result = [Bunch(r._asdict(), nights=nights, price=price) for r in rooms
+              if r.id not in busy and r.accommodates >= guests]
+    result.sort(key=lambda r: (
+        r.supplement * r.nights + r.price, r.accommodates, r.sgl_beds,
+        r.dbl_beds, r.floor_no, r.room_no))
+    return result
+
+
+def describe(r, taxes_percentage):
+    """
+    Returns the payload of an available room, including taxes.
+
+    :param r: An available room, as returned by the availability search.
+    :param taxes_percentage: The percentage of taxes applied to the price.
+    :type taxes_percentage: float
+
+    :rtype: dict
+    """
+
+    # To prevent missing decimals, taxes amount is rounded down/up using
+    # math.ceil()
+    taxes_value = ceil(r.price * taxes_percentage / 100)
+    return {
+        'id': r.id,
+        'number': r.number,
+        'name': r.name,
+        'sgl_beds': r.sgl_beds,
+        'dbl_beds': r.dbl_beds,
+        'accommodates': r.accommodates,
+        'code': r.code,
+        'nights': r.nights,
+        'price': r.price,
+        'taxes_percentage': taxes_percentage,
+        'taxes_value': taxes_value,
+        'total_price': r.price + taxes_value
+    }
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+import csv
+from datetime import datetime
+from io import StringIO
+from psycopg2.extras import execute_values
+from sqlalchemy import text
+from genesisng.schema.guest import Guest, Gender
+from genesisng.util.green import is_green
+
+# Columns of a guest that can be imported
+GUEST_COLUMNS = ('name', 'surname', 'gender', 'email', 'passport',
+                 'birthdate', 'address1', 'address2', 'locality', 'postcode',
+                 'province', 'country', 'home_phone', 'mobile_phone')
+
+# Columns that must be present and not empty in every imported guest
+GUEST_REQUIRED = ('name', 'surname', 'email')
+
+
+def parse_guests(data):
+    """
+    Parses and validates a list of guests in CSV format, with a header line
+    naming the columns.
+
+    When the same email address is found more than once, only the last
+    occurrence is kept and the rest are rejected.
+
+    :param data: The contents of the file.
+    :type data: str
+
+    :returns: The columns found in the header, a dictionary of valid rows
+        (tuples of line number and values of all columns in
+        :data:`GUEST_COLUMNS`) by email address and a list of rejected
+        rows (tuples of line number and reason).
+    :rtype: tuple
+
+    :raises: ValueError if the header is missing, has unknown columns or
+        lacks required ones.
+    """
+
+    reader = csv.DictReader(StringIO(data))
+    header = [f.strip() for f in (reader.fieldnames or [])]
+    unknown = set(header) - set(GUEST_COLUMNS)
+    if unknown:
+        raise ValueError('Unknown columns: %s' % ', '.join(sorted(unknown)))
+    missing = set(GUEST_REQUIRED) - set(header)
+    if missing:
+        raise ValueError('Missing columns: %s' % ', '.join(sorted(missing)))
+    reader.fieldnames = header
+
+    cols = Guest.__table__.columns
+    valid = {}
+    rejected = []
+    for r in reader:
+        line = reader.line_num
+        values = {k: (v or '').strip() for k, v in r.items() if k in header}
+        reason = None
+        for c in GUEST_REQUIRED:
+            if not values[c]:
+                reason = 'Empty %s' % c
+                break
+        if reason is None:
+            for c, v in values.items():
+                length = getattr(cols[c].type, 'length', None)
+                if length and len(v) > length:
+                    reason = 'Too long %s' % c
+                    break
+        if reason is None and values.get('gender') and \
+                values['gender'] not in Gender.__members__:
+            reason = 'Wrong gender'
+        if reason is None and values.get('birthdate'):
+            try:
+                datetime.strptime(values['birthdate'], '%Y-%m-%d')
+            except ValueError:
+                reason = 'Wrong birthdate format'
+        if reason is not None:
+            rejected.append((line, reason))
+            continue
+
+        email = values['email']
+        if email in valid:
+            rejected.append((valid[email][0],
+                             'Duplicated email, see line %s' % line))
+        valid[email] = (line, tuple(values.get(c) or None
+                                    for c in GUEST_COLUMNS))
+
+    rejected.sort()
+    return header, valid, rejected
+
+
+def stage_guests(session, rows):
+    """
+    Creates a temporary staging table, dropped on commit, and copies the
+    given rows into it in a single ``COPY`` statement, or in multi-row
+    ``INSERT`` statements if psycopg2 waits for the database cooperatively.
+
+    :param session: A live session (transaction).
+    :type session: :class:`~sqlalchemy.orm.session.Session`
+    :param rows: Tuples of line number and values of all columns in
+        :data:`GUEST_COLUMNS`, as returned by :func:`parse_guests`.
+    :type rows: list
+    """
+
+    cols = Guest.__table__.columns
+    dialect = session.bind.dialect
+    session.execute(
+        'CREATE TEMPORARY TABLE guest_import (line INTEGER NOT NULL, %s) '
+        'ON COMMIT DROP' % ', '.join(
+            '%s %s' % (c, cols[c].type.compile(dialect=dialect))
+            for c in GUEST_COLUMNS))
+
+    columns = ', '.join(GUEST_COLUMNS)
+    cursor = session.connection().connection.cursor()
+    try:
+        if is_green():
+            # COPY is not supported when waiting for the database
+            # cooperatively, so insert the rows in pages instead
+            execute_values(
+                cursor,
+                'INSERT INTO guest_import (line, %s) VALUES %%s' % columns,
+                [(line,) + tuple(values) for line, values in rows],
+                page_size=1000)
+        else:
+            buf = StringIO()
+            writer = csv.writer(buf)
+            for line, values in rows:
+                writer.writerow((line,) + tuple('' if v is None else v
+                                                for v in values))
+            buf.seek(0)
+
+            # Unquoted empty values are copied as NULL
+            cursor.copy_expert(
+                'COPY guest_import (line, %s) FROM STDIN WITH (FORMAT csv)' %
+                columns, buf)
+    finally:
+        cursor.close()
+
+
+def merge_guests(session, header):
+    """
+    Merges the rows of the staging table into the ``guest`` table in a
+    single ``INSERT .. ON CONFLICT (email) DO UPDATE`` statement.
+
+    New guests are only given the columns present in the imported file and
+    those with a default value in the model, which is used when the imported
+    value is empty or missing, as the database knows nothing about them.
+    Existing guests are only updated on the columns present in the imported
+    file and restored if they had been deleted.
+
+    :param session: A live session (transaction).
+    :type session: :class:`~sqlalchemy.orm.session.Session`
+    :param header: The columns found in the imported file.
+    :type header: list
+
+    :returns: The ids of the inserted guests and the ids of the updated
+        guests.
+    :rtype: tuple
+    """
+
+    cols = Guest.__table__.columns
+    columns, values, defaults = [], [], {}
+    for c in GUEST_COLUMNS:
+        default = cols[c].default
+        if default is not None and default.is_scalar and \
+                default.arg is not None:
+            defaults[c] = default.arg
+            values.append('COALESCE(%s, :%s)' % (c, c))
+        elif c in header:
+            values.append(c)
+        else:
+            continue
+        columns.append(c)
+
+    updates = [c for c in GUEST_COLUMNS if c in header and c != 'email']
+    statement = text("""
+        INSERT INTO guest (%(columns)s)
+        SELECT %(values)s
+          FROM guest_import
+         ORDER BY line
+            ON CONFLICT (email) DO UPDATE
+           SET %(updates)s
+     RETURNING id, xmax = 0 AS inserted
+    """ % {
+        'columns': ', '.join(columns),
+        'values': ', '.join(values),
+        'updates': ', '.join(['%s = EXCLUDED.%s' % (c, c) for c in updates] +
+                             ['deleted = NULL'])
+    })
+
+    inserted, updated = [], []
+    for r in session.execute(statement, defaults):
+        (inserted if r.inserted else updated).append(r.id)
+    return inserted, updated
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+import hmac
+import json
+from collections import OrderedDict
+from hashlib import md5, sha256
+from threading import RLock
+from time import monotonic
+from genesisng.util import keys
+
+
+def digest(value) -> str:
+    """
+    Returns a hash of the content of a value to be stored in the cache.
+
+    :param value: A dictionary, a row of a result set or a list of them.
+
+    :rtype: str
+    """
+
+    data = json.dumps(value, sort_keys=True, default=str)
+    return md5(data.encode('utf-8')).hexdigest()
+
+
+class Digests(object):
+    """
+    In-process record of the hash of the last value written to every key of
+    the cache collections, bounded to a maximum number of keys per collection.
+
+    Hashes are forgotten after ``max_age`` seconds, so that entries changed
+    or deleted by other services or server processes in the meantime are
+    written again sooner or later.
+    """
+
+    def __init__(self, max_size=100000, max_age=60):
+        self._lock = RLock()
+        self._collections = {}
+        self.max_size = max_size
+        self.max_age = max_age
+
+    def get(self, collection, key):
+        with self._lock:
+            entry = self._collections.get(collection, {}).get(key)
+            if entry is None or monotonic() - entry[1] > self.max_age:
+                return None
+            return entry[0]
+
+    def put(self, collection, key, value):
+        with self._lock:
+            entries = self._collections.setdefault(collection, OrderedDict())
+            entries.pop(key, None)
+            entries[key] = (value, monotonic())
+            # Forget the oldest keys, which are the least likely to be
+            # written again with the same content
+            while len(entries) > self.max_size:
+                entries.popitem(last=False)
+
+    def discard(self, collection, key):
+        with self._lock:
+            self._collections.get(collection, {}).pop(key, None)
+
+
+# Digests shared by all services running in this process
+digests = Digests()
+
+# Writes made and saved by all services running in this process
+stats = {'written': 0, 'skipped': 0}
+
+
+class CacheWriter(object):
+    """
+    Buffers the entries to be stored in a cache collection while a result set
+    is being processed and writes them all at once when flushed.
+
+    Entries whose content has not changed since the last time they were
+    written by this process are skipped, saving the write and its replication
+    to the rest of the servers. The collection is written in a single call if
+    it supports ``set_many``, or one entry at a time otherwise.
+
+    Can be used as a context manager, in which case it is flushed on exit.
+    """
+
+    def __init__(self, cache, name, logger=None):
+        """
+        :param cache: The cache collection, or None if it could not be
+            retrieved, in which case nothing is written.
+        :type cache: :class:`~zato.server.cache.Cache`
+        :param name: The name of the cache collection.
+        :type name: str
+        :param logger: The logger of the calling service. Optional.
+        :type logger: :class:`~logging.Logger`
+        """
+        self.cache = cache
+        self.name = name
+        self.logger = logger
+        self._buffer = OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+        else:
+            self._buffer.clear()
+
+    def set(self, key, value):
+        """Buffers an entry to be written on flush."""
+        self._buffer[key] = value
+
+    def flush(self):
+        """
+        Writes the buffered entries whose content has changed.
+
+        :returns: The number of entries written and the number of entries
+            skipped.
+        :rtype: tuple
+        """
+
+        changed = OrderedDict()
+        hashes = {}
+        for key, value in self._buffer.items():
+            h = digest(value)
+            if digests.get(self.name, key) != h:
+                changed[key] = value
+                hashes[key] = h
+        skipped = len(self._buffer) - len(changed)
+        self._buffer.clear()
+
+        if self.cache is None:
+            return 0, skipped
+
+        set_many = getattr(self.cache, 'set_many', None)
+        if changed and set_many is not None:
+            set_many(changed)
+        else:
+            for key, value in changed.items():
+                self.cache.set(key, value)
+        for key, h in hashes.items():
+            digests.put(self.name, key, h)
+
+        stats['written'] += len(changed)
+        stats['skipped'] += skipped
+        if self.logger:
+            self.logger.info(
+                'Cache writes to %s: %s written, %s saved (%s saved so far)' %
+                (self.name, len(changed), skipped, stats['skipped']))
+        return len(changed), skipped
+
+
+def forget_bookings(cache, *guests):
+    """
+    Removes the aggregate of guest details, bookings and rooms stored by the
+    ``Bookings`` service of the given guests from the ``guests`` cache
+    collection.
+
+    :param cache: The ``guests`` cache collection.
+    :type cache: :class:`~zato.server.cache.Cache`
+    :param guests: The ids of the guests.
+    :type guests: int
+    """
+
+    for id_ in guests:
+        try:
+            cache.delete(keys.guest_bookings(id_))
+        except KeyError:
+            # Not in the cache collection
+            pass
+
+
+def pin_digest(pin) -> str:
+    """
+    Returns the hash of a PIN, as stored in the ``locators`` cache collection.
+
+    :rtype: str
+    """
+
+    return sha256(str(pin).encode('utf-8')).hexdigest()
+
+
+def remember_booking(bookings, locators, booking, details=False):
+    """
+    Stores a booking in the ``bookings`` cache collection, and its id and the
+    hash of its PIN by locator in the ``locators`` cache collection.
+
+    :param bookings: The ``bookings`` cache collection.
+    :type bookings: :class:`~zato.server.cache.Cache`
+    :param locators: The ``locators`` cache collection.
+    :type locators: :class:`~zato.server.cache.Cache`
+    :param booking: All attributes of the booking.
+    :type booking: dict
+    :param details: Whether to return the details of the stored entry.
+    :type details: bool
+
+    :returns: The value returned by the ``bookings`` cache collection.
+    """
+
+    locators.set(keys.locator(booking['locator']), {
+        'id': booking['id'],
+        'pin': pin_digest(booking['pin'])
+    })
+    return bookings.set(keys.record(booking['id']), booking, details=details)
+
+
+def forget_booking(bookings, locators, id_, locator):
+    """
+    Removes a booking from the ``bookings`` and the ``locators`` cache
+    collections.
+
+    :param bookings: The ``bookings`` cache collection.
+    :type bookings: :class:`~zato.server.cache.Cache`
+    :param locators: The ``locators`` cache collection.
+    :type locators: :class:`~zato.server.cache.Cache`
+    :param id_: The id of the booking.
+    :type id_: int
+    :param locator: The locator of the booking.
+    :type locator: str
+    """
+
+    for cache, key in ((bookings, keys.record(id_)),
+                       (locators, keys.locator(locator))):
+        try:
+            cache.delete(key)
+        except KeyError:
+            # Not in the cache collection
+            pass
+
+
+def locate_booking(bookings, locators, locator, pin=None):
+    """
+    Looks up a booking by locator in two gets by key, first of its id in the
+    ``locators`` cache collection and then of the booking in the ``bookings``
+    cache collection, instead of walking the keys of the latter.
+
+    :param bookings: The ``bookings`` cache collection.
+    :type bookings: :class:`~zato.server.cache.Cache`
+    :param locators: The ``locators`` cache collection.
+    :type locators: :class:`~zato.server.cache.Cache`
+    :param locator: The locator of the booking.
+    :type locator: str
+    :param pin: The PIN of the booking. Optional. If given, the booking is
+        not looked up unless the hash of the PIN matches.
+    :type pin: str
+
+    :returns: The cache entry of the booking, with details, or None if not
+        found.
+    """
+
+    entry = locators.get(keys.locator(locator))
+    if not entry:
+        return None
+    if pin is not None and \
+            not hmac.compare_digest(entry['pin'], pin_digest(pin)):
+        return None
+    return bookings.get(keys.record(entry['id']), details=True) or None
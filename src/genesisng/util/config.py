@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+import json
+from base64 import urlsafe_b64encode, urlsafe_b64decode
 from bunch import Bunch
 from typing import Dict
 
@@ -65,6 +67,21 @@ def parse_args(input, allowed: Dict, pagination, logger) -> Dict:
         criteria = pagination.default_criteria
         direction = pagination.default_direction
 
+    # An after token replaces the offset by a seek on the sort criteria and
+    # the id of the last row of the previous page. Tokens issued for another
+    # sort order are discarded.
+    try:
+        after = decode_after(input.after[0])
+    except (ValueError, KeyError, IndexError, AttributeError, TypeError):
+        after = None
+    if after:
+        if after[:2] == (criteria, direction):
+            after = after[2:]
+            offset = 0
+        else:
+            logger.info("Discarting after token: %s" % input.after[0])
+            after = None
+
     # Filters allow filtering by field and value through an operator. Multiple
     # filters are allowed, called conditions.
     # You can only filter by a field that has been allowed for this entity.
@@ -120,15 +137,80 @@ def parse_args(input, allowed: Dict, pagination, logger) -> Dict:
     if not allowed.search:
         term = None
 
+    # The total count of records is only computed when requested
+    try:
+        count = as_bool(input.count[0])
+    except (ValueError, KeyError, IndexError, AttributeError, TypeError):
+        count = False
+
     return Bunch({
         'page': page,
         'size': size,
         'limit': limit,
         'offset': offset,
+        'after': after,
         'criteria': criteria,
         'direction': direction,
         'filters': conditions,
         'operator': operator,
         'columns': columns,
-        'search': term
+        'search': term,
+        'count': count
     })
+
+
+def encode_after(criteria, direction, value, id_) -> str:
+    """
+    Builds the opaque token used to request the page that follows a given row
+    when listing items, to be returned in the ``X-Genesis-After`` header.
+
+    :param criteria: The field used to sort the items.
+    :type criteria: str
+    :param direction: The sort direction, either ``asc`` or ``desc``.
+    :type direction: str
+    :param value: The value of the sort field in the last row of the page.
+    :param id_: The id of the last row of the page.
+    :type id_: int
+
+    :returns: The token, safe to be used in a query string.
+    :rtype: str
+    """
+
+    data = json.dumps([criteria, direction, value, id_], default=str,
+                      separators=(',', ':'))
+    return urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_after(token) -> tuple:
+    """
+    Parses a token built by :func:`encode_after`.
+
+    :param token: The token received through the query string.
+    :type token: str
+
+    :returns: The sort criteria, the direction, the value of the sort field
+        and the id of the last row of the previous page.
+    :rtype: tuple
+
+    :raises: ValueError if the token is not valid.
+    """
+
+    data = urlsafe_b64decode(token + '=' * (-len(token) % 4))
+    criteria, direction, value, id_ = json.loads(data.decode('utf-8'))
+    if not isinstance(id_, int):
+        raise ValueError('Invalid id in after token: %s' % id_)
+    return criteria, direction, value, id_
+
+
+def as_bool(value) -> bool:
+    """
+    Converts a value read from the config.ini file into a boolean.
+
+    :param value: The value of the configuration key, e.g. ``True``.
+    :type value: str
+
+    :returns: Whether the value stands for true or not.
+    :rtype: bool
+    """
+
+    return str(value).strip().lower() in ('true', 'yes', 'on', '1')
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+from time import time
+from sqlalchemy import text
+from genesisng.util import keys
+
+
+def estimate(session, table) -> int:
+    """
+    Returns the number of rows of a table as estimated by the statistics of
+    the query planner, which is kept up to date by ``VACUUM`` and ``ANALYZE``.
+
+    :param session: A live session (transaction).
+    :type session: :class:`~sqlalchemy.orm.session.Session`
+    :param table: The table to estimate the number of rows of.
+    :type table: :class:`~sqlalchemy.schema.Table`
+
+    :returns: The estimated number of rows, or -1 if the table has never been
+        analysed.
+    :rtype: int
+    """
+
+    result = session.execute(
+        text('SELECT reltuples FROM pg_class '
+             'WHERE oid = CAST(:name AS regclass)'),
+        {'name': table.name}).scalar()
+    return -1 if result is None else int(result)
+
+
+def count_rows(session, query, table, params, pagination, cache=None) -> int:
+    """
+    Returns the total count of records of a listing, to be returned in the
+    ``X-Genesis-Count`` header.
+
+    Unfiltered listings of large tables use the estimate of the query planner,
+    so that its cost does not depend on the size of the table. Otherwise, the
+    records matching the filters and the search term are counted through a
+    separate query, which is stored in the cache per filter signature along
+    with its own deadline, as the cache collections of the entities extend
+    the expiry of an entry every time it is read.
+
+    :param session: A live session (transaction).
+    :type session: :class:`~sqlalchemy.orm.session.Session`
+    :param query: The query of the listing with the filters and the search
+        term applied, but not yet sorted nor paginated, and its parameters
+        bound.
+    :type query: :class:`~sqlalchemy.ext.baked.Result`
+    :param table: The table being listed.
+    :type table: :class:`~sqlalchemy.schema.Table`
+    :param params: The arguments returned by
+        :func:`~genesisng.util.config.parse_args`.
+    :type params: Bunch dict
+    :param pagination: The items in the pagination section from the config.ini
+        file.
+    :type pagination: Bunch dict
+    :param cache: The cache collection of the entity. Optional.
+    :type cache: :class:`~zato.server.cache.Cache`
+
+    :returns: The total count of records.
+    :rtype: int
+    """
+
+    if not params.filters and not params.search:
+        total = estimate(session, table)
+        if total >= int(pagination.count_estimate_threshold):
+            return total
+
+    cache_key = keys.count(params)
+    if cache is not None:
+        entry = cache.get(cache_key)
+        if entry is not None and entry['deadline'] > time():
+            return entry['total']
+
+    total = query.count()
+    if cache is not None:
+        expiry = int(pagination.count_cache_expiry)
+        cache.set(cache_key, {'total': total, 'deadline': time() + expiry},
+                  expiry=expiry)
+    return total
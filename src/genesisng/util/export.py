@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+import csv
+import json
+from datetime import date, datetime
+from enum import Enum
+from io import StringIO
+from genesisng.util.config import decode_after
+
+# Content types of the supported export formats
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv'
+}
+
+
+def _default(value):
+    """Converts the values JSON does not know how to serialize."""
+    if isinstance(value, Enum):
+        return value.value
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return str(value)
+
+
+def _ndjson(rows, fields):
+    """Returns a chunk of rows as newline-delimited JSON."""
+    return ''.join(
+        json.dumps(dict(zip(fields, r)), default=_default,
+                   separators=(',', ':')) + '\n'
+        for r in rows)
+
+
+def _csv(rows, fields, header=False):
+    """Returns a chunk of rows as CSV, optionally preceded by a header."""
+    buf = StringIO()
+    writer = csv.writer(buf)
+    if header:
+        writer.writerow(fields)
+    for r in rows:
+        writer.writerow([_default(v) if v is not None else '' for v in r])
+    return buf.getvalue()
+
+
+def resume_after(input) -> int:
+    """
+    Returns the id of the last row exported by the previous response, from
+    the after token received through the query string, as returned in the
+    ``X-Genesis-After`` header.
+
+    :param input: The input of the service, as received through SimpleIO.
+    :type input: Bunch dict
+
+    :returns: The id of the last exported row, or None if no valid token was
+        received.
+    :rtype: int
+    """
+
+    try:
+        criteria, direction, _, id_ = decode_after(input.after[0])
+    except (ValueError, KeyError, IndexError, AttributeError, TypeError):
+        return None
+    if (criteria, direction) != ('id', 'asc'):
+        return None
+    return id_
+
+
+def export(query, fields, format_='ndjson', chunk_size=1000, max_chunks=10):
+    """
+    Runs a query through a server-side cursor and converts up to
+    ``max_chunks`` chunks of its rows to the requested format, a chunk at a
+    time.
+
+    Only ``chunk_size`` rows are held by the driver and the ORM at any given
+    time, and a response never holds more than ``max_chunks`` of them once
+    converted, regardless of the size of the result set. Further rows are
+    exported by the next request, which resumes after the last exported row.
+
+    :param query: The SQLAlchemy Query object, sorted by id and selecting the
+        given fields as columns followed by the id.
+    :type query: :class:`~sqlalchemy:sqlalchemy.orm.query.Query`
+    :param fields: The names of the exported columns, in order.
+    :type fields: list
+    :param format_: The output format, either ``ndjson`` or ``csv``.
+    :type format_: str
+    :param chunk_size: The number of rows fetched and converted at once.
+    :type chunk_size: int
+    :param max_chunks: The maximum number of chunks converted at once.
+    :type max_chunks: int
+
+    :returns: The converted rows and the id of the last one if there may be
+        more rows to export, or None otherwise.
+    :rtype: tuple
+    """
+
+    limit = chunk_size * max_chunks
+    query = query.limit(limit).yield_per(chunk_size).\
+        execution_options(stream_results=True)
+
+    if format_ == 'csv':
+        convert = _csv
+        parts = [_csv([], fields, header=True)]
+    else:
+        convert = _ndjson
+        parts = []
+
+    chunk = []
+    count = 0
+    last = None
+    for r in query:
+        chunk.append(r[:-1])
+        last = r[-1]
+        count += 1
+        if len(chunk) == chunk_size:
+            parts.append(convert(chunk, fields))
+            chunk = []
+    if chunk:
+        parts.append(convert(chunk, fields))
+    return ''.join(parts), last if count == limit else None
@@ -1,5 +1,20 @@
 # -*- coding: utf-8 -*-
-from sqlalchemy import or_, and_
+from sqlalchemy import or_, and_, tuple_, bindparam
+from sqlalchemy.ext import baked
+
+# Baked queries of the listings, shared by all services running in this
+# process and keyed by the shape of the query
+bakery = baked.bakery(size=500)
+
+# List of valid operators as lambda funcions
+OPERATORS = {
+    'eq': lambda f, v: f == v,
+    'ne': lambda f, v: f != v,
+    'gt': lambda f, v: f > v,
+    'lt': lambda f, v: f < v,
+    'gte': lambda f, v: f >= v,
+    'lte': lambda f, v: f <= v
+}
 
 
 def parse_filters(filters, nexus, cols, query):
@@ -23,16 +38,6 @@ def parse_filters(filters, nexus, cols, query):
     :rtype: :class:`~sqlalchemy:sqlalchemy.orm.query.Query`
     """
 
-    # List of valid operators as lambda funcions
-    OPERATORS = {
-        'eq': lambda f, v: f == v,
-        'ne': lambda f, v: f != v,
-        'gt': lambda f, v: f > v,
-        'lt': lambda f, v: f < v,
-        'gte': lambda f, v: f >= v,
-        'lte': lambda f, v: f <= v
-    }
-
     # Process filters
     clauses = []
     for f in filters:
@@ -47,3 +52,144 @@ def parse_filters(filters, nexus, cols, query):
 
     # Return the modified query object
     return query
+
+
+def parse_order(criteria, direction, after, cols, query):
+    """
+    Sorts the Query object of SQLAlchemy by the criteria received through
+    query string, which has already been parsed by `parse_args`, and the id
+    as tie-breaker. If an after token was received, adds the condition that
+    seeks past the last row of the previous page, which can be resolved
+    through an index on the sort field instead of scanning and discarding
+    all previous rows.
+
+    Null values are sorted last in ascending order and first in descending
+    order, as PostgreSQL does by default. The value and the id of the last
+    row are bound as the ``after_value`` and ``after_id`` parameters.
+
+    :param criteria: The field to sort by.
+    :type criteria: String
+
+    :param direction: The sort direction, either ``asc`` or ``desc``.
+    :type direction: String
+
+    :param after: The value of the sort field and the id of the last row of
+        the previous page, or None.
+    :type after: Tuple
+
+    :param cols: A list of the attributes of the entity as table columns.
+    :type cols: :class:`~sqlalchemy:sqlalchemy.sql.base.ImmutableColumnCollection`
+
+    :param query: The SQLAlchemy Query object being constructed.
+    :type query: :class:`~sqlalchemy:sqlalchemy.orm.query.Query`
+
+    :returns: A modified Query object that is sorted and, maybe, filtered.
+    :rtype: :class:`~sqlalchemy:sqlalchemy.orm.query.Query`
+    """
+
+    col = cols[criteria]
+    id_ = cols['id']
+
+    # Sort by the criteria and then by id
+    if direction == 'asc':
+        query = query.order_by(col.asc())
+        if criteria != 'id':
+            query = query.order_by(id_.asc())
+    else:
+        query = query.order_by(col.desc())
+        if criteria != 'id':
+            query = query.order_by(id_.desc())
+
+    if after is None:
+        return query
+
+    # Seek past the last row of the previous page
+    value, last_id = after
+    last_id = bindparam('after_id', last_id, type_=id_.type)
+    if value is not None:
+        value = bindparam('after_value', value, type_=col.type)
+    if criteria == 'id':
+        clause = id_ > last_id if direction == 'asc' else id_ < last_id
+    elif direction == 'asc':
+        if value is None:
+            clause = and_(col.is_(None), id_ > last_id)
+        else:
+            clause = or_(tuple_(col, id_) > tuple_(value, last_id),
+                         col.is_(None))
+    else:
+        if value is None:
+            clause = or_(and_(col.is_(None), id_ < last_id),
+                         col.isnot(None))
+        else:
+            clause = tuple_(col, id_) < tuple_(value, last_id)
+
+    # Return the modified query object
+    return query.filter(clause)
+
+
+def bake_list(entities, cols, params, search=()):
+    """
+    Builds the baked queries of a listing from the arguments received through
+    query string, which have already been parsed by `parse_args`.
+
+    Queries are keyed by their shape (entities, filtered fields and
+    comparators, operator, search, sort criteria and direction, and whether
+    an after token was received) and compiled only once per shape. Values of
+    the filters, the search term, the after token, the limit and the offset
+    are passed as bound parameters.
+
+    :param entities: The columns or the model class to select.
+    :type entities: Tuple
+
+    :param params: The arguments returned by `parse_args`.
+    :type params: Bunch dict
+
+    :param cols: A list of the attributes of the entity as table columns.
+    :type cols: :class:`~sqlalchemy:sqlalchemy.sql.base.ImmutableColumnCollection`
+
+    :param search: The fields searched in if there is a search term.
+    :type search: Tuple
+
+    :returns: The baked query with the filters and the search term applied,
+        the same query sorted and paginated, and the values of their bound
+        parameters.
+    :rtype: Tuple
+    """
+
+    entities = tuple(entities)
+    binds = {'limit': params.limit, 'offset': params.offset}
+
+    base = bakery(lambda s: s.query(*entities), entities)
+
+    # Filters, tied together using the operator
+    if params.filters:
+        shape = tuple((f, c) for f, c, _ in params.filters)
+        nexus = or_ if params.operator == 'or' else and_
+        base.add_criteria(lambda q: q.filter(nexus(*(
+            OPERATORS[c](cols[f], bindparam('filter_%d' % i,
+                                            type_=cols[f].type))
+            for i, (f, c) in enumerate(shape)))), entities, shape, nexus)
+        binds.update(('filter_%d' % i, v)
+                     for i, (_, _, v) in enumerate(params.filters))
+
+    # Search: add ilike clauses if there is a search term.
+    if params.search and search:
+        search = tuple(search)
+        base.add_criteria(lambda q: q.filter(or_(
+            *(cols[f].ilike(bindparam('search')) for f in search))),
+            entities, search)
+        binds['search'] = params.search
+
+    # Order by, seeking past the last row of the previous page if an after
+    # token was received, and add limit and offset
+    after = params.after
+    if after is not None:
+        binds['after_value'], binds['after_id'] = after
+    query = base.with_criteria(
+        lambda q: parse_order(params.criteria, params.direction, after, cols,
+                              q).
+        offset(bindparam('offset')).limit(bindparam('limit')),
+        entities, params.criteria, params.direction,
+        None if after is None else after[0] is None)
+
+    return base, query, binds
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Cooperative database access for services running under gevent.
+
+Zato runs every request in a greenlet of a gevent-based worker. Unless a wait
+callback is registered, psycopg2 blocks the whole worker while waiting for
+PostgreSQL to answer, so a single slow query holds every other request of the
+worker. With the callback of `psycogreen`_ installed, the greenlet waiting on
+the database yields to the rest until the socket is ready, and cache lookups,
+bcrypt verifications and other queries carry on meanwhile.
+
+The callback is global to the process and affects all connections created
+afterwards, so it is registered once per process by the
+``startup.cooperative`` startup service. ``COPY`` is not supported in this
+mode.
+
+Independent queries of a single request may also be run concurrently with
+:func:`gather`, each on its own connection, which only overlaps their waits
+on the database once the callback is registered, and work not needed for the
+response may be left running in the background with :func:`spawn`.
+
+.. _psycogreen: https://github.com/psycopg/psycogreen
+"""
+import gevent
+from psycopg2 import extensions
+
+try:
+    from psycogreen.gevent import patch_psycopg
+except ImportError:
+    patch_psycopg = None
+
+# Whether the lack of psycogreen has been reported already
+_reported = False
+
+
+def is_green() -> bool:
+    """
+    Returns whether psycopg2 waits for the database cooperatively.
+
+    :rtype: bool
+    """
+
+    return extensions.get_wait_callback() is not None
+
+
+def patch(logger=None) -> bool:
+    """
+    Registers the gevent wait callback of psycopg2, unless a callback has
+    already been registered, e.g. by the server itself.
+
+    :param logger: The logger of the calling service. Optional.
+    :type logger: :class:`~logging.Logger`
+
+    :returns: Whether psycopg2 waits for the database cooperatively.
+    :rtype: bool
+    """
+
+    global _reported
+
+    if is_green():
+        return True
+    if patch_psycopg is None:
+        if logger and not _reported:
+            logger.warning('Could not make psycopg2 cooperative: '
+                           'psycogreen is not installed.')
+            _reported = True
+        return False
+    patch_psycopg()
+    if logger:
+        logger.info('Registered the gevent wait callback of psycopg2.')
+    return True
+
+
+def gather(*calls) -> list:
+    """
+    Runs the given callables concurrently, each in its own greenlet, and
+    waits for all of them to finish.
+
+    Callables running queries must use a session of their own, as sessions
+    and connections cannot be shared between greenlets.
+
+    :param calls: Callables without arguments.
+
+    :returns: The values returned by the callables, in the same order.
+    :rtype: list
+
+    :raises: The exception raised by the first failed callable, if any.
+    """
+
+    greenlets = [gevent.spawn(c) for c in calls]
+    gevent.joinall(greenlets)
+    for g in greenlets:
+        if not g.successful():
+            raise g.exception
+    return [g.value for g in greenlets]
+
+
+def spawn(fn, *args, logger=None):
+    """
+    Runs a callable in a greenlet of its own, without waiting for it. Any
+    exception it raises is logged rather than propagated.
+
+    :param fn: The callable.
+    :param args: The arguments of the callable.
+    :param logger: The logger of the calling service. Optional.
+    :type logger: :class:`~logging.Logger`
+
+    :returns: The greenlet.
+    :rtype: :class:`~gevent.Greenlet`
+    """
+
+    def run():
+        try:
+            fn(*args)
+        except Exception:
+            if logger:
+                logger.exception('Background task %s failed.' % fn)
+
+    return gevent.spawn(run)
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Keys of the entries stored in the cache collections.
+
+Every entry is stored under a key built by one of these functions and read
+back with a get by that exact key, never by walking the keys of the
+collection with ``get_by_prefix`` or ``get_by_suffix``, whose cost grows with
+the size of the collection and which may match other entries, e.g.
+``id:1`` is also a prefix of ``id:10``.
+
+Keys of the ``availability`` cache collection, which are also parsed back to
+evict entries, are built by :func:`genesisng.util.availability.cache_key`.
+"""
+
+# Key of the entry holding all records of an entity, e.g. all extras
+ALL = 'all'
+
+
+def record(id_) -> str:
+    """
+    Returns the key of a record by id, in the cache collection of its entity,
+    i.e. ``bookings``, ``guests``, ``logins``, ``rates`` or ``rooms``.
+
+    :param id_: The id of the record.
+    :type id_: int
+
+    :rtype: str
+    """
+
+    return 'id:%s' % id_
+
+
+def locator(locator_) -> str:
+    """
+    Returns the key of the id and hash of the PIN of a booking by locator, in
+    the ``locators`` cache collection.
+
+    :param locator_: The locator of the booking.
+    :type locator_: str
+
+    :rtype: str
+    """
+
+    return 'locator:%s' % locator_
+
+
+def guest_bookings(id_) -> str:
+    """
+    Returns the key of the details, bookings and rooms of a guest, in the
+    ``guests`` cache collection.
+
+    :param id_: The id of the guest.
+    :type id_: int
+
+    :rtype: str
+    """
+
+    return 'bookings:%s' % id_
+
+
+def stale(key) -> str:
+    """
+    Returns the key of the stale copy of an entry that has been evicted but
+    may still be served while it is refreshed, in the same cache collection.
+
+    :param key: The key of the evicted entry.
+    :type key: str
+
+    :rtype: str
+    """
+
+    return 'stale:%s' % key
+
+
+def lock(key) -> str:
+    """
+    Returns the key of the lock entry of the work that writes an entry, in
+    the ``default`` cache collection.
+
+    :param key: The key of the entry being written.
+    :type key: str
+
+    :rtype: str
+    """
+
+    return 'lock:%s' % key
+
+
+def generation(name) -> str:
+    """
+    Returns the key of the generation of an in-process index, counting the
+    changes made to its data by every server process, in the ``default``
+    cache collection.
+
+    :param name: The name of the index, i.e. ``occupancy`` or ``price``.
+    :type name: str
+
+    :rtype: str
+    """
+
+    return 'generation:%s' % name
+
+
+def count(params) -> str:
+    """
+    Returns the key of the total count of records of a listing, in the cache
+    collection of its entity.
+
+    :param params: The parsed arguments of the listing, as returned by
+        :func:`~genesisng.util.config.parse_args`.
+    :type params: Bunch dict
+
+    :rtype: str
+    """
+
+    return 'count|filters:%s|operator:%s|search:%s' % (
+        str(params.filters), params.operator, params.search)
+
+
+def page(params) -> str:
+    """
+    Returns the key of a page of a listing, in the cache collection of its
+    entity.
+
+    :param params: The parsed arguments of the listing, as returned by
+        :func:`~genesisng.util.config.parse_args`.
+    :type params: Bunch dict
+
+    :rtype: str
+    """
+
+    return 'page:%s|size:%s|criteria:%s|direction:%s|filters:%s|' \
+        'operator:%s|search:%s|after:%s' % (
+            params.page, params.size, params.criteria, params.direction,
+            str(params.filters), params.operator, params.search,
+            params.after)
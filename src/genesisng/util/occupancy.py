@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+from threading import RLock
+from time import monotonic
+from datetime import date, datetime
+from genesisng.schema.booking import Booking
+from genesisng.util import keys
+
+
+def _date(value):
+    """Returns the value as a date, as attributes of a booking that has just
+    been flushed keep the strings they were created with."""
+    if isinstance(value, date):
+        return value
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+class OccupancyIndex(object):
+    """
+    In-process index of the nights booked on every room.
+
+    Each room is represented by a bitset, stored as a Python integer, where
+    every bit is a night counted from an origin date. A stay occupies the
+    nights from the check-in date up to, but not including, the check-out
+    date, so two stays overlap if, and only if, the bitwise ``and`` of their
+    masks is not zero. This mimics the ``OVERLAPS`` operator used by the
+    availability search.
+
+    Only bookings that have not been cancelled occupy a room, which is the
+    same criteria used by the SQL query in the availability search.
+
+    The index is loaded from the database on first use and kept current by
+    the booking services. As every server process keeps its own copy, every
+    change is also counted in a generation number kept in a builtin cache
+    collection, shared by all server processes, and the index is reloaded
+    whenever the generation differs from the one it was loaded at, or once its
+    time to live expires.
+    """
+
+    def __init__(self):
+        self._lock = RLock()
+        self._origin = None
+        self._bookings = {}
+        self._rooms = {}
+        self.loaded = None
+        self.generation = None
+
+    def _mask(self, check_in, check_out):
+        """Returns the bit mask of the nights of a stay, clamped to the origin
+        of the index."""
+        start = max((check_in - self._origin).days, 0)
+        end = (check_out - self._origin).days
+        if end <= start:
+            return 0
+        return ((1 << (end - start)) - 1) << start
+
+    def _rebase(self, origin):
+        """Moves the origin of the index back in time to the given date."""
+        shift = (self._origin - origin).days
+        self._rooms = {k: v << shift for k, v in self._rooms.items()}
+        self._origin = origin
+
+    def _add(self, id_, id_room, check_in, check_out):
+        if self._origin is None:
+            self._origin = check_in
+        elif check_in < self._origin:
+            self._rebase(check_in)
+        self._bookings[id_] = (id_room, check_in, check_out)
+        self._rooms[id_room] = self._rooms.get(id_room, 0) | \
+            self._mask(check_in, check_out)
+
+    def _discard(self, id_):
+        entry = self._bookings.pop(id_, None)
+        if entry is None:
+            return
+        # Bookings of the same room may share nights, so the bitset of the
+        # room is rebuilt from its remaining bookings.
+        id_room = entry[0]
+        bitset = 0
+        for r, check_in, check_out in self._bookings.values():
+            if r == id_room:
+                bitset |= self._mask(check_in, check_out)
+        self._rooms[id_room] = bitset
+
+    def is_ready(self, ttl):
+        """Tells whether the index has been loaded and has not expired."""
+        return self.loaded is not None and monotonic() - self.loaded < ttl
+
+    def load(self, session):
+        """Loads all bookings that occupy a room from the database."""
+        with self._lock:
+            result = session.query(Booking.id, Booking.id_room,
+                                   Booking.check_in, Booking.check_out).\
+                filter(Booking.cancelled.is_(None)).\
+                all()
+            self._origin = None
+            self._bookings = {}
+            self._rooms = {}
+            for r in result:
+                self._add(r.id, r.id_room, r.check_in, r.check_out)
+            self.loaded = monotonic()
+
+    def ensure(self, session, ttl, cache=None):
+        """
+        Loads the index unless it is ready to be used and up to date with the
+        changes made through other server processes.
+
+        :param session: A live session (transaction).
+        :type session: :class:`~sqlalchemy.orm.session.Session`
+        :param ttl: The number of seconds the index lasts at most.
+        :type ttl: int
+        :param cache: The cache collection holding the generation of the
+            index. Optional.
+        :type cache: :class:`~zato.server.cache.Cache`
+        """
+        # Read the generation before loading, so that changes made meanwhile
+        # cause another load on next use
+        generation = None
+        if cache is not None:
+            generation = cache.get(keys.generation('occupancy')) or 0
+        if not self.is_ready(ttl) or generation != self.generation:
+            self.load(session)
+            self.generation = generation
+
+    def invalidate(self):
+        """Marks the index as expired so that it is reloaded on next use."""
+        self.loaded = None
+
+    def sync(self, booking, cache=None):
+        """
+        Updates the index with the current state of a booking. To be called
+        after every write operation on a booking, whichever it is.
+
+        :param booking: The booking that has been created or modified.
+        :type booking: :class:`~genesisng.schema.booking.Booking`
+        :param cache: The cache collection holding the generation of the
+            index, to tell other server processes to reload theirs. Optional.
+        :type cache: :class:`~zato.server.cache.Cache`
+        """
+        with self._lock:
+            if self.loaded is not None:
+                self._discard(booking.id)
+                if booking.cancelled is None:
+                    self._add(booking.id, booking.id_room,
+                              _date(booking.check_in),
+                              _date(booking.check_out))
+            if cache is None:
+                return
+            generation = cache.incr(keys.generation('occupancy'))
+            # Keep this copy unless another process changed a booking since
+            # it was loaded, which would leave a gap
+            if self.generation is not None and \
+                    generation == self.generation + 1:
+                self.generation = generation
+            else:
+                self.invalidate()
+
+    def busy_rooms(self, check_in, check_out):
+        """
+        Returns the ids of the rooms that have at least one night booked
+        between the given dates.
+
+        :param check_in: The date the guests want to arrive.
+        :type check_in: date
+        :param check_out: The date the guests want to leave.
+        :type check_out: date
+
+        :returns: The ids of the rooms that are not available.
+        :rtype: set
+        """
+        with self._lock:
+            if self._origin is None:
+                return set()
+            mask = self._mask(check_in, check_out)
+            return {k for k, v in self._rooms.items() if v & mask}
+
+
+# Index shared by all services running in this process
+index = OccupancyIndex()
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+Password verification outside the request worker.
+
+Verifying a bcrypt hash costs hundreds of milliseconds of CPU by design, and
+it holds the worker, and every other request it serves, for that long. The
+:class:`Verifier` hands verifications over to a pool of processes, and lets
+at most a given number of them wait for it, so that a burst of logins is
+rejected early with :class:`Overloaded` instead of queueing without bounds.
+
+Successful verifications may be remembered for a short while by
+:class:`Verified`, keyed by username and HMAC of the password with a secret
+generated when the process starts, so that neither passwords nor anything
+derived from them with a known key are kept.
+"""
+import hmac
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from hashlib import sha256
+from multiprocessing import get_context
+from os import urandom
+from threading import Lock
+from time import monotonic
+from passlib.hash import bcrypt
+
+
+class Overloaded(Exception):
+    """
+    Raised when too many verifications are waiting for the pool, or one of
+    them has not finished in time.
+    """
+
+
+def _verify(password, hash_):
+    """Verifies a password against a hash, in a process of the pool."""
+    return bcrypt.verify(password, hash_)
+
+
+class Verifier(object):
+    """
+    Pool of processes verifying passwords against bcrypt hashes.
+
+    The pool is started on first use. Processes are spawned rather than
+    forked, so that they do not inherit the event loop and connections of
+    the server process.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._executor = None
+        self._workers = 0
+        self.pending = 0
+
+    def _pool(self, workers):
+        with self._lock:
+            if self._executor is None or self._workers != workers:
+                if self._executor is not None:
+                    self._executor.shutdown(wait=False)
+                self._executor = ProcessPoolExecutor(
+                    max_workers=workers, mp_context=get_context('spawn'))
+                self._workers = workers
+            return self._executor
+
+    def _reset(self, executor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+
+    def verify(self, password, hash_, workers=0, max_pending=0,
+               timeout=None) -> bool:
+        """
+        Verifies a password against a bcrypt hash.
+
+        :param password: The clear-text password.
+        :type password: str
+        :param hash_: The bcrypt hash of the password.
+        :type hash_: str
+        :param workers: The number of processes of the pool. If 0, the
+            password is verified in the calling process.
+        :type workers: int
+        :param max_pending: The maximum number of verifications waiting for
+            the pool. If 0, there is no limit.
+        :type max_pending: int
+        :param timeout: The number of seconds to wait for the verification.
+        :type timeout: float
+
+        :returns: Whether the password matches the hash.
+        :rtype: bool
+
+        :raises: Overloaded if there are too many verifications waiting, or
+            if this one did not finish in time.
+        """
+
+        if workers <= 0:
+            return bcrypt.verify(password, hash_)
+
+        with self._lock:
+            if max_pending and self.pending >= max_pending:
+                raise Overloaded('%s verifications pending' % self.pending)
+            self.pending += 1
+        try:
+            executor = self._pool(workers)
+            future = executor.submit(_verify, password, hash_)
+            try:
+                return future.result(timeout)
+            except TimeoutError:
+                future.cancel()
+                raise Overloaded('Verification timed out')
+            except BrokenProcessPool:
+                # A process of the pool died, so start a new pool next time
+                # and verify this one here
+                self._reset(executor)
+                return bcrypt.verify(password, hash_)
+        finally:
+            with self._lock:
+                self.pending -= 1
+
+
+class Verified(object):
+    """
+    In-process record of the credentials verified recently, bounded to a
+    maximum number of entries.
+
+    Every entry keeps the hash the password was verified against, so that
+    entries are ignored once the password of the login changes.
+    """
+
+    def __init__(self, max_size=10000):
+        self._lock = Lock()
+        self._secret = urandom(32)
+        self._entries = {}
+        self.max_size = max_size
+
+    def _key(self, username, password):
+        mac = hmac.new(self._secret, password.encode('utf-8'), sha256)
+        return username, mac.digest()
+
+    def check(self, username, password, hash_) -> bool:
+        """
+        Returns whether the credentials have been verified against the given
+        hash and the entry has not expired.
+
+        :rtype: bool
+        """
+
+        entry = self._entries.get(self._key(username, password))
+        if entry is None or entry[1] < monotonic():
+            return False
+        return hmac.compare_digest(entry[0], hash_)
+
+    def add(self, username, password, hash_, expiry):
+        """
+        Records credentials that have been verified against a hash, for the
+        given number of seconds.
+        """
+
+        key = self._key(username, password)
+        now = monotonic()
+        with self._lock:
+            if len(self._entries) >= self.max_size:
+                self._entries = {k: v for k, v in self._entries.items()
+                                 if v[1] >= now}
+                if len(self._entries) >= self.max_size:
+                    self._entries.clear()
+            self._entries[key] = (hash_, now + expiry)
+
+
+# Pool and record of verified credentials shared by all services running in
+# this process
+verifier = Verifier()
+verified = Verified()
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Server-side prepared statements for the lookups run on every request.
+
+Statements are prepared with ``PREPARE`` the first time they are used on
+each pooled connection, which keeps track of them in its ``info``
+dictionary, and executed with ``EXECUTE`` from then on, so that PostgreSQL
+does not parse and plan them again on every call. Rows are loaded into
+model instances through the ORM, as :meth:`~sqlalchemy.orm.query.Query.get`
+or :meth:`~sqlalchemy.orm.query.Query.one_or_none` would.
+
+Prepared statements last as long as the database session, so they require
+connections to be kept for the whole session, e.g. PgBouncer must not be
+used in transaction pooling mode.
+"""
+from sqlalchemy import text
+
+# Statements by name, with the types of their parameters
+STATEMENTS = {
+    'get_booking': (
+        ('integer',),
+        'SELECT * FROM booking WHERE id = $1 AND deleted IS NULL'),
+    'locate_booking': (
+        ('varchar',),
+        'SELECT * FROM booking WHERE locator = $1 AND deleted IS NULL'),
+    'validate_booking': (
+        ('varchar', 'varchar'),
+        'SELECT * FROM booking WHERE locator = $1 AND pin = $2 '
+        'AND deleted IS NULL AND cancelled IS NULL'),
+    'get_guest': (
+        ('integer',),
+        'SELECT * FROM guest WHERE id = $1 AND deleted IS NULL'),
+    'get_room': (
+        ('integer',),
+        'SELECT * FROM room WHERE id = $1 AND deleted IS NULL'),
+    'get_login': (
+        ('varchar',),
+        'SELECT * FROM login WHERE username = $1'),
+}
+
+
+def prepare(session, name):
+    """
+    Prepares a statement on the connection of the session, unless it has
+    already been prepared on it.
+
+    :param session: A live session (transaction).
+    :type session: :class:`~sqlalchemy.orm.session.Session`
+    :param name: The name of the statement, as in :data:`STATEMENTS`.
+    :type name: str
+    """
+
+    info = session.connection().connection.info
+    prepared = info.setdefault('prepared_statements', set())
+    if name in prepared:
+        return
+    types, statement = STATEMENTS[name]
+    session.execute(text('PREPARE %s (%s) AS %s' % (
+        name, ', '.join(types), statement)))
+    prepared.add(name)
+
+
+def lookup(session, entity, name, *args, options=()):
+    """
+    Loads an instance of a model class through a prepared statement.
+
+    :param session: A live session (transaction).
+    :type session: :class:`~sqlalchemy.orm.session.Session`
+    :param entity: The model class the statement selects from.
+    :param name: The name of the statement, as in :data:`STATEMENTS`.
+    :type name: str
+    :param args: The values of the parameters of the statement.
+    :param options: Loader options, e.g. to undefer columns.
+    :type options: list
+
+    :returns: The instance, or None if not found.
+    """
+
+    prepare(session, name)
+    binds = {'p%d' % i: a for i, a in enumerate(args)}
+    statement = text('EXECUTE %s (%s)' % (
+        name, ', '.join(':p%d' % i for i in range(len(args)))))
+    return session.query(entity).options(*options).\
+        from_statement(statement).params(binds).one_or_none()
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+from array import array
+from threading import RLock
+from time import monotonic
+from datetime import date, datetime
+from genesisng.schema.rate import Rate
+from genesisng.util import keys
+
+
+def _date(value):
+    """Returns the value as a date, as attributes of a rate that has just been
+    added keep the strings they were created with."""
+    if isinstance(value, date):
+        return value
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+class PriceCalendar(object):
+    """
+    In-process calendar of nightly prices built from the published rates.
+
+    Every night between the start date of the earliest rate and the end date
+    of the latest one has a base price, a price per bed and a flag telling
+    whether any rate covers it. Prefix sums of the three of them are kept so
+    that the number of priced nights and the price of any stay are obtained
+    with a couple of subtractions, regardless of its length.
+
+    A rate covers the nights from its start date up to, but not including,
+    its end date, which is the same arithmetic used by the availability search
+    when adding up the prices of the seasons a stay overlaps.
+
+    The calendar is loaded from the database on first use and kept current by
+    the rate services, rebuilding the prefix sums from the first night that
+    changed onwards. As every server process keeps its own copy, every
+    change is also counted in a generation number kept in a builtin cache
+    collection, shared by all server processes, and the calendar is reloaded
+    whenever the generation differs from the one it was loaded at, or once its
+    time to live expires.
+    """
+
+    def __init__(self):
+        self._lock = RLock()
+        self._rates = {}
+        self._reset(None, 0)
+        self.loaded = None
+        self.generation = None
+
+    def _build(self):
+        """Rebuilds the nightly arrays and their prefix sums from scratch."""
+        if not self._rates:
+            self._reset(None, 0)
+            return
+        origin = min(r[0] for r in self._rates.values())
+        end = max(r[1] for r in self._rates.values())
+        self._reset(origin, (end - origin).days)
+        for date_from, date_to, base_price, bed_price in self._rates.values():
+            self._fill(date_from, date_to, base_price, bed_price)
+        self._accumulate(0)
+
+    def _reset(self, origin, length):
+        """Allocates empty arrays for the given number of nights."""
+        self._origin = origin
+        self._base = array('d', [0]) * length
+        self._bed = array('d', [0]) * length
+        self._covered = array('d', [0]) * length
+        self._sum_base = array('d', [0]) * (length + 1)
+        self._sum_bed = array('d', [0]) * (length + 1)
+        self._sum_covered = array('d', [0]) * (length + 1)
+
+    def _fill(self, date_from, date_to, base_price, bed_price, covered=1):
+        """Sets the prices of the nights covered by a rate."""
+        start = (date_from - self._origin).days
+        end = (date_to - self._origin).days
+        for i in range(start, end):
+            self._base[i] = base_price
+            self._bed[i] = bed_price
+            self._covered[i] = covered
+
+    def _accumulate(self, start):
+        """Recomputes the prefix sums from the given night onwards."""
+        for i in range(start, len(self._base)):
+            self._sum_base[i + 1] = self._sum_base[i] + self._base[i]
+            self._sum_bed[i + 1] = self._sum_bed[i] + self._bed[i]
+            self._sum_covered[i + 1] = self._sum_covered[i] + \
+                self._covered[i]
+
+    def _in_range(self, date_from, date_to):
+        return self._origin is not None and date_from >= self._origin and \
+            (date_to - self._origin).days <= len(self._base)
+
+    def is_ready(self, ttl):
+        """Tells whether the calendar has been loaded and has not expired."""
+        return self.loaded is not None and monotonic() - self.loaded < ttl
+
+    def load(self, session):
+        """Loads all published rates from the database."""
+        with self._lock:
+            result = session.query(Rate.id, Rate.date_from, Rate.date_to,
+                                   Rate.base_price, Rate.bed_price).\
+                filter(Rate.published.is_(True)).\
+                all()
+            self._rates = {r.id: (r.date_from, r.date_to, r.base_price or 0,
+                                  r.bed_price or 0) for r in result}
+            self._build()
+            self.loaded = monotonic()
+
+    def ensure(self, session, ttl, cache=None):
+        """
+        Loads the calendar unless it is ready to be used and up to date with
+        the changes made through other server processes.
+
+        :param session: A live session (transaction).
+        :type session: :class:`~sqlalchemy.orm.session.Session`
+        :param ttl: The number of seconds the calendar lasts at most.
+        :type ttl: int
+        :param cache: The cache collection holding the generation of the
+            calendar. Optional.
+        :type cache: :class:`~zato.server.cache.Cache`
+        """
+        # Read the generation before loading, so that changes made meanwhile
+        # cause another load on next use
+        generation = None
+        if cache is not None:
+            generation = cache.get(keys.generation('price')) or 0
+        if not self.is_ready(ttl) or generation != self.generation:
+            self.load(session)
+            self.generation = generation
+
+    def invalidate(self):
+        """Marks the calendar as expired so that it is reloaded on next
+        use."""
+        self.loaded = None
+
+    def _bump(self, cache):
+        """Counts a change in the generation of the calendar, to tell other
+        server processes to reload theirs, and keeps this copy unless another
+        process changed a rate since it was loaded, which would leave a
+        gap."""
+        if cache is None:
+            return
+        generation = cache.incr(keys.generation('price'))
+        if self.generation is not None and \
+                generation == self.generation + 1:
+            self.generation = generation
+        else:
+            self.invalidate()
+
+    def sync(self, rate, cache=None):
+        """
+        Updates the calendar with the current state of a rate. To be called
+        after a rate has been created or updated.
+
+        :param rate: The rate that has been created or modified.
+        :type rate: :class:`~genesisng.schema.rate.Rate`
+        :param cache: The cache collection holding the generation of the
+            calendar, to tell other server processes to reload theirs.
+            Optional.
+        :type cache: :class:`~zato.server.cache.Cache`
+        """
+        with self._lock:
+            if self.loaded is not None:
+                old = self._rates.pop(rate.id, None)
+                if rate.published:
+                    new = (_date(rate.date_from), _date(rate.date_to),
+                           rate.base_price or 0, rate.bed_price or 0)
+                    self._rates[rate.id] = new
+                else:
+                    new = None
+                self._update(old, new)
+            self._bump(cache)
+
+    def discard(self, id_, cache=None):
+        """
+        Removes a rate from the calendar. To be called after a rate has been
+        deleted.
+
+        :param id_: The id of the rate.
+        :type id_: int
+        :param cache: The cache collection holding the generation of the
+            calendar, to tell other server processes to reload theirs.
+            Optional.
+        :type cache: :class:`~zato.server.cache.Cache`
+        """
+        with self._lock:
+            if self.loaded is not None:
+                self._update(self._rates.pop(id_, None), None)
+            self._bump(cache)
+
+    def _update(self, old, new):
+        """Replaces the nights of the old rate by those of the new one,
+        rebuilding the whole calendar only when its range changes."""
+        if old is None and new is None:
+            return
+        if not all(self._in_range(r[0], r[1]) for r in (old, new) if r) or \
+                (old and not self._rates):
+            self._build()
+            return
+        if old:
+            self._fill(old[0], old[1], 0, 0, 0)
+        if new:
+            self._fill(*new)
+        start = min((r[0] - self._origin).days for r in (old, new) if r)
+        self._accumulate(start)
+
+    def quote(self, check_in, check_out, guests):
+        """
+        Returns the number of nights covered by a rate and the price of a
+        stay, not including the supplement of the room.
+
+        :param check_in: The date the guests want to arrive.
+        :type check_in: date
+        :param check_out: The date the guests want to leave.
+        :type check_out: date
+        :param guests: The number of guests.
+        :type guests: int
+
+        :returns: The number of nights and the price, both zero if no
+            published rate covers any of the nights of the stay.
+        :rtype: tuple
+        """
+        with self._lock:
+            if self._origin is None:
+                return 0, 0.0
+            length = len(self._base)
+            start = min(max((check_in - self._origin).days, 0), length)
+            end = min(max((check_out - self._origin).days, 0), length)
+            nights = int(self._sum_covered[end] - self._sum_covered[start])
+            price = self._sum_base[end] - self._sum_base[start] + \
+                (self._sum_bed[end] - self._sum_bed[start]) * guests
+            return nights, price
+
+
+# Calendar shared by all services running in this process
+calendar = PriceCalendar()
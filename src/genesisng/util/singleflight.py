@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Coalescing of identical concurrent requests.
+
+When many identical requests miss the cache at the same time, e.g. when a
+promotion is announced, only one of them should do the work while the rest
+wait for it and share its result. Within a server process, :class:`Group`
+lets a single caller per key run the work and hands its result, or its
+exception, to every caller that arrived meanwhile.
+
+Across servers, :func:`acquire` writes a short-lived lock entry in a cache
+collection, which the rest of the servers see once the collection has been
+synchronised, and :func:`wait` polls for the result while the entry exists.
+Builtin cache collections have no atomic ``add`` operation, so this is a best
+effort: two servers may still run the same work now and then, but never
+wait for each other for longer than the lock lasts. As collections may extend
+the expiry of an entry every time it is read, which polling does, the lock
+entry holds its own deadline and is ignored once it has passed, even if the
+server holding it died without releasing it.
+"""
+from threading import Event, Lock
+from time import monotonic, sleep, time
+from uuid import uuid4
+
+
+class _Call(object):
+    """A piece of work in progress and its outcome."""
+
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+class Group(object):
+    """
+    In-process registry of the work in progress, by key.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._calls = {}
+
+    def do(self, key, fn, timeout=None):
+        """
+        Runs a callable, unless another caller is already running it for the
+        same key, in which case its result is awaited and shared instead.
+
+        :param key: The key identifying the work, e.g. a cache key.
+        :type key: str
+        :param fn: A callable without arguments.
+        :param timeout: The number of seconds to wait for another caller
+            before running the callable anyway. Optional.
+        :type timeout: float
+
+        :returns: The value returned by the callable and whether it was
+            shared by another caller.
+        :rtype: tuple
+
+        :raises: The exception raised by the callable, in every caller
+            sharing it.
+        """
+
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                leader = True
+            else:
+                leader = False
+
+        if not leader:
+            if not call.done.wait(timeout):
+                return fn(), False
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+    def running(self, key) -> bool:
+        """
+        Returns whether the work of a key is in progress.
+
+        :rtype: bool
+        """
+
+        with self._lock:
+            return key in self._calls
+
+
+def _held(entry):
+    """Tells whether a lock entry exists and its deadline has not passed."""
+    return bool(entry) and entry['deadline'] > time()
+
+
+def acquire(cache, key, expiry):
+    """
+    Writes a lock entry in a cache collection, unless it is already held.
+
+    :param cache: The cache collection holding the lock entries.
+    :type cache: :class:`~zato.server.cache.Cache`
+    :param key: The key of the lock entry.
+    :type key: str
+    :param expiry: The number of seconds the lock lasts at most.
+    :type expiry: int
+
+    :returns: The token of the lock, to release it, or None if it is held
+        by someone else.
+    :rtype: str
+    """
+
+    if _held(cache.get(key)):
+        return None
+    token = uuid4().hex
+    cache.set(key, {'token': token, 'deadline': time() + expiry},
+              expiry=expiry)
+    # Read it back, in case someone else wrote it in the meantime
+    entry = cache.get(key)
+    return token if entry and entry['token'] == token else None
+
+
+def release(cache, key, token):
+    """
+    Removes a lock entry from a cache collection, if still held with the
+    given token.
+
+    :param cache: The cache collection holding the lock entries.
+    :type cache: :class:`~zato.server.cache.Cache`
+    :param key: The key of the lock entry.
+    :type key: str
+    :param token: The token returned by :func:`acquire`.
+    :type token: str
+    """
+
+    entry = cache.get(key)
+    if not entry or entry['token'] != token:
+        return
+    try:
+        cache.delete(key)
+    except KeyError:
+        # Expired in the meantime
+        pass
+
+
+def wait(cache, key, locks, lock_key, timeout, interval=0.05):
+    """
+    Waits for an entry to be written to a cache collection while its lock
+    entry is held.
+
+    :param cache: The cache collection the entry is written to.
+    :type cache: :class:`~zato.server.cache.Cache`
+    :param key: The key of the entry.
+    :type key: str
+    :param locks: The cache collection holding the lock entries.
+    :type locks: :class:`~zato.server.cache.Cache`
+    :param lock_key: The key of the lock entry.
+    :type lock_key: str
+    :param timeout: The number of seconds to wait at most.
+    :type timeout: float
+    :param interval: The number of seconds between polls.
+    :type interval: float
+
+    :returns: The entry, with details, or None if it was not written before
+        the lock was released or the timeout expired.
+    """
+
+    deadline = monotonic() + timeout
+    while True:
+        cache_data = cache.get(key, details=True)
+        if cache_data:
+            return cache_data
+        if not _held(locks.get(lock_key)) or monotonic() >= deadline:
+            return None
+        sleep(interval)
+
+
+# Work in progress of all services running in this process
+group = Group()
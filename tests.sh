@@ -66,15 +66,33 @@ curl -v -g "http://127.0.0.1:11223/genesisng/guests/list"; echo ""
 # List using page and size
 curl -v -g "http://127.0.0.1:11223/genesisng/guests/list?page=3&size=35"; echo ""
 
+# List using page and size, including the total count of records
+curl -v -g "http://127.0.0.1:11223/genesisng/guests/list?page=3&size=35&count=true"; echo ""
+
 # List using page, size, sort_by, order_by and fields
 curl -v -g "http://127.0.0.1:11223/genesisng/guests/list?page=10&size=20&sort=surname|asc&fields=id&fields=name&fields=surname"; echo ""
 
+# List the page after the one whose last row was the guest with id 200 and
+# surname Smith, using the token returned in the X-Genesis-After header
+curl -v -g "http://127.0.0.1:11223/genesisng/guests/list?size=20&sort=surname|asc&after=WyJzdXJuYW1lIiwiYXNjIiwiU21pdGgiLDIwMF0"; echo ""
+
 # List using page, size, sort_by, order_by, fields and filters
 curl -v -g "http://127.0.0.1:11223/genesisng/guests/list?page=10&size=10&sort=name|desc&fields=id&fields=name&fields=surname&fields=email&filters=birthdate|gte|1990-01-01"; echo ""
 
 # List using page, size, sort_by, order_by and search
 curl -v -g "http://127.0.0.1:11223/genesisng/guests/list?page=4&size=10&sort=country|asc&search=Palma"; echo ""
 
+# Import a list of guests in CSV format
+curl -v -g -XPOST -d '{"data": "name,surname,email,country\nJohn,Doe,john.doe@example.com,GB\nJane,Doe,jane.doe@example.com,GB\n"}' "http://127.0.0.1:11223/genesisng/guests/import"; echo ""
+
+# Export as newline-delimited JSON or CSV, using filters and fields
+curl -v -g "http://127.0.0.1:11223/genesisng/guests/export?fields=id&fields=email&filters=country|eq|ES"; echo ""
+curl -v -g "http://127.0.0.1:11223/genesisng/bookings/export?format=csv&filters=check_in|gte|2017-01-01"; echo ""
+
+# Export the guests following the one with id 10000, using the token returned
+# in the X-Genesis-After header when the export did not fit in one response
+curl -v -g "http://127.0.0.1:11223/genesisng/guests/export?after=WyJpZCIsImFzYyIsMTAwMDAsMTAwMDBd"; echo ""
+
 # Bookings from a guest
 curl -v -g "http://127.0.0.1:11223/genesisng/guests/1/bookings"; echo ""
 
@@ -104,6 +122,18 @@ curl -v -g "http://127.0.0.1:11223/genesisng/availability/extras"; echo ""
 curl -v -g "http://127.0.0.1:11223/genesisng/availability/search?guests=3&check_in=2017-07-01&check_out=2017-07-10"; echo ""
 curl -v -g "http://127.0.0.1:11223/genesisng/availability/search?guests=3&check_in=2017-07-01&check_out=2017-07-10&rooms=3&rooms=6"; echo ""
 
+# Batch
+curl -v -g -XPOST -d '{"stays": [{"check_in": "2017-07-01", "check_out": "2017-07-10", "guests": 3}, {"check_in": "2017-07-02", "check_out": "2017-07-11", "guests": 3}, {"check_in": "2017-07-03", "check_out": "2017-07-12", "guests": 2}]}' "http://127.0.0.1:11223/genesisng/availability/batch"; echo ""
+
+# Flexible
+curl -v -g "http://127.0.0.1:11223/genesisng/availability/flexible?guests=2&nights=3&date_from=2017-07-01&date_to=2017-07-31"; echo ""
+
 # Bookings
 
+# Validate a booking after listing it, so that it is read from the rows the
+# listing stored in the cache (expects 200 OK rather than a server error)
+curl -v -g "http://127.0.0.1:11223/genesisng/bookings/list?filters=id|eq|1"; echo ""
+PIN=$(curl -s -g "http://127.0.0.1:11223/genesisng/bookings/list?filters=id|eq|1&fields=pin" | python3 -c 'import json, sys; print(json.load(sys.stdin)[0]["pin"])')
+curl -v -g -XPOST -d "{\"pin\": \"$PIN\"}" "http://127.0.0.1:11223/genesisng/bookings/w5kqt6/validate"; echo ""
+
 curl -v -g -XPOST -d '{"id_guest": 1, "id_room"}' "http://127.0.0.1:11223/genesisng/bookings/create"; echo ""